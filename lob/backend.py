@@ -0,0 +1,66 @@
+""" Runtime selection of the JAX backend (e.g. to train and evaluate on CPU-only hosts)
+    and of the persistent compilation cache.
+    Has to be called before any JAX computation initialises the backends.
+"""
+import os
+from typing import Optional
+import jax
+
+
+def configure_backend(
+        backend: Optional[str] = None,
+        n_cpu_devices: Optional[int] = None,
+        n_cpu_threads: Optional[int] = None,
+    ) -> None:
+    """
+    :param backend:         'gpu', 'cpu', 'tpu' or None (JAX default)
+    :param n_cpu_devices:   number of XLA host devices the CPU is split into, which are
+                            used as data parallel devices (pmap / mesh) [default: 1]
+    :param n_cpu_threads:   threads used for host-side (torch / NumPy) data preparation
+                            [default: number of cores per host device]
+    """
+    if backend == 'cpu':
+        n_cores = os.cpu_count() or 1
+        n_cpu_devices = n_cpu_devices or 1
+        flags = [os.environ.get("XLA_FLAGS", ""),
+                 f"--xla_force_host_platform_device_count={n_cpu_devices}"]
+        if n_cpu_devices >= n_cores:
+            # parallelism comes from the host devices: avoid oversubscribing
+            # cores with an intra-op thread pool per device
+            flags.append("--xla_cpu_multi_thread_eigen=false")
+        os.environ["XLA_FLAGS"] = " ".join(flags).strip()
+
+        if n_cpu_threads is None:
+            n_cpu_threads = max(1, n_cores // n_cpu_devices)
+        import torch
+        torch.set_num_threads(n_cpu_threads)
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ.setdefault(var, str(n_cpu_threads))
+
+    if backend is not None:
+        # only initialise the selected platform (e.g. no CUDA on CPU hosts)
+        jax.config.update("jax_platforms", backend)
+
+
+def configure_compilation_cache(
+        cache_dir: Optional[str],
+        min_compile_time_secs: float = 0.,
+    ) -> None:
+    """ Persistent (on-disk) XLA compilation cache, shared by restarts, sweep
+        trials and rollout workers. JAX keys the entries on the lowered
+        computation (i.e. model config and shapes), compile options, devices and
+        JAX version, so one directory holds executables of all configurations.
+    :param cache_dir:               cache directory, None or '' to disable
+    :param min_compile_time_secs:   only cache executables taking at least this long
+                                    to compile [default: 0, i.e. also the small helpers]
+    """
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
+    except AttributeError:
+        # older JAX versions
+        from jax.experimental.compilation_cache import compilation_cache
+        compilation_cache.initialize_cache(cache_dir)
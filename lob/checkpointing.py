@@ -0,0 +1,148 @@
+""" Asynchronous, resumable training checkpoints.
+
+    Besides the per-epoch checkpoints (flax / orbax, used for inference),
+    training can write resume checkpoints every N steps or minutes. These hold
+    the de-replicated train state (params, batch stats and optimizer state,
+    including the step count the learning rate schedules are evaluated at),
+    the RNG keys, the sampler cursor and the data offsets, so that training
+    continues at the exact batch. The state is copied to the host on the
+    training thread and written to disk (msgpack) in a background thread.
+"""
+import os
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from glob import glob
+from typing import Any, Callable, Dict, Optional
+import numpy as onp
+import jax
+from jax.experimental import multihost_utils
+from flax import jax_utils, serialization
+
+
+RESUME_DIR = 'resume'
+_RESUME_FILE = re.compile(r'epoch_(\d+)_batch_(\d+)\.msgpack$')
+
+
+def host_state(state, mesh=None):
+    """ Copy of the train state on the host without the device (pmap)
+        replication, or gathered from the mesh
+    """
+    if mesh is None:
+        return jax.device_get(jax_utils.unreplicate(state))
+    if jax.process_count() > 1:
+        return multihost_utils.process_allgather(state, tiled=True)
+    return jax.device_get(state)
+
+
+class AsyncCheckpointer:
+    """ Decides when resume checkpoints are due and writes checkpoints in a
+        (single) background thread, so that training continues while writing.
+    """
+    def __init__(
+            self,
+            ckpt_dir: str,
+            every_steps: int = 0,
+            every_minutes: float = 0.,
+            keep: int = 2,
+            write: bool = True,
+        ):
+        """
+        :param ckpt_dir:        run checkpoint directory (resume checkpoints go to ckpt_dir/resume)
+        :param every_steps:     write a resume checkpoint every this many steps (0: never)
+        :param every_minutes:   write a resume checkpoint every this many minutes (0: never)
+        :param keep:            number of most recent resume checkpoints to keep
+        :param write:           whether this process writes (e.g. only process 0)
+        """
+        self.resume_dir = os.path.join(ckpt_dir, RESUME_DIR)
+        self.every_steps = every_steps
+        self.every_minutes = every_minutes
+        self.keep = keep
+        self.write = write
+        self.steps = 0
+        self.last_time = time.time()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[Future] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.every_steps > 0 or self.every_minutes > 0
+
+    def due(self) -> bool:
+        """ count a training step and return whether a resume checkpoint is due """
+        self.steps += 1
+        due = (self.every_steps > 0 and self.steps % self.every_steps == 0) or \
+            (self.every_minutes > 0 and time.time() - self.last_time >= 60 * self.every_minutes)
+        if self.every_minutes > 0 and jax.process_count() > 1:
+            # all processes have to take part in gathering the state
+            due = bool(multihost_utils.broadcast_one_to_all(onp.array(due)))
+        return due
+
+    def submit(self, fn: Callable, *args, **kwargs) -> None:
+        """ run a write (e.g. checkpoints.save_checkpoint on host arrays) in the
+            background thread, after the previous write has finished
+        """
+        self.wait()
+        if self.write:
+            self._future = self._executor.submit(fn, *args, **kwargs)
+
+    def save_resume(self, epoch: int, batch: int, target: Dict[str, Any]) -> None:
+        """ write a resume checkpoint of batch (number of batches done) in epoch
+            target: host pytree (e.g. {'state': host_state(state), ...})
+        """
+        self.last_time = time.time()
+        path = os.path.join(self.resume_dir, f'epoch_{epoch}_batch_{batch}.msgpack')
+        self.submit(self._write_resume, path, serialization.to_state_dict(target))
+
+    def _write_resume(self, path: str, target: Dict[str, Any]) -> None:
+        os.makedirs(self.resume_dir, exist_ok=True)
+        # write atomically: a crash while writing keeps the previous checkpoint
+        with open(path + '.tmp', 'wb') as f:
+            f.write(serialization.msgpack_serialize(target))
+        os.replace(path + '.tmp', path)
+        for old in _resume_checkpoints(self.resume_dir)[:-self.keep]:
+            os.remove(old)
+
+    def wait(self) -> None:
+        """ block until the last write has finished (raising its errors) """
+        if self._future is not None:
+            self._future.result()
+            self._future = None
+
+
+def _resume_checkpoints(resume_dir: str):
+    """ resume checkpoint files in resume_dir, oldest first """
+    files = [f for f in glob(os.path.join(resume_dir, '*.msgpack')) if _RESUME_FILE.search(f)]
+    return sorted(files, key=lambda f: tuple(int(i) for i in _RESUME_FILE.search(f).groups()))
+
+
+def latest_resume_checkpoint(path: str) -> Optional[str]:
+    """ most recent resume checkpoint, given a resume checkpoint file, a run
+        checkpoint directory or its resume directory; None if there is none
+    """
+    if os.path.isfile(path) and _RESUME_FILE.search(path):
+        return path
+    for resume_dir in (os.path.join(path, RESUME_DIR), path):
+        files = _resume_checkpoints(resume_dir)
+        if len(files) > 0:
+            return files[-1]
+    return None
+
+
+def load_resume_checkpoint(path: str) -> Dict[str, Any]:
+    """ Read a resume checkpoint as saved, with the train state as state dict
+        (see restore_state)
+    """
+    with open(path, 'rb') as f:
+        return serialization.msgpack_restore(f.read())
+
+
+def restore_state(state, resume: Dict[str, Any], mesh=None, shard_fn: Optional[Callable] = None):
+    """ Train state of a resume checkpoint, restored into the structure of
+        state and placed like it: replicated over the local devices (pmap),
+        or on the mesh with shard_fn(state, mesh)
+    """
+    restored = serialization.from_state_dict(host_state(state, mesh), resume['state'])
+    if mesh is None:
+        return jax_utils.replicate(restored)
+    return shard_fn(restored, mesh)
@@ -1,9 +1,10 @@
 import torch
+import numpy as np
 from pathlib import Path
 import os
 from typing import Callable, Optional, TypeVar, Dict, Tuple, List, Union
 from s5.dataloading import make_data_loader
-from .lobster_dataloader import LOBSTER, LOBSTER_Dataset, LOBSTER_Sampler
+from .lobster_dataloader import LOBSTER, LOBSTER_Dataset, LOBSTER_Sampler, LOBSTER_Subset
 
 
 DEFAULT_CACHE_DIR_ROOT = Path('./cache_dir/')
@@ -29,8 +30,23 @@ def create_lobster_prediction_dataset(
 		book_depth: int = 500,
 		n_data_workers: int = 0,
 		return_raw_msgs: bool = False,
+		n_files_shuffle: int = 0,
+		compact_batches: bool = False,
+		process_index: int = 0,
+		process_count: int = 1,
+		grad_accum_steps: int = 1,
+		steps_per_dispatch: int = 1,
+		resumable: bool = False,
+		track_io: bool = False,
 	) -> ReturnType:
 	""" 
+		bsz is the global batch size. For multi-process training, each process
+		loads bsz // process_count samples per batch from its own shard of the data.
+		With gradient accumulation, training batches contain grad_accum_steps
+		micro-batches of size bsz, for each of steps_per_dispatch stacked steps.
+		resumable: sample training batches with a LOBSTER_Sampler, whose cursor
+				   can be checkpointed (see create_lobster_train_loader)
+		track_io: count memmap pages read per training batch (LOBSTER_Sampler.get_io_stats)
 	"""
 
 	print("[*] Generating LOBSTER Prediction Dataset from", cache_dir)
@@ -48,24 +64,30 @@ def create_lobster_prediction_dataset(
 		book_depth=book_depth,
 		n_cache_files=1e7,  # large number to keep everything in cache
 		return_raw_msgs=return_raw_msgs,
+		compact_batches=compact_batches,
 	)
 	dataset_obj.setup()
 
 	print("Using mask function:", mask_fn)
 
-	# use sampler to only get individual samples and automatic batching from dataloader
-	#trn_sampler = LOBSTER_Sampler(
-	#		dataset_obj.dataset_train, n_files_shuffle=5, batch_size=1, seed=seed)
-	
+	assert bsz % process_count == 0
+	bsz = bsz // process_count
+
 	trn_loader = create_lobster_train_loader(
-		dataset_obj, seed, bsz, n_data_workers, reset_train_offsets=False)
-	# NOTE: drop_last=True recompiles the model for a smaller batch size
+		dataset_obj, seed, bsz * grad_accum_steps * steps_per_dispatch, n_data_workers, reset_train_offsets=False,
+		n_files_shuffle=n_files_shuffle,
+		process_index=process_index, process_count=process_count, resumable=resumable,
+		track_io=track_io)
+	# NOTE: the smaller final batch is padded to bsz and masked in validate
+	#       (train_helpers.pad_batch), so that all samples are evaluated with one compiled shape
 	val_loader = make_data_loader(
-		dataset_obj.dataset_val, dataset_obj, seed=seed, batch_size=bsz,
-		drop_last=True, shuffle=False, num_workers=n_data_workers)
+		process_shard(dataset_obj.dataset_val, process_index, process_count),
+		dataset_obj, seed=seed, batch_size=bsz,
+		drop_last=False, shuffle=False, num_workers=n_data_workers)
 	tst_loader = make_data_loader(
-		dataset_obj.dataset_test, dataset_obj, seed=seed, batch_size=bsz,
-		drop_last=True, shuffle=False, num_workers=n_data_workers)
+		process_shard(dataset_obj.dataset_test, process_index, process_count),
+		dataset_obj, seed=seed, batch_size=bsz,
+		drop_last=False, shuffle=False, num_workers=n_data_workers)
 
 	N_CLASSES = dataset_obj.d_output
 	SEQ_LENGTH = dataset_obj.L
@@ -79,19 +101,69 @@ def create_lobster_prediction_dataset(
 	return (dataset_obj, trn_loader, val_loader, tst_loader, aux_loaders, 
 	 		N_CLASSES, SEQ_LENGTH, IN_DIM, BOOK_SEQ_LEN, BOOK_DIM, TRAIN_SIZE)
 
-def create_lobster_train_loader(dataset_obj, seed, bsz, num_workers, reset_train_offsets=False):
+def process_shard(dset, process_index=0, process_count=1):
+	""" Contiguous and disjoint part of dset for this process, covering all
+		samples: the last len(dset) % process_count processes get one sample more
+	"""
+	if process_count == 1:
+		return dset
+	n, remainder = divmod(len(dset), process_count)
+	# processes before this one with an extra sample
+	n_extra = max(0, process_index - (process_count - remainder))
+	start = process_index * n + n_extra
+	end = start + n + (process_index >= process_count - remainder)
+	return LOBSTER_Subset(dset, np.arange(start, end))
+
+def create_lobster_train_loader(dataset_obj, seed, bsz, num_workers, reset_train_offsets=False,
+								n_files_shuffle=0, process_index=0, process_count=1, resumable=False,
+								track_io=False):
+	""" n_files_shuffle: if > 0, shuffle only within blocks of n_files_shuffle days
+						 (LOBSTER_Sampler) instead of uniformly over all training data
+		Workers are persistent: new random offsets for an epoch are set in place
+		with dataset_obj.reset_train_offsets() and the loader can be reused.
+		For process_count > 1, each process samples (bsz) from its own days.
+		resumable: always use a LOBSTER_Sampler (uniform shuffle for n_files_shuffle=0),
+				   so that training can resume mid-epoch from its state_dict
+		track_io: count memmap pages read per batch (LOBSTER_Sampler with track_io)
+	"""
 	if reset_train_offsets:
 		dataset_obj.reset_train_offsets()
-	# use sampler to only get individual samples and automatic batching from dataloader
-	trn_loader = make_data_loader(
-		dataset_obj.dataset_train,
-		dataset_obj,
-		seed=seed,
-		batch_size=bsz,
-		shuffle=True,  # TODO: remove later
-		num_workers=num_workers)
+	if (process_count > 1 or resumable) and n_files_shuffle == 0:
+		# uniform shuffle over all days of the process' shard
+		n_files_shuffle = dataset_obj.dataset_train.num_days
+	if n_files_shuffle > 0:
+		# day-blocked shuffling for locality of memmap reads
+		trn_sampler = LOBSTER_Sampler(
+			dataset_obj.dataset_train, n_files_shuffle=n_files_shuffle, batch_size=bsz, seed=seed,
+			process_index=process_index, process_count=process_count, track_io=track_io)
+		trn_loader = make_data_loader(
+			dataset_obj.dataset_train,
+			dataset_obj,
+			seed=seed,
+			batch_sampler=trn_sampler,
+			num_workers=num_workers,
+			persistent_workers=True)
+	else:
+		trn_loader = make_data_loader(
+			dataset_obj.dataset_train,
+			dataset_obj,
+			seed=seed,
+			batch_size=bsz,
+			shuffle=True,  # TODO: remove later
+			num_workers=num_workers,
+			persistent_workers=True)
 	return trn_loader
 
+def shutdown_loader(loader):
+	""" Stop the (persistent) worker processes of a DataLoader, e.g. before
+		replacing it with a loader of the next curriculum stage
+	"""
+	iterator = getattr(loader, '_iterator', None)
+	if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+		iterator._shutdown_workers()
+	if loader is not None:
+		loader._iterator = None
+
 Datasets = {
 	# financial data
 	"lobster-prediction": create_lobster_prediction_dataset,
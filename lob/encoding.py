@@ -308,7 +308,20 @@ class Message_Tokenizer:
             raise ValueError("Index ({}) must be less than {}".format(idx, Message_Tokenizer.MSG_LEN))
         field_i = np.searchsorted(Message_Tokenizer.TOK_DELIM, idx, side='right')
         return [Message_Tokenizer.FIELDS[i] for i in field_i]
-    
+
+    @staticmethod
+    def get_non_time_tok_idx():
+        """ Get the indices of all tokens in a message which are predicted,
+            i.e. all but the time_s and time_ns tokens, which are calculated
+            from delta_t during generation.
+        """
+        starts = np.concatenate(([0], Message_Tokenizer.TOK_DELIM))
+        ends = starts + Message_Tokenizer.TOK_LENS
+        time_start_i = starts[Message_Tokenizer.FIELD_I['time_s']]
+        time_end_i = ends[Message_Tokenizer.FIELD_I['time_ns']]
+        idx = np.arange(Message_Tokenizer.MSG_LEN)
+        return idx[(idx < time_start_i) | (idx >= time_end_i)]
+
     @staticmethod
     def _generate_col_idx_by_encoder():
         """ Generates attribute dictionary col_idx_by_encoder
@@ -0,0 +1,158 @@
+""" Export of the model prediction (valh.predict) as a serialized,
+    shape-specialised StableHLO function with the weights bundled, and loading
+    of the exported artifact for inference without constructing the Flax model
+    or retracing it.
+
+    Export a checkpoint (once, e.g. on the training host):
+        python -m lob.export_model --ckpt_path checkpoints/<run> --out predict.jaxexport
+
+    Use it in rollout workers:
+        args, state, model = load_exported_model('predict.jaxexport')
+        inference.generate(..., train_state=state, model=model, batchnorm=args.batchnorm, ...)
+
+    The exported function is specialised to the input shapes it was exported
+    for (single sample, n_messages messages) and to the platform it was
+    exported on.
+"""
+import argparse
+import json
+from argparse import Namespace
+from typing import Optional, Tuple
+import numpy as onp
+import jax
+import jax.numpy as jnp
+from flax import linen as nn
+from flax import serialization
+from flax.core.frozen_dict import freeze, unfreeze
+
+try:
+    from jax import export as jax_export
+except ImportError:
+    try:
+        # JAX < 0.4.30
+        from jax.experimental import export as jax_export
+    except ImportError:
+        jax_export = None
+
+from lob.encoding import Message_Tokenizer, Vocab
+from lob.init_train import InferenceState, init_model_cls, load_inference_checkpoint
+
+
+def _require_export():
+    if jax_export is None:
+        raise NotImplementedError(
+            f"JAX {jax.__version__} has no export API (jax.export / jax.experimental.export)")
+
+
+def _serialize(exported) -> bytes:
+    if hasattr(exported, 'serialize'):
+        return bytes(exported.serialize())
+    return bytes(jax_export.serialize(exported))
+
+
+def _variables(state, batchnorm: bool) -> dict:
+    """ model variables as passed to model.apply by valh.predict (plain dicts) """
+    if batchnorm:
+        return unfreeze({"params": state.params, "batch_stats": state.batch_stats})
+    return unfreeze({"params": state.params})
+
+
+def export_predict(
+        state,
+        model: nn.Module,
+        batchnorm: bool,
+        seq_len: int,
+        book_seq_len: int,
+        book_dim: int,
+        config: Optional[dict] = None,
+    ) -> bytes:
+    """ Export valh.predict of model for a single sample of seq_len message
+        tokens and book_seq_len x book_dim book inputs.
+        Returns the serialized artifact (exported function, variables, config).
+    """
+    _require_export()
+    variables = jax.tree_util.tree_map(onp.asarray, _variables(state, batchnorm))
+
+    def predict_fn(variables, m_seq, b_seq, m_timesteps, b_timesteps):
+        return model.apply(variables, m_seq, b_seq, m_timesteps, b_timesteps)
+
+    specs = (
+        jax.tree_util.tree_map(lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype), variables),
+        jax.ShapeDtypeStruct((1, seq_len, len(Vocab())), jnp.float32),
+        jax.ShapeDtypeStruct((1, book_seq_len, book_dim), jnp.float32),
+        jax.ShapeDtypeStruct((1, seq_len), jnp.float32),
+        jax.ShapeDtypeStruct((1, book_seq_len), jnp.float32),
+    )
+    exported = jax_export.export(jax.jit(predict_fn))(*specs)
+
+    return serialization.msgpack_serialize({
+        'exported': _serialize(exported),
+        'variables': variables,
+        'mode': model.mode,
+        'batchnorm': batchnorm,
+        # restored config values may be numpy scalars
+        'config': json.dumps(config or {}, default=lambda x: x.item()),
+    })
+
+
+class ExportedModel:
+    """ Stand-in for the Flax model in valh.predict (and thus inference.generate),
+        calling the deserialized exported function instead of tracing the model
+    """
+    def __init__(self, exported, mode: str):
+        self.exported = exported
+        self.mode = mode
+
+    def apply(self, variables, *inputs):
+        return self.exported.call(unfreeze(variables), *inputs)
+
+
+def load_exported_model(path: str) -> Tuple[Namespace, InferenceState, ExportedModel]:
+    """ Load an exported artifact (see export_predict)
+        Returns training args, inference state (bundled weights) and model.
+    """
+    _require_export()
+    with open(path, 'rb') as f:
+        artifact = serialization.msgpack_restore(f.read())
+    exported = jax_export.deserialize(bytearray(artifact['exported']))
+    variables = artifact['variables']
+    state = InferenceState(
+        params=freeze(variables['params']),
+        batch_stats=freeze(variables['batch_stats']) if 'batch_stats' in variables else None,
+    )
+    args = Namespace(**json.loads(artifact['config']))
+    args.batchnorm = bool(artifact['batchnorm'])
+    return args, state, ExportedModel(exported, str(artifact['mode']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the model prediction of a checkpoint as serialized StableHLO')
+    parser.add_argument('--ckpt_path', type=str, required=True,
+                        help='training checkpoint directory or params-only export')
+    parser.add_argument('--out', type=str, required=True,
+                        help='file the exported artifact is written to')
+    parser.add_argument('--step', type=int, default=None,
+                        help='checkpoint step [default: latest]')
+    parser.add_argument('--n_messages', type=int, default=500,
+                        help='number of input messages the function is exported for')
+    parser.add_argument('--book_dim', type=int, default=501,
+                        help='dimension of the (transformed) book input')
+    export_args = parser.parse_args()
+
+    args, state = load_inference_checkpoint(export_args.ckpt_path, step=export_args.step)
+    assert args.use_book_data, "export is only implemented for models with book data"
+    model = init_model_cls(args, n_classes=len(Vocab()), book_dim=export_args.book_dim)(
+        training=False, step_rescale=1.0)
+    artifact = export_predict(
+        state,
+        model,
+        args.batchnorm,
+        seq_len=export_args.n_messages * Message_Tokenizer.MSG_LEN,
+        book_seq_len=export_args.n_messages,
+        book_dim=export_args.book_dim,
+        config=vars(args),
+    )
+    with open(export_args.out, 'wb') as f:
+        f.write(artifact)
+    print(f"[*] Exported prediction ({len(artifact) / 2**20:.1f} MiB) to {export_args.out}")
@@ -25,6 +25,7 @@ from lob.preproc import transform_L2_state
 import lob.encoding as encoding
 from lob.encoding import Message_Tokenizer, Vocab
 from lob.lobster_dataloader import LOBSTER_Dataset
+from lob.profiling import NO_TIMER, StepTimer
 
 
 # add git submodule to path to allow imports to work
@@ -56,6 +57,9 @@ l2_state_n = 20
 # hence, skip generation from TIME_START_I (inclusive) to TIME_END_I (exclusive)
 TIME_START_I, _ = valh.get_idx_from_field('time_s')
 _, TIME_END_I = valh.get_idx_from_field('time_ns')
+# row of the multi-target model output (mode='multi') for each message token
+MULTI_TARGET_I = {
+    int(tok_i): i for i, tok_i in enumerate(Message_Tokenizer.get_non_time_tok_idx())}
 
 @jax.jit
 def init_msgs_from_l2(book: Union[pd.Series, onp.ndarray]) -> jnp.ndarray:
@@ -767,6 +771,9 @@ def generate(
         # if eval_msgs given, also returns loss of predictions
         # e.g. to calculate perplexity
         m_seq_eval: Optional[jax.Array] = None,  
+        # lob.profiling.StepTimer: per message times of input preparation,
+        # model prediction ('compute') and the order book simulator ('sim')
+        timer: StepTimer = NO_TIMER,
     ) -> Tuple[jax.Array, jax.Array, jax.Array, jax.Array, int, jax.Array]:
 
     # id_gen = OrderIdGenerator()
@@ -851,30 +858,37 @@ def generate(
                 continue
 
             # syntactically valid tokens for current message position
-            valid_mask = valh.get_valid_mask(valid_mask_array, mask_i)
-            m_seq, _ = valh.mask_last_msg_in_seq(m_seq, mask_i)
-            input = (
-                one_hot(
-                    jnp.expand_dims(m_seq, axis=0), vocab_len
-                ).astype(float),
-                jnp.expand_dims(b_seq, axis=0)
-            )
-            integration_timesteps = (
-                jnp.ones((1, len(m_seq))), 
-                jnp.ones((1, len(b_seq)))
-            )
-            logits = valh.predict(
-                input,
-                integration_timesteps, train_state, model, batchnorm)
-            
-            # filter out (syntactically) invalid tokens for current position
-            if valid_mask is not None:
-                logits = valh.filter_valid_pred(logits, valid_mask)
-
-            # update sequence
-            # note: rng arg expects one element per batch element
-            rng, rng_ = jax.random.split(rng)
-            m_seq = valh.fill_predicted_toks(m_seq, logits, sample_top_n, jnp.array([rng_]))
+            with timer.phase('prep'):
+                valid_mask = valh.get_valid_mask(valid_mask_array, mask_i)
+                m_seq, _ = valh.mask_last_msg_in_seq(m_seq, mask_i)
+                input = timer.sync((
+                    one_hot(
+                        jnp.expand_dims(m_seq, axis=0), vocab_len
+                    ).astype(float),
+                    jnp.expand_dims(b_seq, axis=0)
+                ))
+                integration_timesteps = (
+                    jnp.ones((1, len(m_seq))), 
+                    jnp.ones((1, len(b_seq)))
+                )
+            with timer.phase('compute'):
+                logits = valh.predict(
+                    input,
+                    integration_timesteps, train_state, model, batchnorm)
+                # multi-target models predict all tokens of the message at once:
+                # only keep the prediction for the current position
+                if model.mode == 'multi':
+                    logits = logits[:, MULTI_TARGET_I[mask_i]]
+                
+                # filter out (syntactically) invalid tokens for current position
+                if valid_mask is not None:
+                    logits = valh.filter_valid_pred(logits, valid_mask)
+
+                # update sequence
+                # note: rng arg expects one element per batch element
+                rng, rng_ = jax.random.split(rng)
+                m_seq = timer.sync(
+                    valh.fill_predicted_toks(m_seq, logits, sample_top_n, jnp.array([rng_])))
 
         debug(m_seq[-l:])
         # TODO: remove
@@ -903,16 +917,17 @@ def generate(
 
         # parse generated message for simulator, also getting corrected raw message
         # (needs to be encoded and overwrite originally generated message)
-        sim_msg, msg_corr, msg_raw = get_sim_msg(
-            m_seq[-l:],  # the generated message
-            m_seq[:-l],  # sequence without generated message
-            m_seq_raw[1:],   # raw data (same length as sequence without generated message)
-            sim,
-            mid_price=p_mid_old.astype(jnp.int32),
-            new_order_id=order_id,
-            tick_size=tick_size,
-            encoder=encoder,
-        )
+        with timer.phase('sim'):
+            sim_msg, msg_corr, msg_raw = get_sim_msg(
+                m_seq[-l:],  # the generated message
+                m_seq[:-l],  # sequence without generated message
+                m_seq_raw[1:],   # raw data (same length as sequence without generated message)
+                sim,
+                mid_price=p_mid_old.astype(jnp.int32),
+                new_order_id=order_id,
+                tick_size=tick_size,
+                encoder=encoder,
+            )
 
         if sim_msg is None:
             info('invalid message - discarding...\n')
@@ -923,6 +938,7 @@ def generate(
             m_seq = onp.concatenate([
                 onp.full((l,), Vocab.NA_TOK),
                 m_seq[: -l]])
+            timer.step_done()
             continue
 
         info(sim_msg)
@@ -937,15 +953,16 @@ def generate(
         debug('new raw msg', encoding.repr_raw_msg(m_seq_raw[-1]))
 
         # feed message to simulator, updating book state
-        _trades = sim.process_order_array(sim_msg)
-        # debug('trades', _trades)
-        p_mid_new = (sim.get_best_ask() + sim.get_best_bid()) / 2
-        p_mid_new = (p_mid_new // tick_size) * tick_size
-        p_change = ((p_mid_new - p_mid_old) // tick_size).astype(jnp.int32)
+        with timer.phase('sim'):
+            _trades = sim.process_order_array(sim_msg)
+            # debug('trades', _trades)
+            p_mid_new = (sim.get_best_ask() + sim.get_best_bid()) / 2
+            p_mid_new = (p_mid_new // tick_size) * tick_size
+            p_change = ((p_mid_new - p_mid_old) // tick_size).astype(jnp.int32)
 
-        # get new book state
-        book = sim.get_L2_state(l2_state_n)
-        l2_book_states.append(book)
+            # get new book state
+            book = timer.sync(sim.get_L2_state(l2_state_n))
+            l2_book_states.append(book)
 
         new_book_raw = jnp.concatenate([jnp.array([p_change]), book]).reshape(1,-1)
         new_book = preproc.transform_L2_state(new_book_raw, 500, 100)
@@ -954,6 +971,7 @@ def generate(
 
         debug('p_change', p_change, '\n------------------------------------\\n')
 
+        timer.step_done()
         n_msg_todo -= 1
 
     if m_seq_eval is None:
@@ -1083,7 +1101,8 @@ def generate_single_rollout(
         batchnorm,
         encoder,
         rng,
-        m_seq_eval = None
+        m_seq_eval = None,
+        timer: StepTimer = NO_TIMER,
     ):
     
     rng, rng_ = jax.random.split(rng)        
@@ -1102,6 +1121,7 @@ def generate_single_rollout(
         encoder,
         rng_,
         sample_top_n=-1,  # sample from entire distribution
+        timer=timer,
     )
     # only keep actually newly generated messages
     m_seq_raw_gen = m_seq_raw_gen[-n_gen_msgs:]
@@ -1227,6 +1247,7 @@ def generate_repeated_rollouts(
         sim_book_levels: int,
         sim_queue_len: int,
         data_levels: int,
+        timer: StepTimer = NO_TIMER,
     ):
 
     l2_book_states = jnp.zeros((num_repeats, n_gen_msgs, sim_book_levels * 4))
@@ -1282,7 +1303,8 @@ def generate_repeated_rollouts(
             batchnorm,
             encoder,
             rng,
-            m_seq_eval
+            m_seq_eval,
+            timer=timer,
         )
         event_types_gen = event_types_gen.at[i].set(rollout_metrics['event_types_gen'])
         event_types_eval = event_types_eval.at[i].set(eval.event_type_count(m_seq_raw_eval[:, 1]))
@@ -1325,7 +1347,9 @@ def sample_messages(
         sim_book_levels: int = 20,
         sim_queue_len: int = 100,
         data_levels: int = 10,
-        save_folder: str = './tmp/'
+        save_folder: str = './tmp/',
+        # lob.profiling.StepTimer of the generated messages (see generate)
+        timer: StepTimer = NO_TIMER,
     ):
 
     rng, rng_ = jax.random.split(rng)
@@ -1373,8 +1397,11 @@ def sample_messages(
             n_vol_series,
             sim_book_levels,
             sim_queue_len,
-            data_levels
+            data_levels,
+            timer=timer,
         )
+        if timer.enabled:
+            print(f'Generation step time (p50 ms): {timer.summary()}')
         # save results dict as pickle file
         with open(save_folder + f'/tmp_inference_results_dict_{i}.pkl', 'wb') as f:
             pickle.dump(sequence_metrics, f)
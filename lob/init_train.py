@@ -2,20 +2,29 @@ from __future__ import annotations
 from argparse import Namespace
 from glob import glob
 from functools import partial
-from typing import Optional, Tuple, Union
+import json
+import os
+from typing import Any, Optional, Sequence, Set, Tuple, Union
+import numpy as onp
 import jax
 import jax.numpy as np
 from jax import random
+from jax.sharding import Mesh
 from flax.training.train_state import TrainState
 from jax.scipy.linalg import block_diag
 from flax.training import checkpoints
 from flax import linen as nn
+from flax import struct
+from flax.core.frozen_dict import freeze, unfreeze
+from flax.traverse_util import flatten_dict, unflatten_dict
 from orbax import checkpoint
 from lob.encoding import Vocab
 from lob.lob_seq_model import BatchFullLobPredModel, BatchLobPredModel, BatchPaddedLobPredModel, FullLobPredModel#, ParFullLobPredModel
 
 #from lob.lob_seq_model import BatchLobPredModel
-from lob.train_helpers import create_train_state, eval_step, prep_batch, cross_entropy_loss, compute_accuracy
+from lob.sharding import inference_sharding
+from lob.train_helpers import create_train_state, make_lr_schedule, eval_step, prep_batch, cross_entropy_loss, compute_accuracy
+from s5.autotune import autotune_ssm_kernels
 from s5.ssm import init_S5SSM
 from s5.ssm_init import make_DPLR_HiPPO
 from s5.dataloading import make_data_loader
@@ -24,6 +33,21 @@ from lob.lobster_dataloader import LOBSTER_Dataset, LOBSTER
 import lob.validation_helpers as valh
 
 
+# defaults of training args read by init_model_cls which are missing from
+# the config of checkpoints trained before they were added
+CONFIG_DEFAULTS = {
+    'precision': 'fp32',
+    'remat': 'none',
+    'ssm_kernel': 'scan',
+    'ssm_chunk_size': 256,
+}
+
+
+def _config_args(config: dict) -> Namespace:
+    """ training args of a checkpoint config, with CONFIG_DEFAULTS for missing args """
+    return Namespace(**{**CONFIG_DEFAULTS, **config})
+
+
 def load_args_from_checkpoint(
         checkpoint_path: str,
         step: Optional[int] = None,
@@ -37,7 +61,7 @@ def load_args_from_checkpoint(
         step=step,
         orbax_checkpointer=orbax_checkpointer
     )
-    args = Namespace(**raw_restored['config'])
+    args = _config_args(raw_restored['config'])
     return args
 
 
@@ -68,29 +92,208 @@ def load_checkpoint(
     return restored
 
 
-def init_train_state(
+@struct.dataclass
+class InferenceState:
+    """ Model variables needed for inference (e.g. valh.predict), without
+        optimizer state or apply_fn
+    """
+    params: Any
+    batch_stats: Any = None
+
+
+# files of a params-only export (see export_inference_params)
+PARAMS_CONFIG = 'config.json'
+PARAMS_INDEX = 'index.json'
+
+
+def _is_params_export(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, PARAMS_INDEX))
+
+
+def _unreplicate_variables(variables: dict) -> dict:
+    """ strip the leading device axis of variables saved from pmap training
+        (detected on the 1D SSM eigenvalues 'Lambda_re'); mesh training saves
+        unreplicated variables
+    """
+    lambdas = [v for k, v in flatten_dict(variables['params']).items() if k[-1] == 'Lambda_re']
+    assert len(lambdas) > 0, "no S5 layer (Lambda_re) found in checkpoint params"
+    if lambdas[0].ndim == 1:
+        return variables
+    return jax.tree_util.tree_map(lambda x: x[0], variables)
+
+
+def _restore_variables(
+        path: str,
+        step: Optional[int] = None,
+    ) -> Tuple[dict, dict]:
+    """ raw (target-free) restore of a training checkpoint: config and
+        unreplicated params / batch_stats as host arrays
+    """
+    orbax_checkpointer = checkpoint.PyTreeCheckpointer()
+    raw_restored = checkpoints.restore_checkpoint(
+        path,
+        None,
+        step=step,
+        orbax_checkpointer=orbax_checkpointer
+    )
+    model = raw_restored['model']
+    variables = {'params': model['params']}
+    if model.get('batch_stats') is not None:
+        variables['batch_stats'] = model['batch_stats']
+    variables = jax.tree_util.tree_map(onp.asarray, _unreplicate_variables(variables))
+    return raw_restored['config'], variables
+
+
+def export_inference_params(
+        ckpt_path: str,
+        out_dir: str,
+        step: Optional[int] = None,
+    ) -> None:
+    """ Write params and batch_stats of a training checkpoint (without
+        optimizer state) as one .npy file per array plus the training config,
+        for fast (memory-mapped) loading with load_inference_checkpoint
+    """
+    config, variables = _restore_variables(ckpt_path, step)
+    os.makedirs(out_dir, exist_ok=True)
+    index = []
+    for i, (k, v) in enumerate(flatten_dict(variables).items()):
+        onp.save(os.path.join(out_dir, f'{i}.npy'), v)
+        index.append(list(k))
+    with open(os.path.join(out_dir, PARAMS_INDEX), 'w') as f:
+        json.dump(index, f)
+    with open(os.path.join(out_dir, PARAMS_CONFIG), 'w') as f:
+        # restored config values may be numpy scalars
+        json.dump(dict(config), f, indent=2, default=lambda x: x.item())
+
+
+def load_inference_checkpoint(
+        path: str,
+        step: Optional[int] = None,
+        mmap: bool = True,
+        mesh: Optional[Mesh] = None,
+    ) -> Tuple[Namespace, InferenceState]:
+    """ Load training args and the inference state (params, batch_stats) of a
+        checkpoint, without building the optimizer or initialising the model.
+        path: params export (see export_inference_params), whose arrays are
+              memory-mapped if mmap (pages are read from disk while copying
+              them to the device, without an intermediate host copy),
+              or flax / orbax training checkpoint directory (read once in full)
+        mesh: if given, the state is placed on the mesh (see lob.sharding),
+              otherwise on the default device
+        The state is put on device once, so that jitted predictions don't copy
+        the weights from the host on every call.
+        Use with init_model_cls(args, ...) to build the model.
+    """
+    if _is_params_export(path):
+        with open(os.path.join(path, PARAMS_CONFIG)) as f:
+            config = json.load(f)
+        with open(os.path.join(path, PARAMS_INDEX)) as f:
+            index = json.load(f)
+        variables = unflatten_dict({
+            tuple(k): onp.load(os.path.join(path, f'{i}.npy'), mmap_mode='r' if mmap else None)
+            for i, k in enumerate(index)
+        })
+    else:
+        config, variables = _restore_variables(path, step)
+    state = InferenceState(
+        params=freeze(variables['params']),
+        batch_stats=freeze(variables['batch_stats']) if 'batch_stats' in variables else None,
+    )
+    if mesh is not None:
+        state = jax.device_put(state, inference_sharding(state, mesh))
+    else:
+        state = jax.device_put(state)
+    return _config_args(config), state
+
+
+def resample_positions(kernel: jax.Array, new_len: int) -> jax.Array:
+    """ Linearly interpolate a kernel (..., L, d) over its position axis (-2)
+        to new_len positions, scaled by L / new_len so that the projection of
+        a constant sequence keeps its magnitude.
+    """
+    kernel = onp.asarray(kernel)
+    old_len = kernel.shape[-2]
+    resampled = onp.apply_along_axis(
+        lambda k: onp.interp(onp.linspace(0, 1, new_len), onp.linspace(0, 1, old_len), k),
+        -2, kernel)
+    return np.array(resampled * old_len / new_len, dtype=kernel.dtype)
+
+
+def transfer_train_state(
+        old_state: TrainState,
+        new_state: TrainState,
+        seq_len_layers: Tuple[str, ...] = ('message_out_proj', 'book_out_proj'),
+    ) -> TrainState:
+    """ Transfer training state to a new state for a different sequence length
+        (e.g. for the next stage of a msg_seq_len curriculum).
+        Parameters and optimizer state of the same shape are copied. Kernels of
+        the projections over the sequence length (seq_len_layers) are resampled
+        to the new length (see resample_positions), their optimizer state is reset.
+        The leaves are read on the host: states on a mesh need to be gathered
+        first (lob.checkpointing.host_state) and placed on the mesh afterwards.
+    """
+    old_params = flatten_dict(unfreeze(old_state.params))
+    new_params = flatten_dict(unfreeze(new_state.params))
+    params = {}
+    for k, new_p in new_params.items():
+        old_p = old_params[k]
+        if old_p.shape == new_p.shape:
+            params[k] = old_p
+        elif k[-2] in seq_len_layers and k[-1] == 'kernel':
+            params[k] = resample_positions(old_p, new_p.shape[-2])
+        else:
+            raise ValueError(f"Can't transfer parameter {'/'.join(k)}: {old_p.shape} -> {new_p.shape}")
+    opt_state = jax.tree_util.tree_map(
+        lambda o, n: o if o.shape == n.shape else n,
+        old_state.opt_state, new_state.opt_state)
+
+    state = new_state.replace(
+        step=old_state.step,
+        params=unflatten_dict(params),
+        opt_state=opt_state,
+    )
+    if hasattr(old_state, 'batch_stats'):
+        state = state.replace(batch_stats=old_state.batch_stats)
+    return state
+
+
+def ssm_shapes(
         args: Namespace,
-        n_classes: int,
         seq_len: int,
+        book_seq_len: int,
         book_dim: int,
-        book_seq_len,
-        print_shapes=False
-    ) -> Tuple[TrainState, Union[partial[BatchLobPredModel], partial[FullLobPredModel]]]:
+    ) -> Set[Tuple[int, int, int, bool, bool]]:
+    """ distinct (L, H, P, conj_sym, bidirectional) of the S5 layers of the model """
+    P = args.ssm_size_base // 2 if args.conj_sym else args.ssm_size_base
+    def shape(L, H):
+        return (L, H, P, args.conj_sym, args.bidirectional)
 
-    in_dim = n_classes
+    # message encoder
+    shapes = {shape(seq_len, args.d_model)}
+    if args.use_book_data:
+        if args.n_book_pre_layers > 0:
+            shapes.add(shape(book_seq_len, book_dim))
+        if args.n_book_post_layers > 0:
+            shapes.add(shape(book_seq_len, args.d_model))
+        # fused layers over the projected (d_model) sequence
+        shapes.add(shape(args.d_model, args.d_model))
+    return shapes
 
-    ssm_size = args.ssm_size_base
-    ssm_lr = args.ssm_lr_base
 
-    # Set global learning rate lr (e.g. encoders, etc.) as function of ssm_lr
-    lr = args.lr_factor * ssm_lr
+def init_model_cls(
+        args: Namespace,
+        n_classes: int,
+        book_dim: int,
+        print_shapes=False,
+    ) -> Union[partial[BatchLobPredModel], partial[BatchFullLobPredModel]]:
+    """ Model class (partial, missing training and step_rescale) of the
+        training args, without initialising any parameters
+    """
+    ssm_size = args.ssm_size_base
 
     # determine the size of initial blocks
     block_size = int(ssm_size / args.blocks)
 
-    key = random.PRNGKey(args.jax_seed)
-    init_rng, train_rng = random.split(key, num=2)
-
     # Initialize state matrix A using approximation to HiPPO-LegS matrix
     Lambda, _, B, V, B_orig = make_DPLR_HiPPO(block_size)
 
@@ -112,12 +315,18 @@ def init_train_state(
         print("Lambda.shape={}".format(Lambda.shape))
         print("V.shape={}".format(V.shape))
         print("Vinv.shape={}".format(Vinv.shape))
-        print("book_seq_len", book_seq_len)
-        print("book_dim", book_dim)
+
+    if args.mode == 'multi':
+        # per-token readout is only causal with a unidirectional encoder
+        assert not args.bidirectional, "mode 'multi' requires bidirectional=False"
+
+    # mixed precision: computation dtype of dense layers (params stay float32)
+    if args.precision == 'bf16':
+        dtype = np.bfloat16
+    else:
+        dtype = np.float32
 
     padded = False
-    retrieval = False
-    speech = False
 
     ssm_init_fn = init_S5SSM(
         H=args.d_model,
@@ -132,7 +341,9 @@ def init_train_state(
         dt_max=args.dt_max,
         conj_sym=args.conj_sym,
         clip_eigs=args.clip_eigs,
-        bidirectional=args.bidirectional
+        bidirectional=args.bidirectional,
+        kernel=args.ssm_kernel,
+        chunk_size=args.ssm_chunk_size,
     )
     
     if args.use_book_data:
@@ -160,6 +371,8 @@ def init_train_state(
             prenorm=args.prenorm,
             batchnorm=args.batchnorm,
             bn_momentum=args.bn_momentum,
+            dtype=dtype,
+            remat=args.remat,
         )
     else:
         if args.num_devices > 1:
@@ -178,7 +391,62 @@ def init_train_state(
             prenorm=args.prenorm,
             batchnorm=args.batchnorm,
             bn_momentum=args.bn_momentum,
+            dtype=dtype,
+            remat=args.remat,
+        )
+
+    return model_cls
+
+
+def init_train_state(
+        args: Namespace,
+        n_classes: int,
+        seq_len: int,
+        book_dim: int,
+        book_seq_len,
+        print_shapes=False,
+        steps_per_epoch: Optional[Union[int, Sequence[int]]] = None,
+        mesh: Optional[Mesh] = None,
+        stage_seq_lens: Sequence[Tuple[int, int]] = (),
+    ) -> Tuple[TrainState, Union[partial[BatchLobPredModel], partial[FullLobPredModel]]]:
+    """ stage_seq_lens: (seq_len, book_seq_len) of further msg_seq_len curriculum
+                        stages, whose SSM kernels are tuned up front (ssm_kernel 'auto')
+    """
+
+    in_dim = n_classes
+
+    ssm_lr = args.ssm_lr_base
+
+    # Set global learning rate lr (e.g. encoders, etc.) as function of ssm_lr
+    lr = args.lr_factor * ssm_lr
+
+    if steps_per_epoch is not None:
+        # per step learning rate decay, evaluated by optax in the train step
+        ssm_lr = make_lr_schedule(
+            ssm_lr, steps_per_epoch, args.warmup_end, args.epochs, args.cosine_anneal, args.lr_min)
+        lr = make_lr_schedule(
+            lr, steps_per_epoch, args.warmup_end, args.epochs, args.cosine_anneal, args.lr_min)
+
+    key = random.PRNGKey(args.jax_seed)
+    init_rng, train_rng = random.split(key, num=2)
+
+    if print_shapes:
+        print("book_seq_len", book_seq_len)
+        print("book_dim", book_dim)
+
+    if args.ssm_kernel == 'auto':
+        # fastest SSM kernel per layer shape (cached), before the model is traced
+        shapes = ssm_shapes(args, seq_len, book_seq_len, book_dim)
+        for stage_seq_len, stage_book_seq_len in stage_seq_lens:
+            shapes |= ssm_shapes(args, stage_seq_len, stage_book_seq_len, book_dim)
+        autotune_ssm_kernels(
+            shapes,
+            bsz=max(1, args.bsz // args.num_devices),
+            cache_file=args.ssm_autotune_cache,
         )
+    model_cls = init_model_cls(args, n_classes, book_dim, print_shapes)
+    padded = False
+    retrieval = False
 
     # initialize training state
     state = create_train_state(
@@ -197,8 +465,12 @@ def init_train_state(
         opt_config=args.opt_config,
         ssm_lr=ssm_lr,
         lr=lr,
+        lr_min=args.lr_min,
         dt_global=args.dt_global,
         num_devices=args.num_devices,
+        mesh=mesh,
+        shard_opt_state=args.shard_opt_state,
+        shard_params=args.shard_params,
     )
 
     return state, model_cls
@@ -1,10 +1,29 @@
 from functools import partial
-from typing import Tuple
+from typing import Any, Tuple
 import jax
 import jax.numpy as jnp
 from flax import linen as nn
-from s5.layers import SequenceLayer
+from s5.layers import SequenceLayer, dense_layer, remat_layer
 from s5.seq_model import StackedEncoderModel, masked_meanpool
+from lob.encoding import Message_Tokenizer
+
+
+def multi_target_readout_idx(seq_len):
+    """ Sequence positions from which the (non-time) tokens of the last
+        message are predicted in mode 'multi': each token is read out from
+        the position directly before it, so that (with a causal encoder)
+        it is only conditioned on the earlier tokens of the message.
+    """
+    return seq_len - Message_Tokenizer.MSG_LEN - 1 + Message_Tokenizer.get_non_time_tok_idx()
+
+
+def remat_stack(module_cls, remat="none"):
+    """ With remat 'stack', only save the inputs of a whole layer stack
+        and recompute all its activations in the backward pass.
+    """
+    if remat == "stack":
+        return nn.remat(module_cls)
+    return module_cls
 
 
 class LobPredModel(nn.Module):
@@ -22,13 +41,23 @@ class LobPredModel(nn.Module):
             dropout     (float32):  dropout rate
             training    (bool):     whether in training mode or not
             mode        (str):      Options: [pool: use mean pooling, last: just take
-                                                                       the last state]
+                                                                       the last state,
+                                              multi: predict all non-time tokens of the
+                                                     last message (one output per token)]
             prenorm     (bool):     apply prenorm if true or postnorm if false
             batchnorm   (bool):     apply batchnorm if true or layernorm if false
             bn_momentum (float32):  the batchnorm momentum if batchnorm is used
             step_rescale  (float32):  allows for uniformly changing the timescale parameter,
                                     e.g. after training on a different resolution for
                                     the speech commands benchmark
+            dtype       (dtype):    computation dtype of dense layers and decoder (e.g. bfloat16),
+                                    parameters and SSMs are kept in float32
+            quantize    (bool):     int8 weight-only dense layers and decoder for inference
+                                    (params converted with s5.layers.quantize_params)
+            remat       (str):      activation rematerialization: [none,
+                                    layer: save only inputs of each S5 layer,
+                                    dots: save matmul outputs of each S5 layer,
+                                    stack: save only inputs of each layer stack]
     """
     ssm: nn.Module
     d_output: int
@@ -43,12 +72,16 @@ class LobPredModel(nn.Module):
     batchnorm: bool = False
     bn_momentum: float = 0.9
     step_rescale: float = 1.0
+    dtype: Any = jnp.float32
+    quantize: bool = False
+    remat: str = "none"
 
     def setup(self):
         """
         Initializes the S5 stacked encoder and a linear decoder.
         """
-        self.encoder = StackedEncoderModel(
+        encoder_cls = remat_stack(StackedEncoderModel, self.remat)
+        self.encoder = encoder_cls(
                             ssm=self.ssm,
                             d_model=self.d_model,
                             n_layers=self.n_layers,
@@ -59,8 +92,11 @@ class LobPredModel(nn.Module):
                             batchnorm=self.batchnorm,
                             bn_momentum=self.bn_momentum,
                             step_rescale=self.step_rescale,
+                            dtype=self.dtype,
+                            quantize=self.quantize,
+                            remat=self.remat,
                                         )
-        self.decoder = nn.Dense(self.d_output)
+        self.decoder = dense_layer(self.quantize)(self.d_output, dtype=self.dtype)
 
     def __call__(self, x, integration_timesteps):
         """
@@ -88,11 +124,17 @@ class LobPredModel(nn.Module):
                 raise NotImplementedError("Mode must be in ['pool'] for self.padded=True (for now...)")
             else:
                 x = x[-1]
+        elif self.mode in ["multi"]:
+            if self.padded:
+                raise NotImplementedError("Mode must be in ['pool'] for self.padded=True (for now...)")
+            # (n_targets, d_model): one readout per target token
+            x = x[multi_target_readout_idx(x.shape[0])]
         else:
-            raise NotImplementedError("Mode must be in ['pool', 'last]")
+            raise NotImplementedError("Mode must be in ['pool', 'last', 'multi']")
 
         x = self.decoder(x)
-        return nn.log_softmax(x, axis=-1)
+        # loss is computed in float32
+        return nn.log_softmax(x.astype(jnp.float32), axis=-1)
 
 # Here we call vmap to parallelize across a batch of input sequences
 BatchLobPredModel = nn.vmap(
@@ -117,13 +159,17 @@ class LobBookModel(nn.Module):
     batchnorm: bool = False
     bn_momentum: float = 0.9
     step_rescale: float = 1.0
+    dtype: Any = jnp.float32
+    quantize: bool = False
+    remat: str = "none"
 
     def setup(self):
         """
         Initializes ...
         """
+        layer_cls = remat_layer(SequenceLayer, self.remat)
         self.layers = tuple(
-            SequenceLayer(
+            layer_cls(
                 # fix ssm init to correct shape (different than other layers)
                 ssm=partial(self.ssm, H=self.d_book),
                 dropout=self.dropout,
@@ -134,11 +180,13 @@ class LobBookModel(nn.Module):
                 batchnorm=self.batchnorm,
                 bn_momentum=self.bn_momentum,
                 step_rescale=self.step_rescale,
+                dtype=self.dtype,
+                quantize=self.quantize,
             ) for _ in range(self.n_pre_layers)
         )
-        self.layers += (nn.Dense(self.d_model), )  # project to d_model
+        self.layers += (dense_layer(self.quantize)(self.d_model, dtype=self.dtype), )  # project to d_model
         self.layers += tuple(
-            SequenceLayer(
+            layer_cls(
                 ssm=self.ssm,
                 dropout=self.dropout,
                 d_model=self.d_model,
@@ -148,6 +196,8 @@ class LobBookModel(nn.Module):
                 batchnorm=self.batchnorm,
                 bn_momentum=self.bn_momentum,
                 step_rescale=self.step_rescale,
+                dtype=self.dtype,
+                quantize=self.quantize,
             )
             for _ in range(self.n_post_layers)
         )
@@ -182,12 +232,17 @@ class FullLobPredModel(nn.Module):
     batchnorm: bool = False
     bn_momentum: float = 0.9
     step_rescale: float = 1.0
+    dtype: Any = jnp.float32
+    quantize: bool = False
+    remat: str = "none"
 
     def setup(self):
         """
         Initializes the S5 stacked encoder and a linear decoder.
         """
-        self.message_encoder = StackedEncoderModel(
+        encoder_cls = remat_stack(StackedEncoderModel, self.remat)
+        book_encoder_cls = remat_stack(LobBookModel, self.remat)
+        self.message_encoder = encoder_cls(
             ssm=self.ssm,
             d_model=self.d_model,
             n_layers=self.n_message_layers,
@@ -198,10 +253,13 @@ class FullLobPredModel(nn.Module):
             batchnorm=self.batchnorm,
             bn_momentum=self.bn_momentum,
             step_rescale=self.step_rescale,
+            dtype=self.dtype,
+            quantize=self.quantize,
+            remat=self.remat,
         )
         # applied to transposed message output to get seq len for fusion
-        self.message_out_proj = nn.Dense(self.d_model)  
-        self.book_encoder = LobBookModel(
+        self.message_out_proj = dense_layer(self.quantize)(self.d_model, dtype=self.dtype)  
+        self.book_encoder = book_encoder_cls(
             ssm=self.ssm,
             d_book=self.d_book,
             d_model=self.d_model,
@@ -214,10 +272,13 @@ class FullLobPredModel(nn.Module):
             batchnorm=self.batchnorm,
             bn_momentum=self.bn_momentum,
             step_rescale=self.step_rescale,
+            dtype=self.dtype,
+            quantize=self.quantize,
+            remat=self.remat,
         )
         # applied to transposed book output to get seq len for fusion
-        self.book_out_proj = nn.Dense(self.d_model)
-        self.fused_s5 = StackedEncoderModel(
+        self.book_out_proj = dense_layer(self.quantize)(self.d_model, dtype=self.dtype)
+        self.fused_s5 = encoder_cls(
             ssm=self.ssm,
             d_model=self.d_model,
             n_layers=self.n_fused_layers,
@@ -228,8 +289,11 @@ class FullLobPredModel(nn.Module):
             batchnorm=self.batchnorm,
             bn_momentum=self.bn_momentum,
             step_rescale=self.step_rescale,
+            dtype=self.dtype,
+            quantize=self.quantize,
+            remat=self.remat,
         )
-        self.decoder = nn.Dense(self.d_output)
+        self.decoder = dense_layer(self.quantize)(self.d_output, dtype=self.dtype)
 
     def __call__(self, x_m, x_b, message_integration_timesteps, book_integration_timesteps):
         """
@@ -248,6 +312,13 @@ class FullLobPredModel(nn.Module):
         # TODO: check integration time steps make sense here
         x_b = self.book_encoder(x_b, book_integration_timesteps)
 
+        if self.mode in ["multi"]:
+            # per-token states of the last message, read out before each target
+            x_tok = x_m[multi_target_readout_idx(x_m.shape[0])]
+            # the fusion projection mixes all positions: hide the last message
+            # so that the fused context only contains past messages
+            x_m = x_m.at[-Message_Tokenizer.MSG_LEN:].set(0.)
+
         x_m = self.message_out_proj(x_m.T).T
         x_b = self.book_out_proj(x_b.T).T
         x = jnp.concatenate([x_m, x_b], axis=1)
@@ -258,11 +329,17 @@ class FullLobPredModel(nn.Module):
             x = jnp.mean(x, axis=0)
         elif self.mode in ["last"]:
             x = x[-1]
+        elif self.mode in ["multi"]:
+            # combine fused context with each token state: (n_targets, 3*d_model)
+            x = jnp.mean(x, axis=0)
+            x = jnp.concatenate(
+                [jnp.broadcast_to(x, (x_tok.shape[0], x.shape[0])), x_tok], axis=1)
         else:
-            raise NotImplementedError("Mode must be in ['pool', 'last]")
+            raise NotImplementedError("Mode must be in ['pool', 'last', 'multi']")
 
         x = self.decoder(x)
-        return nn.log_softmax(x, axis=-1)
+        # loss is computed in float32
+        return nn.log_softmax(x.astype(jnp.float32), axis=-1)
 
 # Here we call vmap to parallelize across a batch of input sequences
 BatchFullLobPredModel = nn.vmap(
@@ -289,12 +366,17 @@ class PaddedLobPredModel(nn.Module):
     batchnorm: bool = False
     bn_momentum: float = 0.9
     step_rescale: float = 1.0
+    dtype: Any = jnp.float32
+    quantize: bool = False
+    remat: str = "none"
 
     def setup(self):
         """
         Initializes the S5 stacked encoder and a linear decoder.
         """
-        self.message_encoder = StackedEncoderModel(
+        encoder_cls = remat_stack(StackedEncoderModel, self.remat)
+        book_encoder_cls = remat_stack(LobBookModel, self.remat)
+        self.message_encoder = encoder_cls(
             ssm=self.ssm,
             d_model=self.d_model,
             n_layers=self.n_message_layers,
@@ -305,10 +387,13 @@ class PaddedLobPredModel(nn.Module):
             batchnorm=self.batchnorm,
             bn_momentum=self.bn_momentum,
             step_rescale=self.step_rescale,
+            dtype=self.dtype,
+            quantize=self.quantize,
+            remat=self.remat,
         )
         # applied to transposed message output to get seq len for fusion
         #self.message_out_proj = nn.Dense(self.d_model)  
-        self.book_encoder = LobBookModel(
+        self.book_encoder = book_encoder_cls(
             ssm=self.ssm,
             d_book=self.d_book,
             d_model=self.d_model,
@@ -321,10 +406,13 @@ class PaddedLobPredModel(nn.Module):
             batchnorm=self.batchnorm,
             bn_momentum=self.bn_momentum,
             step_rescale=self.step_rescale,
+            dtype=self.dtype,
+            quantize=self.quantize,
+            remat=self.remat,
         )
         # applied to transposed book output to get seq len for fusion
         #self.book_out_proj = nn.Dense(self.d_model)
-        self.fused_s5 = StackedEncoderModel(
+        self.fused_s5 = encoder_cls(
             ssm=self.ssm,
             d_model=self.d_model,
             n_layers=self.n_fused_layers,
@@ -335,8 +423,11 @@ class PaddedLobPredModel(nn.Module):
             batchnorm=self.batchnorm,
             bn_momentum=self.bn_momentum,
             step_rescale=self.step_rescale,
+            dtype=self.dtype,
+            quantize=self.quantize,
+            remat=self.remat,
         )
-        self.decoder = nn.Dense(self.d_output)
+        self.decoder = dense_layer(self.quantize)(self.d_output, dtype=self.dtype)
 
     def __call__(self, x_m, x_b, message_integration_timesteps, book_integration_timesteps):
         """
@@ -368,7 +459,8 @@ class PaddedLobPredModel(nn.Module):
             raise NotImplementedError("Mode must be in ['pool', 'last]")
 
         x = self.decoder(x)
-        return nn.log_softmax(x, axis=-1)
+        # loss is computed in float32
+        return nn.log_softmax(x.astype(jnp.float32), axis=-1)
 
 # Here we call vmap to parallelize across a batch of input sequences
 BatchPaddedLobPredModel = nn.vmap(
@@ -1,5 +1,6 @@
 """ Datasets for core experimental results """
 from pathlib import Path
+import mmap
 import random
 import sys
 from typing import Sequence
@@ -11,6 +12,7 @@ from collections import OrderedDict
 
 #import torch
 #import torchvision
+import torch
 from torch.utils.data import Dataset, Subset, Sampler
 from glob import glob
 import pandas as pd
@@ -27,6 +29,7 @@ from s5.dataloaders.base import default_data_path, SequenceDataset
 from s5.utils import permutations
 default_data_path = Path(__file__).parent.parent.absolute()
 default_data_path = default_data_path / "data"
+PAGE_SIZE = mmap.PAGESIZE
 
 
 class LOBSTER_Dataset(Dataset):
@@ -144,7 +147,18 @@ class LOBSTER_Dataset(Dataset):
             # seq[-1][slice(*LOBSTER_Dataset._get_tok_slice_i(f))] = Vocab.HIDDEN_TOK
             seq = seq.at[-1, slice(*LOBSTER_Dataset._get_tok_slice_i(f))].set(Vocab.HIDDEN_TOK)
         return seq, y
-    
+
+    @staticmethod
+    def last_msg_mask(seq, rng):
+        """ Keep the most recent message as is and use all of its non-time
+            tokens as prediction targets (multi-target training).
+            No MSK or HID tokens are set: the model (mode='multi') reads out
+            each target from the position preceding it, so every prediction
+            is conditioned only on the earlier tokens of the message.
+        """
+        y = seq[-1, Message_Tokenizer.get_non_time_tok_idx()]
+        return seq, y
+
     @staticmethod
     def _select_random_causal_mask(rng):
         """ Select random subset of fields and one field to mask
@@ -218,6 +232,9 @@ class LOBSTER_Dataset(Dataset):
             # if given, also load and return raw sequences
             # -> used for inference (not training!)
             return_raw_msgs=False,
+            # return int16 tokens and raw int32 L2 book rows,
+            # book_transform is then applied on device (prep_batch)
+            compact_batches=False,
             ) -> None:
 
         assert len(message_files) > 0
@@ -235,6 +252,7 @@ class LOBSTER_Dataset(Dataset):
         self.book_transform = book_transform
         self.book_depth = book_depth
         self.return_raw_msgs = return_raw_msgs
+        self.compact_batches = compact_batches
         self.num_days = len(self.message_files)
         self.n_messages = n_messages
 
@@ -246,16 +264,34 @@ class LOBSTER_Dataset(Dataset):
         self.rng = np.random.default_rng(seed)
         self.rng_jax = jax.random.PRNGKey(seed)
         self.randomize_offset = randomize_offset
+        # offsets and sequence start indices live in shared memory, so that
+        # persistent DataLoader workers see changes made by reseed_offsets
+        self._seq_offsets = torch.zeros(self.num_days, dtype=torch.int64).share_memory_()
+        self._seqs_cumsum_shared = torch.zeros(self.num_days + 1, dtype=torch.int64).share_memory_()
+        # only read file headers once
+        self._num_rows = np.array([self._get_num_rows(f) for f in message_files])
         self._reset_offsets()
         self._set_book_dims()
 
-        self._seqs_per_file = np.array(
-            [(self._get_num_rows(f) - self.seq_offsets[i]) // n_messages
-             for i, f in enumerate(message_files)])
+    @property
+    def seq_offsets(self):
+        return self._seq_offsets.numpy()
+
+    @property
+    def _seqs_cumsum(self):
         # store at which observations files start
-        self._seqs_cumsum = np.concatenate(([0], np.cumsum(self._seqs_per_file)))
-        # count total number of sequences only once
-        self._len = int(self._seqs_cumsum[-1])
+        return self._seqs_cumsum_shared.numpy()
+
+    @property
+    def _seqs_per_file(self):
+        return np.diff(self._seqs_cumsum)
+
+    def reseed_offsets(self, seed):
+        """ Draw new random offsets in place (e.g. every training epoch),
+            without re-opening files or re-creating the DataLoader
+        """
+        self.rng = np.random.default_rng(seed)
+        self._reset_offsets()
 
     def _set_book_dims(self):
         if self.use_book_data:
@@ -275,18 +311,36 @@ class LOBSTER_Dataset(Dataset):
             so that sequences don't always contain the same time periods
         """
         if self.randomize_offset:
-            self.seq_offsets = {
-                i: self.rng.integers(0, self.n_messages) 
-                for i in range(len(self.message_files))}
+            offsets = self.rng.integers(0, self.n_messages, size=self.num_days)
         else:
-            self.seq_offsets = {i: 0 for i in range(len(self.message_files))}
+            offsets = np.zeros(self.num_days, dtype=np.int64)
+        self.set_offsets(offsets)
+
+    def set_offsets(self, offsets):
+        """ Set the offsets of all files in place, e.g. restored from a
+            checkpoint (seq_offsets) to resume at the same sequences
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        assert offsets.shape == (self.num_days,), \
+            f"offsets for {offsets.shape} days, dataset has {self.num_days}"
+        seqs_per_file = (self._num_rows - offsets) // self.n_messages
+        # update in place (shared memory)
+        self.seq_offsets[:] = offsets
+        self._seqs_cumsum[:] = np.concatenate(([0], np.cumsum(seqs_per_file)))
+
+    def num_sequences(self, n_messages):
+        """ Expected number of sequences of n_messages messages (e.g. of another
+            msg_seq_len curriculum stage), with random offsets of half a sequence
+        """
+        offset = n_messages // 2 if self.randomize_offset else 0
+        return int(np.sum(np.maximum(self._num_rows - offset, 0) // n_messages))
 
     @property
     def shape(self):
         return len(self), Message_Tokenizer.MSG_LEN#, len(self.vocab)
 
     def __len__(self):
-        return self._len
+        return int(self._seqs_cumsum[-1])
 
     def __getitem__(self, idx):
         if hasattr(idx, '__len__'):
@@ -319,6 +373,9 @@ class LOBSTER_Dataset(Dataset):
         # apply mask and extract prediction target token
         X, y = self.mask_fn(X, self.rng)
         X, y = X.reshape(-1), y.reshape(-1)
+        if self.compact_batches:
+            # vocab fits into int16, one-hot encoding is done on device
+            X = X.astype(jnp.int16)
         # TODO: look into aux_data (could we still use time when available?)
 
         if self.use_book_data:
@@ -330,7 +387,11 @@ class LOBSTER_Dataset(Dataset):
 
             # tranform from L2 (price volume) representation to fixed volume image 
             if self.book_transform:
-                book = transform_L2_state(book, self.book_depth, 100)
+                if self.compact_batches:
+                    # ~40 values per message instead of book_depth + 1
+                    book = book.astype(np.int32)
+                else:
+                    book = transform_L2_state(book, self.book_depth, 100)
 
             # use raw price, volume series, rather than volume image
             # subtract initial price to start all sequences around 0
@@ -383,108 +444,194 @@ class LOBSTER_Dataset(Dataset):
     
 
 class LOBSTER_Sampler(Sampler):
-    def __init__(self, dset, n_files_shuffle, batch_size=1, seed=None):
+    """ Day-blocked shuffling: days are visited in random order in blocks of
+        n_files_shuffle days and only the sequences within a block are shuffled.
+        This keeps reads local to a few memory-mapped files at a time, trading
+        shuffle quality against page cache misses once data exceeds RAM.
+        If batch_size > 1, lists of indices are yielded (to be used as
+        batch_sampler), dropping the last incomplete batch.
+        The order of every epoch is a deterministic function of (seed, epoch),
+        so iteration can be resumed with load_state_dict.
+        For multi-process training, every process gets a disjoint shard of days
+        (process_index, process_count) and only reads data from its own days.
+        All processes must use the same seed and yield the same number of batches.
+        track_io: estimate the memmap pages read per batch (see get_io_stats),
+                  a diagnostic which costs time on the data path
+    """
+    def __init__(self, dset, n_files_shuffle, batch_size=1, seed=None,
+                 process_index=0, process_count=1, track_io=False):
         self.dset = dset
         assert n_files_shuffle > 0
         self.n_files_shuffle = n_files_shuffle
         self.batch_size = batch_size
+        assert 0 <= process_index < process_count
+        self.process_index = process_index
+        self.process_count = process_count
+        if seed is None:
+            assert process_count == 1, "seed must be given for multi-process sampling"
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.epoch = 0
+        # number of batches already yielded in the current epoch
+        self.batches_done = 0
+        self.track_io = track_io
+        self._reset_io_stats()
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'batches_done': self.batches_done}
+
+    def load_state_dict(self, state):
+        """ Resume iteration at a given position. NOTE: with DataLoader workers,
+            the sampler runs ahead of training, so batches_done should be set to
+            the number of batches actually consumed by the training loop.
+        """
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.batches_done = state['batches_done']
 
-        self.rng = random.Random(seed)
-
-    def reset(self):
+    def _get_indices_by_day(self):
         # LOBSTER_Dataset
-        if hasattr(self.dset, "num_days"):
-            days = range(self.dset.num_days)
+        if hasattr(self.dset, "_seqs_cumsum"):
+            cumsum = self.dset._seqs_cumsum
+            return {d: np.arange(cumsum[d], cumsum[d + 1]) for d in range(self.dset.num_days)}
         # LOBSTER_Subset
         elif hasattr(self.dset, "indices_on_day"):
-            days = list(self.dset.indices_on_day.keys())
+            return self.dset.indices_on_day
         else:
             raise AttributeError("dataset has neither num_days nor indices_on_day attribute.")
-        # days in random order
-        self.days_unused = self.rng.sample(
-            days,
-            len(days)
-        )
-        self.active_indices = []
+
+    def epoch_order(self, epoch):
+        """ All indices of an epoch in the order they are sampled
+            and the (exclusive) end position of every block of days
+        """
+        rng = np.random.default_rng([self.seed, epoch])
+        indices_on_day = self._get_indices_by_day()
+        # same global day order on all processes
+        days = rng.permutation(list(indices_on_day.keys()))
+        shards = [days[p::self.process_count] for p in range(self.process_count)]
+        # all processes need the same number of batches
+        n_batches = min(sum(len(indices_on_day[d]) for d in shard) for shard in shards) // self.batch_size
+        days = shards[self.process_index]
+        rng = np.random.default_rng([self.seed, epoch, self.process_index])
+        blocks = [
+            rng.permutation(np.concatenate([indices_on_day[d] for d in days[i: i + self.n_files_shuffle]]))
+            for i in range(0, len(days), self.n_files_shuffle)
+        ]
+        order = np.concatenate(blocks).astype(np.int64)
+        block_ends = np.cumsum([len(b) for b in blocks])
+        # drop last incomplete batch
+        return order[: n_batches * self.batch_size], block_ends
 
     def __iter__(self):
-        # reset days and active indices whenever new iterator is created (e.g. new epoch)
-        self.reset()
-
-        while len(self.days_unused) > 0 or len(self.active_indices) >= self.batch_size:
-            batch = []
-            # not enough indices available for full batch
-            if len(self.active_indices) < self.batch_size:
-                batch += list(self.active_indices)
-                # get new indices from new days
-                self.active_indices = self._get_new_active_indices(self._get_new_days())
-            while len(batch) < self.batch_size:
-                # TODO: fix pop from empty list error
-                batch.append(self.active_indices.pop())
+        order, block_ends = self.epoch_order(self.epoch)
+        batches = order.reshape(-1, self.batch_size)
+        self._io_block = None
+        for batch in batches[self.batches_done:]:
+            # block of the first sample in the batch
+            block = np.searchsorted(block_ends, self.batches_done * self.batch_size, side='right')
+            self.batches_done += 1
+            if self.track_io:
+                self._update_io_stats(batch, block)
             if self.batch_size == 1:
-                batch = batch[0]
-            yield batch
-
-    def _get_new_days(self):
-        days = []
-        for _ in range(self.n_files_shuffle):
-            if len(self.days_unused) > 0:
-                days.append(self.days_unused.pop())
+                yield int(batch[0])
             else:
-                break
-        return days
-
-    def _get_new_active_indices(self, days):
-        idx = []
-        # LOBSTER_Dataset
-        if hasattr(self.dset, "_seqs_cumsum"):
-            for d in days:
-                idx.extend(
-                    list(range(
-                        self.dset._seqs_cumsum[d],
-                        self.dset._seqs_cumsum[d + 1]
-                    ))
-                )
-        elif hasattr(self.dset, "indices_on_day"):
-            for d in days:
-                idx.extend(self.dset.indices_on_day[d])
-        else:
-            raise AttributeError("dataset has neither num_days nor indices_on_day attribute.")
-        
-        self.rng.shuffle(idx)
-        return idx
+                yield batch.tolist()
+        self.epoch += 1
+        self.batches_done = 0
 
     def __len__(self):
-        return len(self.dset)
+        order, _ = self.epoch_order(self.epoch)
+        return len(order) // self.batch_size
+
+    # I/O metrics: estimate memmap pages touched per batch
+    def _reset_io_stats(self):
+        self._io_n_batches = 0
+        self._io_pages = 0
+        self._io_new_pages = 0
+        self._io_seen_pages = set()
+        self._io_block = None
+
+    def get_io_stats(self, reset=True):
+        """ Returns the mean number of memmap pages touched per batch and the mean
+            number of pages not touched before in the current block of days
+            (approximate page cache misses if the files of a block fit in RAM).
+            Only counted with track_io.
+        """
+        n = max(self._io_n_batches, 1)
+        stats = {
+            'pages_per_batch': self._io_pages / n,
+            'new_pages_per_batch': self._io_new_pages / n,
+            'n_batches': self._io_n_batches,
+        }
+        if reset:
+            self._reset_io_stats()
+        return stats
+
+    def _file_layouts(self, dset):
+        # (header offset, bytes per row) for every message (and book) file
+        if not hasattr(self, '_layouts'):
+            files = [dset.message_files]
+            if dset.use_book_data:
+                files.append(dset.book_files)
+            self._layouts = []
+            for fs in files:
+                lay = []
+                for f in fs:
+                    a = np.load(f, mmap_mode='r', allow_pickle=True)
+                    lay.append((a.offset, a.itemsize * int(np.prod(a.shape[1:]))))
+                self._layouts.append(np.array(lay, dtype=np.int64))
+        return self._layouts
+
+    def _update_io_stats(self, batch, block):
+        dset = self.dset
+        idx = np.asarray(batch)
+        # map subset positions to dataset indices
+        if hasattr(dset, "indices"):
+            idx = np.asarray(dset.indices)[idx]
+            dset = dset.dataset
+        file_idx = np.searchsorted(dset._seqs_cumsum, idx, side='right') - 1
+        seq_idx = idx - dset._seqs_cumsum[file_idx]
+        row_start = dset.seq_offsets[file_idx] + seq_idx * dset.n_messages
+        row_end = row_start + dset.n_messages
+
+        # files of the previous block are assumed to be evicted
+        if block != self._io_block:
+            self._io_seen_pages = set()
+            self._io_block = block
+
+        pages = set()
+        for kind, layout in enumerate(self._file_layouts(dset)):
+            header, row_bytes = layout[file_idx, 0], layout[file_idx, 1]
+            p_start = (header + row_start * row_bytes) // PAGE_SIZE
+            p_end = (header + row_end * row_bytes - 1) // PAGE_SIZE
+            for f, ps, pe in zip(file_idx, p_start, p_end):
+                pages.update((kind, int(f), p) for p in range(ps, pe + 1))
+        self._io_n_batches += 1
+        self._io_pages += len(pages)
+        self._io_new_pages += len(pages - self._io_seen_pages)
+        self._io_seen_pages |= pages
 
 
 class LOBSTER_Subset(Subset):
     def __init__(self, dataset: LOBSTER_Dataset, indices: Sequence[int]) -> None:
         self.dataset = dataset
-        self.indices = sorted(indices)
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
 
         self.indices_on_day = self.get_indices_by_day(
             self.indices)
 
     def __getitem__(self, idx):
         if isinstance(idx, list):
-            return self.dataset[[self.indices[i] for i in idx]]
-        return self.dataset[self.indices[idx]]
+            return self.dataset[[int(self.indices[i]) for i in idx]]
+        return self.dataset[int(self.indices[idx])]
 
     def get_indices_by_day(self, indices):
-        indices_on_day = {}
-        day = 0
-        i_end = self.dataset._seqs_cumsum[day + 1]
-
-        for i, idx in enumerate(indices):
-            while idx >= i_end:
-                day += 1
-                i_end = self.dataset._seqs_cumsum[day + 1]
-            
-            if day not in indices_on_day.keys():
-                indices_on_day[day] = []
-            indices_on_day[day].append(i)
-        return indices_on_day
+        """ Returns dict of day -> positions in (sorted) indices on that day
+        """
+        days = np.searchsorted(self.dataset._seqs_cumsum, indices, side='right') - 1
+        unique_days, day_starts = np.unique(days, return_index=True)
+        positions = np.split(np.arange(len(indices)), day_starts[1:])
+        return {int(d): pos for d, pos in zip(unique_days, positions)}
 
 
 class LOBSTER(SequenceDataset):
@@ -528,6 +675,7 @@ class LOBSTER(SequenceDataset):
             "n_cache_files": 0,
             "book_depth": 500,
             "return_raw_msgs": False,
+            "compact_batches": False,
         }
 
     def setup(self):
@@ -586,6 +734,7 @@ class LOBSTER(SequenceDataset):
             book_transform=self.book_transform,
             book_depth=self.book_depth,
             return_raw_msgs=self.return_raw_msgs,
+            compact_batches=self.compact_batches,
         )
         #self.d_input = self.dataset_train.shape[-1]
         self.d_input = len(self.dataset_train.vocab)
@@ -609,6 +758,7 @@ class LOBSTER(SequenceDataset):
             book_transform=self.book_transform,
             book_depth=self.book_depth,
             return_raw_msgs=self.return_raw_msgs,
+            compact_batches=self.compact_batches,
         )
 
         self.dataset_test = LOBSTER_Dataset(
@@ -623,6 +773,7 @@ class LOBSTER(SequenceDataset):
             book_transform=self.book_transform,
             book_depth=self.book_depth,
             return_raw_msgs=self.return_raw_msgs,
+            compact_batches=self.compact_batches,
         )
 
     def reset_train_offsets(self):
@@ -633,19 +784,7 @@ class LOBSTER(SequenceDataset):
         """
         # use a new seed for the train dataset to
         # get a different random offset for each sequence for each epoch
-        self.dataset_train = LOBSTER_Dataset(
-            self.train_files,
-            n_messages=self.n_messages,
-            mask_fn=self.mask_fn,
-            seed=self.rng.randint(0, sys.maxsize),
-            n_cache_files=self.n_cache_files,
-            randomize_offset=True,
-            book_files=self.train_book_files,
-            use_simple_book=self.use_simple_book,
-            book_transform=self.book_transform,
-            book_depth=self.book_depth,
-            return_raw_msgs=self.return_raw_msgs,
-        )
+        self.dataset_train.reseed_offsets(self.rng.randint(0, sys.maxsize))
 
     def __str__(self):
         return f"{'p' if self.permute else 's'}{self._name_}"
@@ -0,0 +1,126 @@
+""" On-device accumulation of evaluation metrics.
+
+    The metrics pytree holds running sums of the loss and accuracy over all
+    targets, and broken down by the message field of the target
+    (Message_Tokenizer.FIELDS) and by the event type of the target message.
+    It is updated inside the compiled eval step and only fetched to the host
+    (summarise_metrics) once per evaluation run.
+"""
+from functools import lru_cache
+from typing import Dict
+import numpy as onp
+import jax
+import jax.numpy as np
+from jax.nn import one_hot
+
+from lob.encoding import Message_Tokenizer, Vocab
+
+
+EVENT_TYPES = ('new', 'cancel', 'delete', 'execute')
+# event type bucket of messages with hidden event type
+N_EVENT_BUCKETS = len(EVENT_TYPES) + 1
+N_FIELDS = len(Message_Tokenizer.FIELDS)
+METRIC_SHAPES = {
+    'loss': (), 'acc': (), 'count': (),
+    'field_loss': (N_FIELDS,), 'field_acc': (N_FIELDS,), 'field_count': (N_FIELDS,),
+    'event_loss': (N_EVENT_BUCKETS,), 'event_acc': (N_EVENT_BUCKETS,), 'event_count': (N_EVENT_BUCKETS,),
+}
+
+
+@lru_cache()
+def _first_event_type_tok() -> int:
+    """ token of event type 1 ('new') """
+    return int(Vocab().ENCODING['event_type'][1][3])
+
+
+def init_metrics() -> Dict[str, jax.Array]:
+    """ zero running sums (of valid targets: 'count') """
+    return {k: np.zeros(shape, dtype=np.float32) for k, shape in METRIC_SHAPES.items()}
+
+
+def target_fields(last_msg: jax.Array, n_targets: int) -> jax.Array:
+    """ field index of every target of a batch (batch, n_targets)
+        last_msg:  input tokens of the most recent message (batch, MSG_LEN)
+        n_targets: 1 for masked (MSK token) targets, otherwise all non-time
+                   tokens of the message are targets (multi-target mode)
+    """
+    if n_targets == 1:
+        tok_i = np.argmax(last_msg == Vocab.MASK_TOK, axis=-1)[:, None]
+    else:
+        tok_i = np.broadcast_to(
+            Message_Tokenizer.get_non_time_tok_idx(), (last_msg.shape[0], n_targets))
+    return np.searchsorted(np.asarray(Message_Tokenizer.TOK_DELIM), tok_i, side='right')
+
+
+def target_event_types(last_msg: jax.Array, labels: jax.Array) -> jax.Array:
+    """ event type bucket (0-3, 4: hidden) of the target message (batch,)
+        labels: (batch, n_targets), the event type is the first target if masked
+    """
+    et_i = Message_Tokenizer.FIELD_I['event_type']
+    tok = last_msg[:, et_i]
+    tok = np.where(tok == Vocab.MASK_TOK, labels[:, 0].astype(tok.dtype), tok)
+    event_type = tok - _first_event_type_tok()
+    valid = (event_type >= 0) & (event_type < len(EVENT_TYPES))
+    return np.where(valid, event_type, len(EVENT_TYPES))
+
+
+def update_metrics(
+        metrics: Dict[str, jax.Array],
+        losses: jax.Array,
+        accs: jax.Array,
+        last_msg: jax.Array,
+        labels: jax.Array,
+        mask: jax.Array,
+    ) -> Dict[str, jax.Array]:
+    """ add a batch to the running sums
+        losses, accs, labels: (batch,) or (batch, n_targets)
+        mask: validity of the samples (batch,)
+    """
+    losses, accs, labels = (x.reshape(mask.shape[0], -1) for x in (losses, accs, labels))
+    weights = np.broadcast_to(mask.astype(np.float32)[:, None], losses.shape)
+    losses = losses * weights
+    accs = accs.astype(np.float32) * weights
+
+    fields = one_hot(target_fields(last_msg, losses.shape[1]), N_FIELDS)
+    events = one_hot(target_event_types(last_msg, labels), N_EVENT_BUCKETS)[:, None]
+
+    def by(groups, x):
+        return np.sum(groups * x[..., None], axis=(0, 1))
+
+    return {
+        'loss': metrics['loss'] + losses.sum(),
+        'acc': metrics['acc'] + accs.sum(),
+        'count': metrics['count'] + weights.sum(),
+        'field_loss': metrics['field_loss'] + by(fields, losses),
+        'field_acc': metrics['field_acc'] + by(fields, accs),
+        'field_count': metrics['field_count'] + by(fields, weights),
+        'event_loss': metrics['event_loss'] + by(events, losses),
+        'event_acc': metrics['event_acc'] + by(events, accs),
+        'event_count': metrics['event_count'] + by(events, weights),
+    }
+
+
+def summarise_metrics(metrics: Dict[str, jax.Array]) -> Dict[str, float]:
+    """ Fetch the running sums (summing over leading device / process axes, if any)
+        and return mean loss and accuracy, overall ('loss', 'acc') and
+        per field / event type (e.g. 'loss/price', 'acc/event_execute').
+        Groups without targets are left out.
+    """
+    sums = jax.device_get(metrics)
+    sums = {k: onp.asarray(v).reshape(-1, *METRIC_SHAPES[k]).sum(axis=0) for k, v in sums.items()}
+
+    summary = {
+        'loss': float(sums['loss'] / sums['count']),
+        'acc': float(sums['acc'] / sums['count']),
+    }
+    groups = (
+        ('field', Message_Tokenizer.FIELDS),
+        ('event', tuple(f'event_{e}' for e in EVENT_TYPES + ('hidden',))),
+    )
+    for prefix, names in groups:
+        for i, name in enumerate(names):
+            n = sums[f'{prefix}_count'][i]
+            if n > 0:
+                summary[f'loss/{name}'] = float(sums[f'{prefix}_loss'][i] / n)
+                summary[f'acc/{name}'] = float(sums[f'{prefix}_acc'][i] / n)
+    return summary
@@ -0,0 +1,145 @@
+""" Per-step timing of the training / evaluation / generation loops and
+    capturing of JAX (Perfetto) traces for a window of training steps.
+
+    StepTimer splits the wall time of every step into phases:
+        data:      waiting for the next batch from the data loader
+        transfer:  host to device copy (and reshaping into device batches)
+        prep:      on-device batch preparation (one-hot encoding, book transform)
+        compute:   the compiled train / eval step
+        logging:   host-side bookkeeping (losses, progress bar)
+    When enabled, the device is synchronised after the transfer, prep and
+    compute phases so that asynchronous dispatch does not move time into
+    the next phase. This removes the overlap of host and device work, so
+    throughput with timing enabled is a lower bound.
+"""
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Optional, Sequence
+import numpy as onp
+import jax
+
+
+class StepTimer:
+    PHASES = ('data', 'transfer', 'prep', 'compute', 'logging')
+
+    def __init__(self, window: int = 100, enabled: bool = True):
+        """
+        :param window:  number of most recent steps the percentiles are computed over
+        :param enabled: if False, all methods are no-ops (no synchronisation)
+        """
+        self.enabled = enabled
+        self.steps = deque(maxlen=window)
+        self._current = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """ add the time spent in the context to phase `name` of the current step """
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[name] = self._current.get(name, 0.) + time.perf_counter() - t0
+
+    def sync(self, x):
+        """ wait for device computation of x (only when enabled) """
+        if self.enabled:
+            jax.block_until_ready(x)
+        return x
+
+    def iterate(self, iterable: Iterable):
+        """ iterate over e.g. a data loader, timing each fetch as 'data' phase """
+        it = iter(iterable)
+        while True:
+            with self.phase('data'):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def step_done(self) -> None:
+        if not self.enabled:
+            return
+        self.steps.append(self._current)
+        self._current = {}
+
+    def reset(self) -> None:
+        self.steps.clear()
+        self._current = {}
+
+    def percentiles(self, qs: Sequence[int] = (50, 90, 99)) -> Dict[str, float]:
+        """ rolling percentiles (in ms) of every phase and of the total step time
+            e.g. {'compute_p50_ms': ..., 'compute_p90_ms': ..., 'step_p50_ms': ...}
+        """
+        if not self.enabled or len(self.steps) == 0:
+            return {}
+        phases = [p for p in self.PHASES if any(p in s for s in self.steps)]
+        phases += sorted({p for s in self.steps for p in s} - set(phases))
+        times = {p: onp.array([s.get(p, 0.) for s in self.steps]) for p in phases}
+        times['step'] = sum(times.values())
+        return {
+            f'{p}_p{q}_ms': float(onp.percentile(t, q)) * 1e3
+            for p, t in times.items() for q in qs
+        }
+
+    def summary(self, q: int = 50) -> str:
+        """ short string of the q-th percentile of every phase, e.g. for tqdm """
+        stats = self.percentiles((q,))
+        return ' '.join(f"{k.split('_')[0]}={v:.1f}" for k, v in stats.items())
+
+
+# shared disabled timer: default of the instrumented loops
+NO_TIMER = StepTimer(window=1, enabled=False)
+
+
+def parse_steps(steps: Optional[str]):
+    """ parse 'a:b' into (a, b): steps a (inclusive) to b (exclusive) """
+    if not steps:
+        return None
+    start, stop = (int(s) for s in steps.split(':'))
+    assert 0 <= start < stop, f"invalid step window '{steps}': needs 0 <= a < b"
+    return start, stop
+
+
+class ProfileWindow:
+    """ Capture a JAX profiler trace (TensorBoard / Perfetto) of training
+        steps a to b (exclusive), counted across epochs.
+    """
+    def __init__(self, steps: Optional[str], log_dir: str = '/tmp/jax-trace'):
+        """
+        :param steps:   'a:b' or None / '' (no trace)
+        :param log_dir: directory the trace is written to
+        """
+        self.window = parse_steps(steps)
+        self.log_dir = log_dir
+        self.step = 0
+        self.active = False
+
+    def start_step(self):
+        """ context of one training step: starts the trace at step a and
+            annotates the steps inside the window
+        """
+        if self.window is not None and self.step == self.window[0]:
+            print(f"[*] Capturing profiler trace of steps {self.window[0]}:{self.window[1]} in {self.log_dir}")
+            jax.profiler.start_trace(self.log_dir, create_perfetto_trace=True)
+            self.active = True
+        if self.active:
+            return jax.profiler.StepTraceAnnotation('train', step_num=self.step)
+        return nullcontext()
+
+    def end_step(self, outputs=None) -> None:
+        """ stops the trace after step b - 1, once its outputs are computed """
+        self.step += 1
+        if self.active and self.step >= self.window[1]:
+            jax.block_until_ready(outputs)
+            self.stop()
+
+    def stop(self) -> None:
+        if self.active:
+            jax.profiler.stop_trace()
+            self.active = False
+            print(f"[*] Profiler trace written to {self.log_dir}")
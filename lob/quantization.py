@@ -0,0 +1,65 @@
+""" Weight-only int8 quantization of trained models for (CPU) inference.
+
+    The Dense layers (input encoders, GLU projections, message / book fusion
+    projections and the decoder) of a model with quantize=True store int8
+    kernels with per output channel scales (s5.layers.QuantizedDense), which
+    quarters the device memory of their weights. The kernels are converted to
+    the compute dtype for the matmul; whether XLA fuses this conversion into
+    the dot (so that only int8 weights are read) depends on the backend.
+    SSM parameters and norms stay in float32.
+"""
+from typing import Dict
+import numpy as onp
+import jax
+import jax.numpy as jnp
+
+from s5.layers import quantize_params
+from lob.encoding import Vocab
+from lob.inference import calc_sequence_losses
+import lob.validation_helpers as valh
+
+
+def quantize_state(state):
+    """ state (TrainState or InferenceState) with params for a quantize=True model,
+        on device (quantize_params converts on the host)
+    """
+    return jax.device_put(state.replace(params=quantize_params(state.params)))
+
+
+def perplexity_check(
+        m_seq: jax.Array,
+        b_seq: jax.Array,
+        state,
+        model_cls,
+        batchnorm: bool,
+        n_inp_msgs: int,
+    ) -> Dict[str, float]:
+    """ Compare the quantized with the float model on the per-message
+        perplexity of a sequence (see inference.calc_sequence_losses)
+        m_seq: encoded messages (n_inp_msgs + n_eval_msgs messages)
+        b_seq: transformed book states, one per message
+        model_cls: model class (e.g. of init_model_cls), which is instantiated
+                   with and without quantization
+    """
+    valid_mask_array = valh.syntax_validation_matrix()
+    ppl = {}
+    for name, quantize in (('float', False), ('int8', True)):
+        model = model_cls(training=False, step_rescale=1.0, quantize=quantize)
+        losses = calc_sequence_losses(
+            m_seq,
+            b_seq,
+            quantize_state(state) if quantize else state,
+            model,
+            batchnorm,
+            n_inp_msgs,
+            len(Vocab()),
+            valid_mask_array,
+        )
+        # perplexity of each predicted message
+        ppl[name] = onp.asarray(jnp.exp(jnp.mean(losses, axis=-1)))
+    return {
+        'perplexity_float': float(ppl['float'].mean()),
+        'perplexity_int8': float(ppl['int8'].mean()),
+        'perplexity_rel_diff': float(ppl['int8'].mean() / ppl['float'].mean() - 1),
+        'perplexity_max_abs_diff': float(onp.abs(ppl['int8'] - ppl['float']).max()),
+    }
@@ -50,7 +50,11 @@ from lobster_dataloader import LOBSTER_Dataset, LOBSTER_Subset, LOBSTER_Sampler,
 import preproc
 import inference
 import validation_helpers as valh
-from lob.init_train import init_train_state, load_checkpoint, load_args_from_checkpoint
+from lob.init_train import init_model_cls, export_inference_params, load_inference_checkpoint
+from lob.backend import configure_compilation_cache
+from lob.profiling import StepTimer
+from lob.warmup import warmup_predict
+from lob.quantization import perplexity_check, quantize_state
 import lob.encoding as encoding
 
 ##################################################
@@ -58,7 +62,22 @@ import lob.encoding as encoding
 # get args from command line to select stock between GOOG, INTC
 parser = argparse.ArgumentParser()
 parser.add_argument('--stock', type=str, default='GOOG', help='stock to evaluate')
+parser.add_argument('--compilation_cache_dir', type=str, default='../cache_dir/jax',
+                    help='persistent XLA compilation cache, shared with other runs (\'\' to disable)')
+parser.add_argument('--params_dir', type=str, default='',
+                    help='params-only export of the checkpoint (written if missing), ' \
+                         'memory-mapped for fast loading (\'\' to read the checkpoint directly)')
+parser.add_argument('--quantize', action='store_true',
+                    help='int8 weight-only quantized dense layers (checked against the float model)')
+parser.add_argument('--time_steps', action='store_true',
+                    help='log percentiles of the input preparation, model prediction and ' \
+                         'simulator time per generated message (synchronises the device)')
 args = parser.parse_args()
+params_dir = args.params_dir
+quantize = args.quantize
+time_steps = args.time_steps
+compilation_cache_dir = args.compilation_cache_dir
+configure_compilation_cache(compilation_cache_dir)
 
 if args.stock == 'GOOG':
     ckpt_path = '../checkpoints/treasured-leaf-149_84yhvzjt/' # 0.5 y GOOG, (full model)
@@ -83,36 +102,20 @@ book_seq_len = n_messages
 rng = jax.random.PRNGKey(42)
 rng, rng_ = jax.random.split(rng)
 
-args = load_args_from_checkpoint(ckpt_path)
+# load params (and batch stats) from disk: no optimizer, no model initialisation
+if params_dir:
+    if not os.path.isdir(params_dir):
+        export_inference_params(ckpt_path, params_dir)
+    args, state = load_inference_checkpoint(params_dir, mmap=True)
+else:
+    args, state = load_inference_checkpoint(ckpt_path)
 
-# scale down to single GPU, single sample inference
-args.bsz = 1
+# single sample inference
 args.num_devices = 1
 
 batchnorm = args.batchnorm
 
-# load train state from disk
-
-new_train_state, model_cls = init_train_state(
-    args,
-    n_classes=n_classes,
-    seq_len=seq_len,
-    book_dim=book_dim,
-    book_seq_len=book_seq_len,
-)
-
-ckpt = load_checkpoint(
-    new_train_state,
-    ckpt_path,
-    args.__dict__)
-par_state = ckpt['model']
-
-# deduplicate params (get saved per gpu in training)
-state = par_state.replace(
-    params=jax.tree_map(lambda x: x[0], par_state.params),
-    batch_stats=jax.tree_map(lambda x: x[0], par_state.batch_stats),
-)
-
+model_cls = init_model_cls(args, n_classes=n_classes, book_dim=book_dim)
 model = model_cls(training=False, step_rescale=1.0)
 
 ##################################################
@@ -162,6 +165,40 @@ logger.setLevel(logging.WARNING)
 
 ##################################################
 
+m_seq, _, b_seq_pv, _, _ = ds[0]
+
+if quantize:
+    # perplexity of the quantized vs the float model on the eval messages of a sample
+    print('Quantization check:', perplexity_check(
+        m_seq,
+        jnp.array(transform_L2_state(b_seq_pv, n_vol_series, 100)),
+        state,
+        model_cls,
+        batchnorm,
+        n_messages,
+    ))
+    state = quantize_state(state)
+    model = model_cls(training=False, step_rescale=1.0, quantize=True)
+
+##################################################
+
+# compile model prediction ahead of time for the input shapes of the rollouts
+# (reused through the persistent compilation cache only)
+if compilation_cache_dir:
+    compile_times = warmup_predict(
+        state,
+        model,
+        batchnorm,
+        m_seq[: seq_len],
+        jnp.array(transform_L2_state(b_seq_pv, n_vol_series, 100))[: n_messages],
+    )
+    print('Compile times (s):', compile_times)
+
+##################################################
+
+# per message timing of the generation (prep, compute, sim)
+gen_timer = StepTimer(enabled=time_steps)
+
 results = inference.sample_messages(
     n_samples = 1000, # 500
     num_repeats = 1,
@@ -178,5 +215,8 @@ results = inference.sample_messages(
     sim_book_levels = sim_book_levels,
     sim_queue_len = sim_queue_len,
     data_levels = data_levels,
-    save_folder = save_dir
+    save_folder = save_dir,
+    timer = gen_timer,
 )
+if gen_timer.enabled:
+    print('Generation step time percentiles (ms):', gen_timer.percentiles())
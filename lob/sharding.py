@@ -0,0 +1,144 @@
+""" Device mesh and parameter sharding for jit-compiled training (alternative to
+    the replicated pmap path in lob.train_helpers).
+
+    The batch is split over the 'data' axis of the mesh. Wide layers (decoder,
+    input encoder, book pre-layers) can be split over the 'model' axis, all
+    other parameters are replicated. Optionally (ZeRO-style), optimizer state
+    and parameters are additionally split over the 'data' axis, so that XLA
+    reduce-scatters gradients and all-gathers parameters where needed.
+    Can be tested on CPU with e.g.
+    XLA_FLAGS=--xla_force_host_platform_device_count=8 JAX_PLATFORMS=cpu
+"""
+import re
+from typing import Optional, Tuple
+import numpy as onp
+import jax
+from jax.experimental import mesh_utils, multihost_utils
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+
+
+# parameters split over the 'model' axis: (path regex, dimension to split)
+MODEL_PARALLEL_RULES = (
+    # decoder over the output vocabulary
+    (r'(^|/)decoder/kernel$', 1),
+    (r'(^|/)decoder/bias$', 0),
+    # input encoders over the (one-hot) input vocabulary
+    (r'(^|/)(message_)?encoder/encoder/kernel$', 0),
+)
+# book pre-layers: only split dimensions of the (raw) book width
+BOOK_PRE_LAYER_RULES = (
+    (r'book_encoder/layers_\d+/out[12]/kernel$', 1),
+    (r'book_encoder/layers_\d+/out[12]/bias$', 0),
+    # projection from book width to d_model
+    (r'book_encoder/layers_\d+/kernel$', 0),
+)
+
+
+def make_mesh(num_devices: int, model_parallel: int = 1) -> Mesh:
+    """ 2D device mesh with axes ('data', 'model') """
+    assert num_devices % model_parallel == 0, \
+        f"num_devices ({num_devices}) must be divisible by model_parallel ({model_parallel})"
+    devices = mesh_utils.create_device_mesh(
+        (num_devices // model_parallel, model_parallel),
+        devices=jax.devices()[:num_devices])
+    return Mesh(devices, ('data', 'model'))
+
+
+def _path_str(path) -> str:
+    keys = []
+    for k in path:
+        if isinstance(k, jax.tree_util.DictKey):
+            keys.append(str(k.key))
+        elif isinstance(k, jax.tree_util.GetAttrKey):
+            keys.append(k.name)
+        elif isinstance(k, jax.tree_util.SequenceKey):
+            keys.append(str(k.idx))
+        else:
+            keys.append(str(k))
+    return '/'.join(keys)
+
+
+def _book_width(params) -> Optional[int]:
+    """ input width of the book projection layer (i.e. the book pre-layer width) """
+    for path, x in jax.tree_util.tree_flatten_with_path(params)[0]:
+        if re.search(BOOK_PRE_LAYER_RULES[-1][0], _path_str(path)):
+            return x.shape[0]
+    return None
+
+
+def partition_spec(
+        path: str,
+        shape: Tuple[int, ...],
+        model_parallel: int,
+        book_width: Optional[int] = None,
+        data_parallel: int = 1,
+        shard_data: bool = False,
+    ) -> P:
+    """ PartitionSpec of a parameter (or optimizer state of a parameter, which
+        has the parameter path as suffix) given its path and shape.
+        shard_data: additionally split the largest remaining dimension
+                    (divisible by data_parallel) over the 'data' axis
+    """
+    spec = [None] * len(shape)
+    if model_parallel > 1:
+        for pattern, dim in MODEL_PARALLEL_RULES:
+            if re.search(pattern, path) and shape[dim] % model_parallel == 0:
+                spec[dim] = 'model'
+                break
+        else:
+            for pattern, dim in BOOK_PRE_LAYER_RULES:
+                if re.search(pattern, path) and shape[dim] == book_width \
+                        and book_width % model_parallel == 0:
+                    spec[dim] = 'model'
+                    break
+    if shard_data and data_parallel > 1:
+        dims = [d for d in range(len(shape)) if spec[d] is None and shape[d] % data_parallel == 0]
+        if len(dims) > 0:
+            spec[max(dims, key=lambda d: shape[d])] = 'data'
+    return P(*spec)
+
+
+def state_sharding(state, mesh: Mesh, shard_opt_state: bool = False, shard_params: bool = False):
+    """ NamedSharding for every leaf of the train state (params, batch stats
+        and optimizer state), see partition_spec.
+        shard_opt_state: split optimizer state (Adam moments) over the 'data' axis
+        shard_params:    split parameters over the 'data' axis
+    """
+    model_parallel = mesh.shape['model']
+    data_parallel = mesh.shape['data']
+    book_width = _book_width(state.params)
+
+    def tree_sharding(tree, shard_data=False):
+        def leaf_sharding(path, x):
+            return NamedSharding(mesh, partition_spec(
+                _path_str(path), onp.shape(x), model_parallel, book_width,
+                data_parallel, shard_data))
+        return jax.tree_util.tree_map_with_path(leaf_sharding, tree)
+
+    return tree_sharding(state).replace(
+        params=tree_sharding(state.params, shard_params),
+        opt_state=tree_sharding(state.opt_state, shard_opt_state),
+    )
+
+
+def inference_sharding(state, mesh: Mesh):
+    """ NamedSharding for every leaf of an inference state (params and batch
+        stats, without optimizer state), see partition_spec
+    """
+    model_parallel = mesh.shape['model']
+    book_width = _book_width(state.params)
+
+    def leaf_sharding(path, x):
+        return NamedSharding(mesh, partition_spec(
+            _path_str(path), onp.shape(x), model_parallel, book_width))
+    return jax.tree_util.tree_map_with_path(leaf_sharding, state)
+
+
+def shard_state(state, mesh: Mesh, shard_opt_state: bool = False, shard_params: bool = False):
+    """ Place (unreplicated) train state on the mesh """
+    return jax.device_put(state, state_sharding(state, mesh, shard_opt_state, shard_params))
+
+
+def shard_batch(batch, mesh: Mesh):
+    """ Turn process-local batch arrays into global arrays split over the 'data' axis """
+    return multihost_utils.host_local_array_to_global_array(batch, mesh, P('data'))
@@ -33,7 +33,11 @@ sweep_config = {
         'restore': {'value': ''},
         'restore_step': {'value': 0},
         'msg_seq_len': {'values': [100, 500, 1000, 2000]},
+        'msg_seq_len_curriculum': {'value': ''},
         'n_data_workers': {'value': 0},
+        'n_files_shuffle': {'value': 0},
+        'track_io': {'value': False},
+        'compact_batches': {'value': False},
 
         'n_message_layers': {'values': [2]},
         'n_book_pre_layers': {'values': [0, 1]},
@@ -50,13 +54,23 @@ sweep_config = {
         'conj_sym': {'values': [True, False]},
         'clip_eigs': {'values': [True, False]},
         'bidirectional': {'values': [True]},
+        'ssm_kernel': {'value': 'scan'},
+        'ssm_chunk_size': {'value': 256},
         'dt_min': {'value': 0.001},
         'dt_max': {'value': 0.1},
+        'precision': {'value': 'fp32'},
+        'remat': {'value': 'none'},
         
         'prenorm': {'values': [True]},
         'batchnorm': {'values': [True, False]},
         'bn_momentum': {'min': 0.1, 'max': 0.99},
         'bsz': {'values': [8]},
+        'sharding': {'value': 'pmap'},
+        'model_parallel': {'value': 1},
+        'shard_opt_state': {'value': False},
+        'shard_params': {'value': False},
+        'grad_accum_steps': {'value': 1},
+        'steps_per_dispatch': {'value': 1},
         'epochs': {'value': 30},
         'early_stop_patience': {'value': 1000},  # handle early stopping in sweep
         'ssm_lr_base': {'min': 1e-6, 'max': 2e-3, 'distribution': 'log_uniform_values'},
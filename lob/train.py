@@ -1,4 +1,7 @@
 from functools import partial
+import time
+import numpy as onp
+import jax
 from jax import random
 import jax.numpy as np
 from jax.scipy.linalg import block_diag
@@ -7,15 +10,46 @@ import orbax.checkpoint
 from lob.lob_seq_model import BatchFullLobPredModel, BatchLobPredModel, BatchPaddedLobPredModel
 import wandb
 
-from lob.init_train import init_train_state, load_checkpoint
-from lob.dataloading import Datasets, create_lobster_prediction_dataset, create_lobster_train_loader
-from lob.lobster_dataloader import LOBSTER, LOBSTER_Dataset
+from lob.checkpointing import AsyncCheckpointer, host_state, latest_resume_checkpoint, \
+    load_resume_checkpoint, restore_state
+from lob.encoding import Message_Tokenizer
+from lob.init_train import init_train_state, load_checkpoint, transfer_train_state
+from lob.dataloading import Datasets, create_lobster_prediction_dataset, create_lobster_train_loader, \
+    shutdown_loader
+from lob.lobster_dataloader import LOBSTER, LOBSTER_Dataset, LOBSTER_Sampler
+from lob.profiling import ProfileWindow, StepTimer
+from lob.warmup import warmup_train
+from lob.sharding import make_mesh, shard_state
 from lob.train_helpers import create_train_state, reduce_lr_on_plateau,\
-    linear_warmup, cosine_annealing, constant_lr, train_epoch, validate
+    plateau_lr_scales, update_lr_scale, train_epoch, validate
 from s5.ssm import init_S5SSM
 from s5.ssm_init import make_DPLR_HiPPO
 
 
+def parse_seq_len_curriculum(curriculum, msg_seq_len):
+    """ Parse curriculum 'len:epochs,len:epochs,...' of msg_seq_len stages
+        into [(msg_seq_len, last_epoch), ...]. The final stage with the
+        given msg_seq_len continues until the end of training.
+    """
+    stages = []
+    last_epoch = 0
+    if curriculum:
+        for stage in curriculum.split(','):
+            stage_len, stage_epochs = (int(v) for v in stage.split(':'))
+            assert stage_len <= msg_seq_len, \
+                f"curriculum stage msg_seq_len {stage_len} longer than msg_seq_len {msg_seq_len}"
+            last_epoch += stage_epochs
+            stages.append((stage_len, last_epoch))
+    stages.append((msg_seq_len, None))
+    return stages
+
+
+def stage_msg_seq_len(stages, epoch):
+    for stage_len, last_epoch in stages:
+        if last_epoch is None or epoch < last_epoch:
+            return stage_len
+
+
 def train(args):
     """
     Main function to train over a certain number of epochs
@@ -24,11 +58,15 @@ def train(args):
     best_test_loss = 100000000
     best_test_acc = -10000.0
 
+    # multi-process training (jax.distributed): every process loads its own
+    # data shard and feeds its local devices
+    process_index, process_count = jax.process_index(), jax.process_count()
+
     # for parameter sweep: get args from wandb server
     if args is None:
         args = wandb.config
     else:
-        if args.USE_WANDB:
+        if args.USE_WANDB and process_index == 0:
             # Make wandb config dictionary
             run = wandb.init(project=args.wandb_project, job_type='model_training', config=vars(args), entity=args.wandb_entity)
         else:
@@ -55,20 +93,77 @@ def train(args):
 
     # Create dataset...
     init_rng, key = random.split(init_rng, num=2)
-    mask_fn = LOBSTER_Dataset.causal_mask if args.masking == 'causal' else LOBSTER_Dataset.random_mask
-    (lobster_dataset, trainloader, valloader, testloader, aux_dataloaders, 
-        n_classes, seq_len, in_dim, book_seq_len, book_dim, train_size) = \
+    if args.mode == 'multi':
+        # all non-time tokens of the last message are targets
+        mask_fn = LOBSTER_Dataset.last_msg_mask
+    elif args.masking == 'causal':
+        mask_fn = LOBSTER_Dataset.causal_mask
+    else:
+        mask_fn = LOBSTER_Dataset.random_mask
+    # sequence length curriculum: stages of shorter msg_seq_len before args.msg_seq_len
+    seq_len_stages = parse_seq_len_curriculum(args.msg_seq_len_curriculum, args.msg_seq_len)
+
+    # continue from the latest resume checkpoint (at its epoch and batch), if there is one
+    resume_path = latest_resume_checkpoint(args.restore) if args.restore else None
+    resume = load_resume_checkpoint(resume_path) if resume_path is not None else None
+    start_epoch = int(resume['epoch']) if resume is not None else 0
+    msg_seq_len = stage_msg_seq_len(seq_len_stages, start_epoch)
+    # resume checkpoints every N steps / minutes need a sampler with a cursor
+    resumable = args.checkpoint_every_steps > 0 or args.checkpoint_every_minutes > 0
+
+    make_dataset = lambda msg_seq_len: \
         create_lobster_prediction_dataset(
             args.dir_name,
             seed=args.jax_seed,
             mask_fn=mask_fn,
-            msg_seq_len=args.msg_seq_len,
+            msg_seq_len=msg_seq_len,
             bsz=args.bsz,
             use_book_data=args.use_book_data,
             use_simple_book=args.use_simple_book,
             book_transform=args.book_transform,
             n_data_workers=args.n_data_workers,
+            n_files_shuffle=args.n_files_shuffle,
+            book_depth=args.book_depth,
+            compact_batches=args.compact_batches,
+            process_index=process_index,
+            process_count=process_count,
+            grad_accum_steps=args.grad_accum_steps,
+            steps_per_dispatch=args.steps_per_dispatch,
+            resumable=resumable,
+            track_io=args.track_io,
         )
+    (lobster_dataset, trainloader, valloader, testloader, aux_dataloaders, 
+        n_classes, seq_len, in_dim, book_seq_len, book_dim, train_size) = make_dataset(msg_seq_len)
+    assert args.num_devices % process_count == 0
+    num_local_devices = args.num_devices // process_count
+    if args.sharding == 'mesh':
+        # jit with state and batches sharded over a (data, model) device mesh
+        mesh = make_mesh(args.num_devices, args.model_parallel)
+        print('Device mesh:', dict(mesh.shape))
+    else:
+        assert args.model_parallel == 1, "model_parallel > 1 requires sharding='mesh'"
+        assert not (args.shard_opt_state or args.shard_params), \
+            "sharded optimizer state / params require sharding='mesh'"
+        mesh = None
+    # compact batches contain raw L2 rows, transformed on device
+    device_book_depth = args.book_depth if (args.compact_batches and args.book_transform) else None
+
+    # rolling per step timing (data, transfer, prep, compute, logging) and
+    # profiler trace of a window of training steps
+    train_timer = StepTimer(enabled=args.time_steps)
+    eval_timer = StepTimer(enabled=args.time_steps)
+    profile = ProfileWindow(args.profile_steps, args.profile_dir)
+
+    # optimizer updates of every epoch (for learning rate schedules): the number
+    # of training sequences changes with the msg_seq_len of curriculum stages
+    def epoch_steps(epoch):
+        stage_len = stage_msg_seq_len(seq_len_stages, epoch)
+        if stage_len == msg_seq_len:
+            size = train_size
+        else:
+            size = lobster_dataset.dataset_train.num_sequences(stage_len)
+        return int(size / (args.bsz * args.grad_accum_steps))
+    steps_per_epoch = [epoch_steps(epoch) for epoch in range(args.epochs)]
 
     print(f"[*] Starting S5 Training on {ds} =>> Initializing...")
 
@@ -78,10 +173,22 @@ def train(args):
         seq_len=seq_len,
         book_dim=book_dim,
         book_seq_len=book_seq_len,
-        print_shapes=True
+        print_shapes=True,
+        steps_per_epoch=steps_per_epoch,
+        mesh=mesh,
+        # SSM kernels for the shapes of all curriculum stages are tuned up front
+        stage_seq_lens=[
+            (stage_len * Message_Tokenizer.MSG_LEN, stage_len if args.use_book_data else 0)
+            for stage_len, _ in seq_len_stages],
     )
 
-    if args.restore is not None and args.restore != '':
+    if resume is not None:
+        print(f"[*] Resuming training from {resume_path}")
+        state = restore_state(
+            state, resume, mesh,
+            partial(shard_state, shard_opt_state=args.shard_opt_state, shard_params=args.shard_params))
+        train_rng = np.asarray(resume['train_rng'])
+    elif args.restore is not None and args.restore != '':
         print(f"[*] Restoring weights from {args.restore}")
         ckpt = load_checkpoint(
             state,
@@ -90,80 +197,233 @@ def train(args):
             step=args.restore_step,
         )
         state = ckpt['model']
+        if mesh is not None:
+            state = shard_state(state, mesh, args.shard_opt_state, args.shard_params)
 
     # Training Loop over epochs
     best_loss, best_acc, best_epoch = 100000000, -100000000.0, 0  # This best loss is val_loss
     count, best_val_loss = 0, 100000000  # This line is for early stopping purposes
     lr_count, opt_acc = 0, -100000000.0  # This line is for learning rate decay
-    step = 0  # for per step learning rate decay
-    steps_per_epoch = int(train_size/args.bsz)
+    if resume is not None:
+        loop = resume['loop']
+        best_loss, best_acc, best_epoch = loop['best_loss'], loop['best_acc'], int(loop['best_epoch'])
+        count, best_val_loss = int(loop['count']), loop['best_val_loss']
+        lr_count, opt_acc = int(loop['lr_count']), loop['opt_acc']
+        lr, ssm_lr = loop['lr'], loop['ssm_lr']
+        best_test_loss, best_test_acc = loop['best_test_loss'], loop['best_test_acc']
+
+    # resume checkpoints (and per-epoch checkpoints) are written in the background
+    ckpt_dir = f'checkpoints/{run.name}_{run.id}'
+    checkpointer = AsyncCheckpointer(
+        ckpt_dir,
+        every_steps=args.checkpoint_every_steps,
+        every_minutes=args.checkpoint_every_minutes,
+        keep=args.checkpoint_keep,
+        write=process_index == 0,
+    )
+
+    def resume_target(state, epoch, batch, skey, epoch_rng, sampler_state):
+        """ everything needed to continue training after batch (number of batches) of epoch """
+        return {
+            'state': host_state(state, mesh),
+            'epoch': epoch,
+            'batch': batch,
+            'train_rng': onp.asarray(train_rng),
+            'skey': onp.asarray(skey),
+            'epoch_rng': onp.asarray(epoch_rng),
+            'seq_offsets': onp.array(lobster_dataset.dataset_train.seq_offsets),
+            'sampler': {
+                'seed': str(sampler_state['seed']),
+                'epoch': sampler_state['epoch'],
+                'batches_done': batch,
+            },
+            'loop': {
+                'best_loss': float(best_loss), 'best_acc': float(best_acc), 'best_epoch': best_epoch,
+                'count': count, 'best_val_loss': float(best_val_loss),
+                'lr_count': lr_count, 'opt_acc': float(opt_acc),
+                'lr': float(lr), 'ssm_lr': float(ssm_lr),
+                'best_test_loss': float(best_test_loss), 'best_test_acc': float(best_test_acc),
+            },
+        }
 
     val_model = model_cls(training=False, step_rescale=1)
 
-    for epoch in range(args.epochs):
+    def warmup():
+        """ ahead of time compilation of the train and eval steps """
+        print("[*] Compiling train and eval steps...")
+        compile_times = warmup_train(
+            state,
+            val_model.apply,
+            trainloader,
+            valloader,
+            seq_len,
+            in_dim,
+            args.batchnorm,
+            num_local_devices,
+            book_depth=device_book_depth,
+            grad_accum_steps=args.grad_accum_steps,
+            steps_per_dispatch=args.steps_per_dispatch,
+            mesh=mesh,
+            shard_opt_state=args.shard_opt_state,
+            shard_params=args.shard_params,
+        )
+        for name, t in compile_times.items():
+            print(f"\t{name}: {t:.1f}s")
+        wandb.log({f"Compile time/{name}": t for name, t in compile_times.items()}, commit=False)
+
+    # the steps only reuse the compiled executables through the persistent
+    # compilation cache, otherwise warming up would compile everything twice
+    aot_warmup = args.aot_warmup and bool(args.compilation_cache_dir)
+    if args.aot_warmup and not aot_warmup:
+        print("[*] Skipping ahead of time compilation: no persistent compilation cache (compilation_cache_dir)")
+    if aot_warmup:
+        warmup()
+
+    for epoch in range(start_epoch, args.epochs):
         print(f"[*] Starting Training Epoch {epoch + 1}...")
 
+        if stage_msg_seq_len(seq_len_stages, epoch) != msg_seq_len:
+            # next curriculum stage: new data and state at the longer sequence length
+            # (compiled steps of each stage shape stay cached by jax)
+            msg_seq_len = stage_msg_seq_len(seq_len_stages, epoch)
+            print(f"[*] Curriculum: continuing with msg_seq_len={msg_seq_len}")
+            # stop the (persistent) loader workers of the previous stage
+            for loader in (trainloader, valloader, testloader):
+                shutdown_loader(loader)
+            del lobster_dataset, trainloader, valloader, testloader
+            (lobster_dataset, trainloader, valloader, testloader, aux_dataloaders,
+                n_classes, seq_len, in_dim, book_seq_len, book_dim, train_size) = make_dataset(msg_seq_len)
+            # learning rate schedules over the steps of all stages
+            new_state, _ = init_train_state(
+                args,
+                n_classes=n_classes,
+                seq_len=seq_len,
+                book_dim=book_dim,
+                book_seq_len=book_seq_len,
+                steps_per_epoch=steps_per_epoch,
+                mesh=mesh,
+            )
+            if mesh is None:
+                state = transfer_train_state(state, new_state)
+            else:
+                # gathered on the host, as the leaves are not fully addressable on multiple processes
+                state = transfer_train_state(host_state(state, mesh), host_state(new_state, mesh))
+                state = shard_state(state, mesh, args.shard_opt_state, args.shard_params)
+            if aot_warmup:
+                warmup()
+
         if epoch < args.warmup_end:
             print("using linear warmup for epoch {}".format(epoch+1))
-            decay_function = linear_warmup
-            end_step = steps_per_epoch * args.warmup_end
-
         elif args.cosine_anneal:
             print("using cosine annealing for epoch {}".format(epoch+1))
-            decay_function = cosine_annealing
-            # for per step learning rate decay
-            end_step = steps_per_epoch * args.epochs - (steps_per_epoch * args.warmup_end)
         else:
             print("using constant lr for epoch {}".format(epoch+1))
-            decay_function = constant_lr
-            end_step = None
-
-        # TODO: Switch to letting Optax handle this.
-        #  Passing this around to manually handle per step learning rate decay.
-        lr_params = (decay_function, ssm_lr, lr, step, end_step, args.opt_config, args.lr_min)
-
-        print('Training on', args.num_devices, 'devices.')
-        train_rng, skey = random.split(train_rng)
-        state, train_loss, step = train_epoch(state,
-                                              skey,
-                                              #model_cls,
-                                              #train_model,
-                                              trainloader,
-                                              seq_len,
-                                              in_dim,
-                                              args.batchnorm,
-                                              lr_params,
-                                              args.num_devices)
-        # reinit training loader, so that sequences are initialised with
-        del trainloader
-        # different offsets
-        trainloader = create_lobster_train_loader(
-            lobster_dataset,
-            int(random.randint(skey, (1,), 0, 100000)),
-            args.bsz,
-            num_workers=args.n_data_workers,
-            reset_train_offsets=True)
+        # per step learning rates are scheduled by optax in the compiled train step,
+        # reductions on plateau scale the schedules
+        state = update_lr_scale(state, plateau_lr_scales(
+            lr, ssm_lr, args.lr_factor * args.ssm_lr_base, args.ssm_lr_base))
+
+        print('Training on', args.num_devices, jax.default_backend(), 'devices', f'({num_local_devices} local).')
+        if resume is not None and resume['batch'] > 0:
+            # continue the epoch with the rng after the checkpointed batch
+            skey, epoch_rng = np.asarray(resume['skey']), np.asarray(resume['epoch_rng'])
+        else:
+            train_rng, skey = random.split(train_rng)
+            epoch_rng = skey
+        if resume is not None:
+            # same sequences and sampling position as at the checkpoint
+            lobster_dataset.dataset_train.set_offsets(resume['seq_offsets'])
+            if isinstance(trainloader.batch_sampler, LOBSTER_Sampler):
+                trainloader.batch_sampler.load_state_dict({
+                    'seed': int(resume['sampler']['seed']),
+                    'epoch': int(resume['sampler']['epoch']),
+                    'batches_done': int(resume['sampler']['batches_done']),
+                })
+            resume = None
+        if isinstance(trainloader.batch_sampler, LOBSTER_Sampler):
+            sampler_start = trainloader.batch_sampler.state_dict()
+        else:
+            sampler_start = None
+
+        def checkpoint_step(state, epoch_rng, n_batches):
+            if checkpointer.due():
+                batch = sampler_start['batches_done'] + n_batches
+                checkpointer.save_resume(epoch, batch, resume_target(
+                    state, epoch, batch, skey, epoch_rng, sampler_start))
+
+        # batches of this epoch still to run (fewer when resumed mid-epoch)
+        epoch_batches = len(trainloader) - (sampler_start['batches_done'] if sampler_start is not None else 0)
+        epoch_start = time.time()
+        state, train_loss = train_epoch(state,
+                                        epoch_rng,
+                                        #model_cls,
+                                        #train_model,
+                                        trainloader,
+                                        seq_len,
+                                        in_dim,
+                                        args.batchnorm,
+                                        num_local_devices,
+                                        book_depth=device_book_depth,
+                                        grad_accum_steps=args.grad_accum_steps,
+                                        steps_per_dispatch=args.steps_per_dispatch,
+                                        mesh=mesh,
+                                        timer=train_timer,
+                                        profile=profile,
+                                        step_callback=checkpoint_step if checkpointer.enabled else None,
+                                        shard_opt_state=args.shard_opt_state,
+                                        shard_params=args.shard_params)
+        # wait for the queued steps: the loss is fetched after the last step has finished
+        train_loss = float(train_loss)
+        train_time = time.time() - epoch_start
+        train_samples = epoch_batches * args.bsz * args.grad_accum_steps * args.steps_per_dispatch
+        print(f"\tTraining throughput ({jax.default_backend()}): "
+              f"{train_samples / train_time:.1f} samples/s ({train_time:.1f}s)")
+        wandb.log({
+            "Train samples per second": train_samples / train_time,
+            "Train epoch time": train_time,
+        }, commit=False)
+        if train_timer.enabled:
+            print(f"\tTrain step time (p50 ms): {train_timer.summary()}")
+            wandb.log({f"Train step time/{k}": v for k, v in train_timer.percentiles().items()},
+                      commit=False)
+        if isinstance(trainloader.batch_sampler, LOBSTER_Sampler) and trainloader.batch_sampler.track_io:
+            io_stats = trainloader.batch_sampler.get_io_stats()
+            print(f"\tPages read per batch: {io_stats['pages_per_batch']:.1f} "
+                  f"(not previously read in day block: {io_stats['new_pages_per_batch']:.1f})")
+            wandb.log({
+                "Pages per batch": io_stats['pages_per_batch'],
+                "New pages per batch": io_stats['new_pages_per_batch'],
+            }, commit=False)
+        # new random offsets for the next epoch (in place, so that the
+        # loader and its worker processes are kept)
+        lobster_dataset.dataset_train.reseed_offsets(int(random.randint(skey, (1,), 0, 100000)))
 
         if valloader is not None:
             print(f"[*] Running Epoch {epoch + 1} Validation...")
-            val_loss, val_acc = validate(state,
+            val_loss, val_acc, val_metrics = validate(state,
                                          #model_cls,
                                          val_model.apply,
                                          valloader,
                                          seq_len,
                                          in_dim,
                                          args.batchnorm,
-                                         args.num_devices)
+                                         num_local_devices,
+                                         book_depth=device_book_depth,
+                                         mesh=mesh,
+                                         timer=eval_timer)
 
             print(f"[*] Running Epoch {epoch + 1} Test...")
-            test_loss, test_acc = validate(state,
+            test_loss, test_acc, test_metrics = validate(state,
                                            #model_cls,
                                            val_model.apply,
                                            testloader,
                                            seq_len,
                                            in_dim,
                                            args.batchnorm,
-                                           args.num_devices)
+                                           num_local_devices,
+                                           book_depth=device_book_depth,
+                                           mesh=mesh,
+                                           timer=eval_timer)
 
             print(f"\n=>> Epoch {epoch + 1} Metrics ===")
             print(
@@ -171,11 +431,21 @@ def train(args):
                 f" Val Accuracy: {val_acc:.4f}"
                 f" Test Accuracy: {test_acc:.4f}"
             )
+            # losses and accuracies per message field and event type
+            print("\tVal Loss per field: " + ", ".join(
+                f"{k.split('/')[1]}={v:.3f}" for k, v in val_metrics.items()
+                if k.startswith('loss/') and not k.startswith('loss/event_')))
+            wandb.log({f"Val {k}": v for k, v in val_metrics.items() if '/' in k}, commit=False)
+            wandb.log({f"Test {k}": v for k, v in test_metrics.items() if '/' in k}, commit=False)
+            if eval_timer.enabled:
+                print(f"\tEval step time (p50 ms): {eval_timer.summary()}")
+                wandb.log({f"Eval step time/{k}": v for k, v in eval_timer.percentiles().items()},
+                          commit=False)
 
         else:
             # else use test set as validation set (e.g. IMDB)
             print(f"[*] Running Epoch {epoch + 1} Test...")
-            val_loss, val_acc = validate(state,
+            val_loss, val_acc, val_metrics = validate(state,
                                          model_cls,
                                          testloader,
                                          seq_len,
@@ -200,16 +470,25 @@ def train(args):
                 'acc_test': test_acc,
             }
         }
-        orbax_checkpointer = orbax.checkpoint.PyTreeCheckpointer()
-        checkpoints.save_checkpoint(
-            ckpt_dir=f'checkpoints/{run.name}_{run.id}',
+        # written from a host copy of the state
+        ckpt['model'] = jax.device_get(state) if mesh is None else host_state(state, mesh)
+        save_kwargs = dict(
+            ckpt_dir=ckpt_dir,
             target=ckpt,
             step=epoch,
             overwrite=True,
             keep=2,
             keep_every_n_steps=10,
-            orbax_checkpointer=orbax_checkpointer
+            orbax_checkpointer=orbax.checkpoint.PyTreeCheckpointer(),
         )
+        if process_count > 1:
+            # orbax synchronises all processes while saving: every process takes
+            # part (process 0 writes), on the training thread
+            checkpointer.wait()
+            checkpoints.save_checkpoint_multiprocess(**save_kwargs)
+        else:
+            # in the background
+            checkpointer.submit(checkpoints.save_checkpoint, **save_kwargs)
 
         # For early stopping purposes
         if val_loss < best_val_loss:
@@ -251,7 +530,9 @@ def train(args):
                     "Learning rate count": lr_count,
                     "Opt acc": opt_acc,
                     "lr": state.opt_state.inner_states['regular'].inner_state.hyperparams['learning_rate'],
-                    "ssm_lr": state.opt_state.inner_states['ssm'].inner_state.hyperparams['learning_rate']
+                    "ssm_lr": state.opt_state.inner_states['ssm'].inner_state.hyperparams['learning_rate'],
+                    "lr_scale": lr / (args.lr_factor * args.ssm_lr_base),
+                    "ssm_lr_scale": ssm_lr / args.ssm_lr_base,
                 }
             )
         else:
@@ -264,7 +545,9 @@ def train(args):
                     "Learning rate count": lr_count,
                     "Opt acc": opt_acc,
                     "lr": state.opt_state.inner_states['regular'].inner_state.hyperparams['learning_rate'],
-                    "ssm_lr": state.opt_state.inner_states['ssm'].inner_state.hyperparams['learning_rate']
+                    "ssm_lr": state.opt_state.inner_states['ssm'].inner_state.hyperparams['learning_rate'],
+                    "lr_scale": lr / (args.lr_factor * args.ssm_lr_base),
+                    "ssm_lr_scale": ssm_lr / args.ssm_lr_base,
                 }
             )
         wandb.run.summary["Best Val Loss"] = best_loss
@@ -273,5 +556,14 @@ def train(args):
         wandb.run.summary["Best Test Loss"] = best_test_loss
         wandb.run.summary["Best Test Accuracy"] = best_test_acc
 
+        if checkpointer.enabled and sampler_start is not None:
+            # resume at the start of the next epoch (new offsets, next sampler epoch)
+            checkpointer.save_resume(epoch + 1, 0, resume_target(
+                state, epoch + 1, 0, skey, skey, trainloader.batch_sampler.state_dict()))
+
         if count > args.early_stop_patience:
             break
+
+    # trace window beyond the last training step
+    profile.stop()
+    checkpointer.wait()
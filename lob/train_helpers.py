@@ -1,15 +1,23 @@
+from contextlib import nullcontext
 from functools import partial
 import numpy as onp
 import jax
 import jax.numpy as np
+from jax.experimental import multihost_utils
 from jax.nn import one_hot
+from jax.sharding import Mesh
 from tqdm import tqdm
 from flax.training import train_state
 from flax import jax_utils
 import optax
 from typing import Any, Dict, Optional, Tuple, Union
 
+from lob.encoding import Message_Tokenizer
 from lob.lob_seq_model import LobPredModel
+from lob.metrics import init_metrics, summarise_metrics, update_metrics
+from lob.preproc import transform_L2_state
+from lob.profiling import NO_TIMER
+from lob.sharding import shard_batch, shard_state, state_sharding
 
 
 # LR schedulers
@@ -50,28 +58,71 @@ def constant_lr(step, base_lr, end_step,  lr_min=None):
     return base_lr
 
 
-def update_learning_rate_per_step(lr_params, state):
-    decay_function, ssm_lr, lr, step, end_step, opt_config, lr_min = lr_params
+def make_lr_schedule(base_lr, steps_per_epoch, warmup_end, epochs, cosine_anneal, lr_min=0.):
+    """ optax schedule (evaluated in the compiled train step) for the learning rate:
+        linear warmup for warmup_end epochs, followed by cosine annealing
+        until the last epoch or a constant learning rate.
+        steps_per_epoch: optimizer steps per epoch, or a list of the steps of every
+                         epoch (e.g. for epochs of a msg_seq_len curriculum)
+    """
+    if onp.ndim(steps_per_epoch) == 0:
+        steps_per_epoch = [int(steps_per_epoch)] * epochs
+    assert len(steps_per_epoch) == epochs, \
+        f"steps for {len(steps_per_epoch)} epochs, training for {epochs}"
+    warmup_end_step = int(sum(steps_per_epoch[:warmup_end]))
+    warmup_steps = max(warmup_end_step, 1)
+    if cosine_anneal:
+        end_step = int(sum(steps_per_epoch)) - warmup_end_step
+        decay_function = partial(cosine_annealing, base_lr=base_lr, end_step=end_step, lr_min=lr_min)
+    else:
+        decay_function = partial(constant_lr, base_lr=base_lr, end_step=None)
+
+    def schedule(step):
+        return np.where(
+            step < warmup_end_step,
+            linear_warmup(step, base_lr, warmup_steps),
+            decay_function(step))
+    return schedule
+
+
+# optimizers with an additional lr_scale hyperparameter kept in the optimizer
+# state, which is used to reduce the (scheduled) learning rate on plateaus.
+# The reduced learning rate is floored at lr_min, as in reduce_lr_on_plateau
+# (learning rates already below lr_min, e.g. during warmup, are not scaled).
+def scaled_lr(learning_rate, lr_scale, lr_min):
+    return np.maximum(learning_rate * lr_scale, np.minimum(learning_rate, lr_min))
 
-    # Get decayed value
-    lr_val = decay_function(step, lr, end_step, lr_min)
-    ssm_lr_val = decay_function(step, ssm_lr, end_step, lr_min)
-    step += 1
 
-    # Update state
-    state.opt_state.inner_states['regular'].inner_state.hyperparams['learning_rate'] = \
-        jax_utils.replicate(np.array(lr_val, dtype=np.float32))
-        
-    state.opt_state.inner_states['ssm'].inner_state.hyperparams['learning_rate'] = \
-        jax_utils.replicate(np.array(ssm_lr_val, dtype=np.float32))
+def scaled_adam(learning_rate, lr_scale=1.0, lr_min=0.):
+    return optax.adam(scaled_lr(learning_rate, lr_scale, lr_min))
 
-    if opt_config in ["BandCdecay"]:
-        # In this case we are applying the ssm learning rate to B, even though
-        # we are also using weight decay on B
-        state.opt_state.inner_states['none'].inner_state.hyperparams['learning_rate'] = \
-            jax_utils.replicate(np.array(ssm_lr_val, dtype=np.float32))
 
-    return state, step
+def scaled_adamw(learning_rate, lr_scale=1.0, weight_decay=1e-4, lr_min=0.):
+    return optax.adamw(scaled_lr(learning_rate, lr_scale, lr_min), weight_decay=weight_decay)
+
+
+def plateau_lr_scales(lr, ssm_lr, base_lr, base_ssm_lr):
+    """ factors of the scheduled learning rates per optimizer group, given the
+        (separately floored) lr and ssm_lr from reduce_lr_on_plateau
+    """
+    ssm_scale = ssm_lr / base_ssm_lr
+    # the "none" group uses the ssm learning rate when it is trained (BCdecay)
+    return {'regular': lr / base_lr, 'ssm': ssm_scale, 'none': ssm_scale}
+
+
+def update_lr_scale(state, lr_scales: Dict[str, float]):
+    """ Set factors for the learning rates of the scaled optimizer groups
+        (e.g. from plateau_lr_scales), once per epoch.
+    """
+    for group, inner in state.opt_state.inner_states.items():
+        hyperparams = inner.inner_state.hyperparams
+        if 'lr_scale' in hyperparams and group in lr_scales:
+            lr_scale = np.array(lr_scales[group], dtype=np.float32)
+            if hyperparams['lr_scale'].ndim > 0:
+                # replicated state (pmap)
+                lr_scale = jax_utils.replicate(lr_scale)
+            hyperparams['lr_scale'] = lr_scale
+    return state
 
 
 def map_nested_fn(fn):
@@ -104,8 +155,12 @@ def create_train_state(model_cls,
                        opt_config="standard",
                        ssm_lr=1e-3,
                        lr=1e-3,
+                       lr_min=0.,
                        dt_global=False,
                        num_devices=1,
+                       mesh=None,
+                       shard_opt_state=False,
+                       shard_params=False,
                        ):
     """
     Initializes the training state using optax
@@ -120,9 +175,15 @@ def create_train_state(model_cls,
     :param weight_decay:
     :param batchnorm:
     :param opt_config:
-    :param ssm_lr:
-    :param lr:
+    :param ssm_lr:          (float or optax schedule)
+    :param lr:              (float or optax schedule)
+    :param lr_min:          floor of the learning rates reduced by the lr_scale hyperparameter
     :param dt_global:
+    :param num_devices:
+    :param mesh:            (jax.sharding.Mesh) if given, the state is placed on the mesh
+                            (see lob.sharding) instead of being replicated for pmap
+    :param shard_opt_state: split optimizer state over data parallel devices (requires mesh)
+    :param shard_params:    split parameters over data parallel devices (requires mesh)
     :return:
     """
 
@@ -187,9 +248,10 @@ def create_train_state(model_cls,
         tx = optax.multi_transform(
             {
                 "none": optax.inject_hyperparams(optax.sgd)(learning_rate=0.0),
-                "ssm": optax.inject_hyperparams(optax.adam)(learning_rate=ssm_lr),
-                "regular": optax.inject_hyperparams(optax.adamw)(learning_rate=lr,
-                                                                 weight_decay=weight_decay),
+                "ssm": optax.inject_hyperparams(scaled_adam, static_args='lr_min')(
+                    learning_rate=ssm_lr, lr_min=lr_min),
+                "regular": optax.inject_hyperparams(scaled_adamw, static_args='lr_min')(
+                    learning_rate=lr, weight_decay=weight_decay, lr_min=lr_min),
             },
             ssm_fn,
         )
@@ -213,11 +275,13 @@ def create_train_state(model_cls,
             )
         tx = optax.multi_transform(
             {
-                "none": optax.inject_hyperparams(optax.adamw)(learning_rate=ssm_lr,
-                                                              weight_decay=weight_decay),
-                "ssm": optax.inject_hyperparams(optax.adam)(learning_rate=ssm_lr),
-                "regular": optax.inject_hyperparams(optax.adamw)(learning_rate=lr,
-                                                                 weight_decay=weight_decay),
+                # ssm learning rate is applied to B, even though B also has weight decay
+                "none": optax.inject_hyperparams(scaled_adamw, static_args='lr_min')(
+                    learning_rate=ssm_lr, weight_decay=weight_decay, lr_min=lr_min),
+                "ssm": optax.inject_hyperparams(scaled_adam, static_args='lr_min')(
+                    learning_rate=ssm_lr, lr_min=lr_min),
+                "regular": optax.inject_hyperparams(scaled_adamw, static_args='lr_min')(
+                    learning_rate=lr, weight_decay=weight_decay, lr_min=lr_min),
             },
             ssm_fn,
         )
@@ -242,9 +306,10 @@ def create_train_state(model_cls,
         tx = optax.multi_transform(
             {
                 "none": optax.inject_hyperparams(optax.adamw)(learning_rate=0.0),
-                "ssm": optax.inject_hyperparams(optax.adam)(learning_rate=ssm_lr),
-                "regular": optax.inject_hyperparams(optax.adamw)(learning_rate=lr,
-                                                                 weight_decay=weight_decay),
+                "ssm": optax.inject_hyperparams(scaled_adam, static_args='lr_min')(
+                    learning_rate=ssm_lr, lr_min=lr_min),
+                "regular": optax.inject_hyperparams(scaled_adamw, static_args='lr_min')(
+                    learning_rate=lr, weight_decay=weight_decay, lr_min=lr_min),
             },
             ssm_fn,
         )
@@ -271,9 +336,10 @@ def create_train_state(model_cls,
         tx = optax.multi_transform(
             {
                 "none": optax.inject_hyperparams(optax.sgd)(learning_rate=0.0),
-                "ssm": optax.inject_hyperparams(optax.adam)(learning_rate=ssm_lr),
-                "regular": optax.inject_hyperparams(optax.adamw)(learning_rate=lr,
-                                                                 weight_decay=weight_decay),
+                "ssm": optax.inject_hyperparams(scaled_adam, static_args='lr_min')(
+                    learning_rate=ssm_lr, lr_min=lr_min),
+                "regular": optax.inject_hyperparams(scaled_adamw, static_args='lr_min')(
+                    learning_rate=lr, weight_decay=weight_decay, lr_min=lr_min),
             },
             ssm_fn,
         )
@@ -290,6 +356,10 @@ def create_train_state(model_cls,
     else:
         state = train_state.TrainState.create(apply_fn=model.apply, params=params, tx=tx)
     
+    if mesh is not None:
+        # place state on the device mesh (sharded or replicated per parameter)
+        return shard_state(state, mesh, shard_opt_state, shard_params)
+
     # keep copy of state on each device
     state = jax_utils.replicate(state)
     return state
@@ -319,8 +389,72 @@ def prep_batch(
         seq_len: int,
         in_dim: int,
         num_devices: int,
+        book_depth: Optional[int] = None,
+        timer=NO_TIMER,
     ) -> Tuple[Tuple, np.ndarray, Tuple]:
+    """ in_dim:     if None, message inputs are kept as integer tokens
+                    (one-hot encoded per micro-batch in train_step_accum)
+        book_depth: if given, book data are raw L2 rows (compact batches),
+                    which are transformed to the volume image on device
+        timer:      lob.profiling.StepTimer, times 'transfer' and 'prep' phases
+    """
+    inputs, targets, book_data, timestep_msg, timestep_book = _unpack_batch(batch)
 
+    # reshape from large batch to multiple device batches
+    with timer.phase('transfer'):
+        inputs, targets, book_data, timestep_msg, timestep_book = timer.sync(device_reshape(
+            num_devices,
+            inputs,
+            targets,
+            book_data,
+            timestep_msg,
+            timestep_book,
+        ))
+
+    # split large batch into smaller device batches on the GPUs
+    with timer.phase('prep'):
+        inputs, labels, integration_times = timer.sync(_prep_batch_par(
+            inputs,
+            targets,
+            seq_len,
+            in_dim,
+            book_data,
+            timestep_msg,
+            timestep_book,
+            book_depth,
+        ))
+
+    return inputs, labels, integration_times
+
+def prep_batch_sharded(
+        batch: Union[
+            Tuple[onp.ndarray, onp.ndarray, Dict[str, onp.ndarray]],
+            Tuple[onp.ndarray, onp.ndarray]],
+        seq_len: int,
+        in_dim: Optional[int],
+        mesh,
+        book_depth: Optional[int] = None,
+        timer=NO_TIMER,
+    ) -> Tuple[Tuple, np.ndarray, Tuple]:
+    """ prep_batch for the jit (mesh) path: instead of reshaping into device
+        batches, the batch becomes global arrays split over the 'data' axis.
+    """
+    with timer.phase('transfer'):
+        batch = timer.sync(shard_batch(_unpack_batch(batch), mesh))
+    inputs, targets, book_data, timestep_msg, timestep_book = batch
+    with timer.phase('prep'):
+        return timer.sync(_prep_batch_jit(
+            inputs,
+            targets,
+            seq_len,
+            in_dim,
+            book_data,
+            timestep_msg,
+            timestep_book,
+            book_depth,
+        ))
+
+def _unpack_batch(batch):
     if len(batch) == 2:
         inputs, targets = batch
         book_data, timestep_msg, timestep_book = None, None, None
@@ -331,38 +465,9 @@ def prep_batch(
         timestep_book = aux_data.get("timesteps_book", None)            
     else:
         raise RuntimeError("Err... not sure what I should do... Unhandled data type. ")
+    return inputs, targets, book_data, timestep_msg, timestep_book
 
-    # reshape from large batch to multiple device batches
-    inputs, targets, book_data, timestep_msg, timestep_book = device_reshape(
-        num_devices,
-        inputs,
-        targets,
-        book_data,
-        timestep_msg,
-        timestep_book,
-    )
-
-    # split large batch into smaller device batches on the GPUs
-    inputs, labels, integration_times = _prep_batch_par(
-        inputs,
-        targets,
-        seq_len,
-        in_dim,
-        book_data,
-        timestep_msg,
-        timestep_book,
-    )
-
-    return inputs, labels, integration_times
-
-@partial(
-#    jax.vmap,
-    jax.pmap,
-    axis_name="batch_devices",
-    static_broadcasted_argnums=(2, 3),
-    in_axes=(0, 0, None, None, 0, 0, 0),
-    out_axes=(0, 0, 0))
-def _prep_batch_par(
+def _prep_batch(
         inputs: jax.Array,
         targets: jax.Array,
         seq_len: int,
@@ -370,17 +475,20 @@ def _prep_batch_par(
         book_data: Optional[jax.Array] = None,
         timestep_msg: Optional[jax.Array] = None,
         timestep_book: Optional[jax.Array] = None,
+        book_depth: Optional[int] = None,
     ) -> Tuple[Tuple, np.ndarray, Tuple]:
     """
     Take a batch and convert it to a standard x/y format per device
     TODO: document this better for pmapped version
     :param seq_len:     (int) length of sequence.
-    :param in_dim:      (int) dimension of input.
+    :param in_dim:      (int) dimension of input. If None, inputs are not one-hot encoded.
+    :param book_depth:  (int) if given, convert raw L2 book rows to volume image.
     :return:
     """
 
     assert inputs.shape[1] == seq_len, f'inputs: {inputs.shape} seq_len {seq_len}'
-    inputs = one_hot(inputs, in_dim)
+    if in_dim is not None:
+        inputs = one_hot(inputs, in_dim).astype(np.float32)
 
     # If there is an aux channel containing the integration times, then add that.
     if timestep_msg is not None:
@@ -391,19 +499,32 @@ def _prep_batch_par(
 
     if book_data is not None:
         #book_data = jax.device_put(book_data, jax.devices()[0])
-        full_inputs = (inputs.astype(np.float32), book_data)
+        if book_depth is not None:
+            book_data = transform_L2_state(
+                book_data.reshape(-1, book_data.shape[-1]), book_depth, 100
+            ).reshape(*book_data.shape[:-1], book_depth + 1)
+        full_inputs = (inputs, book_data)
         if timestep_book is not None:
             #timestep_book = jax.device_put(timestep_book, jax.devices()[0])
             integration_timesteps += (np.diff(timestep_book), )
         else:
             integration_timesteps += (np.ones((len(inputs), seq_len)), )
     else:
-        full_inputs = (inputs.astype(np.float32), )
+        full_inputs = (inputs, )
 
     # CAVE: squeeze very important for training!
     return full_inputs, np.squeeze(targets.astype(np.float32)), integration_timesteps
 
-@partial(jax.jit, static_argnums=(0,), backend='gpu')# backend='cpu')
+_prep_batch_par = jax.pmap(
+    _prep_batch,
+    axis_name="batch_devices",
+    static_broadcasted_argnums=(2, 3, 7),
+    in_axes=(0, 0, None, None, 0, 0, 0, None),
+    out_axes=(0, 0, 0))
+
+_prep_batch_jit = jax.jit(_prep_batch, static_argnums=(2, 3, 7))
+
+@partial(jax.jit, static_argnums=(0,))
 def device_reshape(
         num_devices: int,
         inputs: jax.Array,
@@ -433,41 +554,121 @@ def train_epoch(
         seq_len,
         in_dim,
         batchnorm,
-        lr_params,
         num_devices,
+        book_depth=None,
+        grad_accum_steps=1,
+        steps_per_dispatch=1,
+        mesh=None,
+        timer=NO_TIMER,
+        profile=None,
+        step_callback=None,
+        shard_opt_state=False,
+        shard_params=False,
     ):
     """
     Training function for an epoch that loops over batches.
+    Learning rates follow the optax schedules in the optimizer state.
+    book_depth: given for compact batches (see prep_batch)
+    grad_accum_steps: if > 1, each loader batch is split into this many
+                      micro-batches, accumulating gradients before an update
+    steps_per_dispatch: if > 1, each loader batch holds this many (stacked)
+                        batches, trained on in one compiled call (train_multi_step)
+    mesh: if given, state and batches are sharded over this device mesh (jit
+          instead of pmap, see lob.sharding), with optimizer state / params
+          split over the 'data' axis if shard_opt_state / shard_params
+    timer: lob.profiling.StepTimer, times the phases of every step
+    profile: lob.profiling.ProfileWindow, traces a window of steps
+    step_callback: called after every step as step_callback(state, rng, n_batches)
+                   with the rng to continue from after n_batches of the epoch
+                   (e.g. for resume checkpoints)
     """
-    # Store Metrics
-    batch_losses = []
-
-    decay_function, ssm_lr, lr, step, end_step, opt_config, lr_min = lr_params
-
-    #with jax.profiler.trace("/tmp/jax-trace", create_perfetto_link=True):
-    for batch_idx, batch in enumerate(tqdm(trainloader)):
-        inputs, labels, integration_times = prep_batch(batch, seq_len, in_dim, num_devices)
+    # running sum of the losses (on device)
+    loss_sum = np.zeros(())
 
+    pbar = tqdm(trainloader)
+    for batch_idx, batch in enumerate(timer.iterate(pbar)):
         rng, drop_rng = jax.random.split(rng)
-        state, loss = train_step(
-            state,
-            drop_rng,
-            inputs,
-            labels,
-            integration_times,
-            batchnorm,
-        )
-
-        # losses are already averaged across devices (--> should be all the same here)
-        batch_losses.append(loss[0])
-        lr_params = (decay_function, ssm_lr, lr, step, end_step, opt_config, lr_min)
-        state, step = update_learning_rate_per_step(lr_params, state)
+        with (profile.start_step() if profile is not None else nullcontext()):
+            if mesh is not None:
+                # tokens are one-hot encoded inside the step for stacked / micro-batches
+                step_in_dim = None if (steps_per_dispatch > 1 or grad_accum_steps > 1) else in_dim
+                inputs, labels, integration_times = prep_batch_sharded(
+                    batch, seq_len, step_in_dim, mesh, book_depth, timer)
+                with timer.phase('compute'):
+                    state, loss = timer.sync(train_step_sharded(
+                        state,
+                        drop_rng,
+                        inputs,
+                        labels,
+                        integration_times,
+                        batchnorm,
+                        steps_per_dispatch,
+                        grad_accum_steps,
+                        in_dim,
+                        mesh,
+                        shard_opt_state,
+                        shard_params,
+                    ))
+            elif steps_per_dispatch > 1:
+                inputs, labels, integration_times = prep_batch(
+                    batch, seq_len, None, num_devices, book_depth, timer)
+                with timer.phase('compute'):
+                    state, loss = timer.sync(train_multi_step(
+                        state,
+                        drop_rng,
+                        inputs,
+                        labels,
+                        integration_times,
+                        batchnorm,
+                        steps_per_dispatch,
+                        grad_accum_steps,
+                        in_dim,
+                    ))
+            elif grad_accum_steps > 1:
+                # tokens are one-hot encoded per micro-batch inside the step
+                inputs, labels, integration_times = prep_batch(
+                    batch, seq_len, None, num_devices, book_depth, timer)
+                with timer.phase('compute'):
+                    state, loss = timer.sync(train_step_accum(
+                        state,
+                        drop_rng,
+                        inputs,
+                        labels,
+                        integration_times,
+                        batchnorm,
+                        grad_accum_steps,
+                        in_dim,
+                    ))
+            else:
+                inputs, labels, integration_times = prep_batch(
+                    batch, seq_len, in_dim, num_devices, book_depth, timer)
+                with timer.phase('compute'):
+                    state, loss = timer.sync(train_step(
+                        state,
+                        drop_rng,
+                        inputs,
+                        labels,
+                        integration_times,
+                        batchnorm,
+                    ))
+        if profile is not None:
+            profile.end_step(loss)
+        if step_callback is not None:
+            step_callback(state, rng, batch_idx + 1)
+
+        with timer.phase('logging'):
+            # losses are already averaged across devices (--> should be all the same here)
+            # (one loss per step for steps_per_dispatch > 1)
+            loss_sum = loss_sum + np.mean(loss)
+            if timer.enabled and batch_idx % 50 == 0:
+                pbar.set_postfix_str(timer.summary() + ' (p50 ms)')
+        timer.step_done()
 
     # Return average loss over batches
-    return state, np.mean(np.array(batch_losses)), step
+    return state, loss_sum / (batch_idx + 1)
 
 @partial(
-    jax.pmap, backend='gpu',
+    jax.pmap,
     axis_name="batch_devices",
     static_broadcasted_argnums=(5,),  # TODO: revert to 5 for batchnorm in pmap
     in_axes=(0, None, 0, 0, 0, None),
@@ -480,11 +681,219 @@ def train_step(
         batch_integration_timesteps: Tuple[jax.Array, jax.Array], # 6
         batchnorm: bool, # 7
     ):
+    return _update_step(state, rng, batch_inputs, batch_labels, batch_integration_timesteps, batchnorm)
+
+def _update_step(state, rng, batch_inputs, batch_labels, batch_integration_timesteps, batchnorm,
+                 axis_name="batch_devices"):
+    """ single optimizer step on a device batch (within pmap) or on a global
+        batch (within jit, axis_name=None)
+    """
     #print('tracing par_loss_and_grad')
+    loss, mod_vars, grads = _loss_and_grad(
+        state, state.batch_stats if batchnorm else None, rng,
+        batch_inputs, batch_labels, batch_integration_timesteps, batchnorm)
+
+    # UPDATE
+    # calculate means over device dimension (first)
+    loss = _pmean(loss, axis_name)
+    grads = _pmean(grads, axis_name)
+
+    if batchnorm:
+        mod_vars = _pmean(mod_vars, axis_name)
+        state = state.apply_gradients(grads=grads, batch_stats=mod_vars["batch_stats"])
+    else:
+        state = state.apply_gradients(grads=grads)
+
+    #return loss, mod_vars, grads, state
+    return state, loss
+
+@partial(
+    jax.pmap,
+    axis_name="batch_devices",
+    static_broadcasted_argnums=(5, 6, 7),
+    in_axes=(0, None, 0, 0, 0, None, None, None),
+    out_axes=(0, 0))
+def train_step_accum(
+        state: train_state.TrainState,
+        rng: jax.random.PRNGKeyArray,
+        batch_inputs: Tuple[jax.Array, jax.Array],
+        batch_labels: jax.Array,
+        batch_integration_timesteps: Tuple[jax.Array, jax.Array],
+        batchnorm: bool,
+        grad_accum_steps: int,
+        in_dim: int,
+    ):
+    """ train_step with gradient accumulation: the device batch is split into
+        grad_accum_steps micro-batches, which are processed sequentially in a
+        lax.scan, before applying a single update with the mean gradient.
+        Batchnorm statistics are updated by each micro-batch in turn.
+        Message inputs are integer tokens, which are one-hot encoded per
+        micro-batch to keep memory use at the micro-batch size.
+    """
+    return _accum_update_step(
+        state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+        batchnorm, grad_accum_steps, in_dim)
+
+def _accum_update_step(state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+                       batchnorm, grad_accum_steps, in_dim, axis_name="batch_devices"):
+    """ optimizer step with gradient accumulation, see train_step_accum """
+    micro_batches = _split_batch(
+        (batch_inputs, batch_labels, batch_integration_timesteps), grad_accum_steps)
+
+    def micro_step(carry, micro_batch):
+        grads_sum, loss_sum, batch_stats, rng = carry
+        inputs, labels, integration_timesteps = micro_batch
+        inputs = (one_hot(inputs[0], in_dim).astype(np.float32), *inputs[1:])
+
+        rng, drop_rng = jax.random.split(rng)
+        loss, mod_vars, grads = _loss_and_grad(
+            state, batch_stats, drop_rng, inputs, labels, integration_timesteps, batchnorm)
+        if batchnorm:
+            batch_stats = mod_vars["batch_stats"]
+
+        grads_sum = jax.tree_util.tree_map(np.add, grads_sum, grads)
+        return (grads_sum, loss_sum + loss, batch_stats, rng), None
+
+    init = (
+        jax.tree_util.tree_map(np.zeros_like, state.params),
+        np.zeros(()),
+        state.batch_stats if batchnorm else None,
+        rng,
+    )
+    (grads, loss, batch_stats, _), _ = jax.lax.scan(micro_step, init, micro_batches)
+    grads = jax.tree_util.tree_map(lambda g: g / grad_accum_steps, grads)
+    loss = loss / grad_accum_steps
+
+    # calculate means over device dimension (first)
+    loss = _pmean(loss, axis_name)
+    grads = _pmean(grads, axis_name)
+
+    if batchnorm:
+        batch_stats = _pmean(batch_stats, axis_name)
+        state = state.apply_gradients(grads=grads, batch_stats=batch_stats)
+    else:
+        state = state.apply_gradients(grads=grads)
+
+    return state, loss
+
+@partial(
+    jax.pmap,
+    axis_name="batch_devices",
+    static_broadcasted_argnums=(5, 6, 7, 8),
+    in_axes=(0, None, 0, 0, 0, None, None, None, None),
+    out_axes=(0, 0))
+def train_multi_step(
+        state: train_state.TrainState,
+        rng: jax.random.PRNGKeyArray,
+        batch_inputs: Tuple[jax.Array, jax.Array],
+        batch_labels: jax.Array,
+        batch_integration_timesteps: Tuple[jax.Array, jax.Array],
+        batchnorm: bool,
+        steps_per_dispatch: int,
+        grad_accum_steps: int,
+        in_dim: int,
+    ):
+    """ Runs steps_per_dispatch optimizer steps in a single dispatch: the device
+        batch holds steps_per_dispatch stacked batches, which are scanned over
+        with lax.scan (each step optionally using gradient accumulation).
+        Message inputs are integer tokens, one-hot encoded per step.
+        Returns the updated state and the losses of all steps (steps_per_dispatch,).
+    """
+    return _multi_update_step(
+        state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+        batchnorm, steps_per_dispatch, grad_accum_steps, in_dim)
+
+def _multi_update_step(state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+                       batchnorm, steps_per_dispatch, grad_accum_steps, in_dim,
+                       axis_name="batch_devices"):
+    """ several optimizer steps in a lax.scan, see train_multi_step """
+    batches = _split_batch(
+        (batch_inputs, batch_labels, batch_integration_timesteps), steps_per_dispatch)
+
+    def step(carry, batch):
+        state, rng = carry
+        inputs, labels, integration_timesteps = batch
+        rng, drop_rng = jax.random.split(rng)
+        if grad_accum_steps > 1:
+            state, loss = _accum_update_step(
+                state, drop_rng, inputs, labels, integration_timesteps,
+                batchnorm, grad_accum_steps, in_dim, axis_name)
+        else:
+            inputs = (one_hot(inputs[0], in_dim).astype(np.float32), *inputs[1:])
+            state, loss = _update_step(
+                state, drop_rng, inputs, labels, integration_timesteps, batchnorm, axis_name)
+        return (state, rng), loss
+
+    (state, _), losses = jax.lax.scan(step, (state, rng), batches)
+    return state, losses
+
+@partial(jax.jit, static_argnums=(5, 6, 7, 8, 9, 10, 11), donate_argnums=(0,))
+def train_step_sharded(
+        state: train_state.TrainState,
+        rng: jax.random.PRNGKeyArray,
+        batch_inputs: Tuple[jax.Array, jax.Array],
+        batch_labels: jax.Array,
+        batch_integration_timesteps: Tuple[jax.Array, jax.Array],
+        batchnorm: bool,
+        steps_per_dispatch: int = 1,
+        grad_accum_steps: int = 1,
+        in_dim: Optional[int] = None,
+        mesh: Optional[Mesh] = None,
+        shard_opt_state: bool = False,
+        shard_params: bool = False,
+    ):
+    """ jit version of train_step (or train_step_accum, train_multi_step) for a
+        state and global batch sharded over a device mesh (see lob.sharding).
+        Reductions across devices are inserted by the compiler (no pmean).
+        The updated state is constrained to the layout of shard_state(state, mesh,
+        shard_opt_state, shard_params), so that it keeps its sharding across steps.
+    """
+    if steps_per_dispatch > 1:
+        state, loss = _multi_update_step(
+            state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+            batchnorm, steps_per_dispatch, grad_accum_steps, in_dim, axis_name=None)
+    elif grad_accum_steps > 1:
+        state, loss = _accum_update_step(
+            state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+            batchnorm, grad_accum_steps, in_dim, axis_name=None)
+    else:
+        state, loss = _update_step(
+            state, rng, batch_inputs, batch_labels, batch_integration_timesteps,
+            batchnorm, axis_name=None)
+    if mesh is not None:
+        state = jax.lax.with_sharding_constraint(
+            state, state_sharding(state, mesh, shard_opt_state, shard_params))
+    return state, loss
+
+def _split_batch(batch, n):
+    """ split leading batch axis into n batches (n, batch_size / n, ...),
+        taking every n-th sample so that each of the n batches is spread
+        evenly over devices of a sharded batch
+    """
+    return jax.tree_util.tree_map(
+        lambda x: x.reshape(-1, n, *x.shape[1:]).swapaxes(0, 1), batch)
+
+def _pmean(x, axis_name):
+    if axis_name is None:
+        return x
+    return jax.lax.pmean(x, axis_name=axis_name)
+
+def _loss_and_grad(
+        state: train_state.TrainState,
+        batch_stats: Optional[Any],
+        rng: jax.random.PRNGKeyArray,
+        batch_inputs: Tuple[jax.Array, jax.Array],
+        batch_labels: jax.Array,
+        batch_integration_timesteps: Tuple[jax.Array, jax.Array],
+        batchnorm: bool,
+    ):
+    """ mean cross-entropy loss of a (device) batch, updated model variables
+        and gradients w.r.t. the parameters in state
+    """
     def loss_fn(params):
         if batchnorm:
             logits, mod_vars = state.apply_fn( 
-                {"params": params, "batch_stats": state.batch_stats},
+                {"params": params, "batch_stats": batch_stats},
                 *batch_inputs, *batch_integration_timesteps,
                 rngs={"dropout": rng},
                 mutable=["intermediates", "batch_stats"],
@@ -503,39 +912,89 @@ def train_step(
         return loss, (mod_vars, logits)
 
     (loss, (mod_vars, logits)), grads = jax.value_and_grad(loss_fn, has_aux=True)(state.params)
+    return loss, mod_vars, grads
 
-    # UPDATE
-    # calculate means over device dimension (first)
-    loss = jax.lax.pmean(loss, axis_name="batch_devices")
-    grads = jax.lax.pmean(grads, axis_name="batch_devices")
-
-    if batchnorm:
-        mod_vars = jax.lax.pmean(mod_vars, axis_name="batch_devices")
-        state = state.apply_gradients(grads=grads, batch_stats=mod_vars["batch_stats"])
-    else:
-        state = state.apply_gradients(grads=grads)
-
-    #return loss, mod_vars, grads, state
-    return state, loss
-
-def validate(state, apply_fn, testloader, seq_len, in_dim, batchnorm, num_devices, step_rescale=1.0):
-    """Validation function that loops over batches"""
-    losses, accuracies, preds = np.array([]), np.array([]), np.array([])
-    for batch_idx, batch in enumerate(tqdm(testloader)):
-        inputs, labels, integration_timesteps = prep_batch(batch, seq_len, in_dim, num_devices)
-        loss, acc, pred = eval_step(
-            inputs, labels, integration_timesteps, state, apply_fn, batchnorm)
-        losses = np.append(losses, loss)
-        accuracies = np.append(accuracies, acc)
-
-    aveloss, aveaccu = np.mean(losses), np.mean(accuracies)
-    return aveloss, aveaccu
+def pad_batch(batch, batch_size: int):
+    """ Pad a (final) batch with fewer than batch_size samples to batch_size by
+        repeating its last sample, so that all batches share one compiled shape.
+        Returns the batch and the validity mask (batch_size,) of its samples.
+    """
+    n = len(batch[0])
+    mask = onp.arange(batch_size) < n
+    if n < batch_size:
+        def pad(x):
+            x = onp.asarray(x)
+            return onp.concatenate([x, onp.repeat(x[-1:], batch_size - n, axis=0)])
+        batch = jax.tree_util.tree_map(pad, batch)
+    return batch, mask
+
+def prep_mask(mask: onp.ndarray, num_devices: int, mesh=None) -> jax.Array:
+    """ split the validity mask of a batch like its data (see prep_batch / prep_batch_sharded) """
+    if mesh is not None:
+        return shard_batch(mask, mesh)
+    return mask.reshape(num_devices, -1)
+
+def validate(state, apply_fn, testloader, seq_len, in_dim, batchnorm, num_devices, step_rescale=1.0,
+             book_depth=None, mesh=None, timer=NO_TIMER):
+    """ Validation function that loops over batches. The final batch is padded
+        to the full batch size and padded samples are masked out of the metrics.
+        Metrics are accumulated on device and fetched once at the end.
+        Returns mean loss, mean accuracy and the summary of lob.metrics.summarise_metrics
+        (with losses and accuracies per field and event type).
+    """
+    metrics = init_metrics()
+    if mesh is None:
+        # partial sums per device
+        metrics = jax_utils.replicate(metrics)
+
+    def step(batch, mask, metrics):
+        # tokens are one-hot encoded inside the eval step
+        if mesh is not None:
+            inputs, labels, integration_timesteps = prep_batch_sharded(
+                batch, seq_len, None, mesh, book_depth, timer)
+            with timer.phase('compute'):
+                return timer.sync(eval_step_sharded(
+                    inputs, labels, integration_timesteps, state, apply_fn, batchnorm, in_dim,
+                    prep_mask(mask, num_devices, mesh), metrics))
+        else:
+            inputs, labels, integration_timesteps = prep_batch(
+                batch, seq_len, None, num_devices, book_depth, timer)
+            with timer.phase('compute'):
+                return timer.sync(eval_step(
+                    inputs, labels, integration_timesteps, state, apply_fn, batchnorm, in_dim,
+                    prep_mask(mask, num_devices), metrics))
+
+    n_batches = 0
+    for batch in timer.iterate(tqdm(testloader)):
+        batch, mask = pad_batch(batch, testloader.batch_size)
+        metrics = step(batch, mask, metrics)
+        n_batches += 1
+        timer.step_done()
+
+    if jax.process_count() > 1:
+        # process shards can differ by one sample (see dataloading.process_shard):
+        # all processes run as many steps as the longest, with fully masked batches
+        n_max = int(onp.max(multihost_utils.process_allgather(onp.array(n_batches))))
+        if n_batches < n_max:
+            # any sample, from the full dataset as the shard may be empty
+            dset = getattr(testloader.dataset, 'dataset', testloader.dataset)
+            filler, _ = pad_batch(testloader.collate_fn([dset[0]]), testloader.batch_size)
+            no_samples = onp.zeros(testloader.batch_size, dtype=bool)
+            for _ in range(n_batches, n_max):
+                metrics = step(filler, no_samples, metrics)
+
+    if mesh is None and jax.process_count() > 1:
+        # partial sums of the local devices of every process, so that all
+        # processes summarise the same metrics
+        metrics = multihost_utils.process_allgather(metrics)
+    summary = summarise_metrics(metrics)
+    return summary['loss'], summary['acc'], summary
 
 @partial(
     jax.pmap,
     axis_name="batch_devices",
-    static_broadcasted_argnums=(4,5),
-    in_axes=(0, 0, 0, 0, None, None))
+    static_broadcasted_argnums=(4, 5, 6),
+    in_axes=(0, 0, 0, 0, None, None, None, 0, 0))
 def eval_step(
         batch_inputs,
         batch_labels,
@@ -544,7 +1003,30 @@ def eval_step(
         #model,
         apply_fn,
         batchnorm,
+        in_dim,
+        batch_mask,
+        metrics,
+    ):
+    return _eval_step(batch_inputs, batch_labels, batch_integration_timesteps, state, apply_fn, batchnorm,
+                      in_dim, batch_mask, metrics)
+
+def _eval_step(
+        batch_inputs,
+        batch_labels,
+        batch_integration_timesteps,
+        state,
+        apply_fn,
+        batchnorm,
+        in_dim,
+        batch_mask,
+        metrics,
     ):
+    """ Evaluate a batch and add it to the running metrics (see lob.metrics)
+        batch_inputs: message inputs are integer tokens, one-hot encoded here
+        batch_mask:   validity of the samples (e.g. padding of the final batch)
+    """
+    last_msg = batch_inputs[0][:, -Message_Tokenizer.MSG_LEN:]
+    batch_inputs = (one_hot(batch_inputs[0], in_dim).astype(np.float32), *batch_inputs[1:])
     if batchnorm:
         logits = apply_fn({"params": state.params, "batch_stats": state.batch_stats},
                              *batch_inputs, *batch_integration_timesteps,
@@ -557,4 +1039,7 @@ def eval_step(
     losses = cross_entropy_loss(logits, batch_labels)    
     accs = compute_accuracy(logits, batch_labels)
 
-    return losses, accs, logits
+    return update_metrics(metrics, losses, accs, last_msg, batch_labels, batch_mask)
+
+# jit version of eval_step for states and batches sharded over a device mesh
+eval_step_sharded = jax.jit(_eval_step, static_argnums=(4, 5, 6))
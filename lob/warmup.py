@@ -0,0 +1,136 @@
+""" Ahead-of-time compilation of the train / eval / generation steps before the
+    first step, reporting compile times.
+
+    Executables are compiled with lower().compile() for the shapes of one
+    example batch. With the persistent compilation cache enabled (see
+    lob.backend.configure_compilation_cache), they are written to disk, so that
+    the first actual call, restarts, sweep trials and rollout workers load them
+    instead of recompiling. Without the cache, the executables compiled here
+    are not reused by the jit / pmap functions, so warmup should be skipped.
+"""
+import time
+from typing import Dict, Optional
+import jax
+import jax.numpy as jnp
+from jax.nn import one_hot
+from flax import jax_utils
+
+import lob.validation_helpers as valh
+from lob.encoding import Vocab
+from lob.metrics import init_metrics
+from lob.train_helpers import eval_step, eval_step_sharded, pad_batch, prep_batch, prep_batch_sharded, \
+    prep_mask, train_multi_step, train_step, train_step_accum, train_step_sharded
+
+
+def example_batch(loader):
+    """ one batch with the shapes of the loader's batches, collated from the
+        first samples of its dataset (iterating the loader would advance its sampler)
+    """
+    if loader.batch_size is not None:
+        bsz = loader.batch_size
+    else:
+        bsz = loader.batch_sampler.batch_size
+    return loader.collate_fn([loader.dataset[i] for i in range(bsz)])
+
+
+def _compile(compile_times: Dict[str, float], name: str, fn, *args) -> None:
+    t0 = time.perf_counter()
+    fn.lower(*args).compile()
+    compile_times[name] = time.perf_counter() - t0
+
+
+def _prep(compile_times, name, batch, seq_len, in_dim, num_devices, book_depth, mesh):
+    """ batch preparation, timing its first (compiling) call """
+    t0 = time.perf_counter()
+    if mesh is not None:
+        prepped = prep_batch_sharded(batch, seq_len, in_dim, mesh, book_depth)
+    else:
+        prepped = prep_batch(batch, seq_len, in_dim, num_devices, book_depth)
+    jax.block_until_ready(prepped)
+    compile_times[name] = time.perf_counter() - t0
+    return prepped
+
+
+def warmup_train(
+        state,
+        apply_fn,
+        trainloader,
+        valloader,
+        seq_len: int,
+        in_dim: int,
+        batchnorm: bool,
+        num_devices: int,
+        book_depth: Optional[int] = None,
+        grad_accum_steps: int = 1,
+        steps_per_dispatch: int = 1,
+        mesh=None,
+        shard_opt_state: bool = False,
+        shard_params: bool = False,
+    ) -> Dict[str, float]:
+    """ Compile the train step (as dispatched by train_epoch for the given
+        settings) and the eval step of validate for the shapes of the train /
+        val loader batches. apply_fn: apply function of the eval model
+        Returns compile times in seconds per function.
+    """
+    compile_times = {}
+    rng = jax.random.PRNGKey(0)
+
+    # tokens are one-hot encoded inside the step for stacked / micro-batches
+    step_in_dim = None if (steps_per_dispatch > 1 or grad_accum_steps > 1) else in_dim
+    inputs, labels, integration_times = _prep(
+        compile_times, 'prep_batch (train)', example_batch(trainloader),
+        seq_len, step_in_dim, num_devices, book_depth, mesh)
+    if mesh is not None:
+        _compile(compile_times, 'train_step_sharded', train_step_sharded,
+                 state, rng, inputs, labels, integration_times, batchnorm,
+                 steps_per_dispatch, grad_accum_steps, in_dim,
+                 mesh, shard_opt_state, shard_params)
+    elif steps_per_dispatch > 1:
+        _compile(compile_times, 'train_multi_step', train_multi_step,
+                 state, rng, inputs, labels, integration_times, batchnorm,
+                 steps_per_dispatch, grad_accum_steps, in_dim)
+    elif grad_accum_steps > 1:
+        _compile(compile_times, 'train_step_accum', train_step_accum,
+                 state, rng, inputs, labels, integration_times, batchnorm,
+                 grad_accum_steps, in_dim)
+    else:
+        _compile(compile_times, 'train_step', train_step,
+                 state, rng, inputs, labels, integration_times, batchnorm)
+
+    if valloader is not None:
+        batch, mask = pad_batch(example_batch(valloader), valloader.batch_size)
+        inputs, labels, integration_times = _prep(
+            compile_times, 'prep_batch (eval)', batch,
+            seq_len, None, num_devices, book_depth, mesh)
+        metrics = init_metrics() if mesh is not None else jax_utils.replicate(init_metrics())
+        _compile(compile_times, 'eval_step',
+                 eval_step_sharded if mesh is not None else eval_step,
+                 inputs, labels, integration_times, state, apply_fn, batchnorm, in_dim,
+                 prep_mask(mask, num_devices, mesh), metrics)
+    return compile_times
+
+
+def warmup_predict(
+        state,
+        model,
+        batchnorm: bool,
+        m_seq: jax.Array,
+        b_seq: jax.Array,
+    ) -> Dict[str, float]:
+    """ Compile the model prediction of inference.generate for single sample
+        inputs of the shapes of m_seq (encoded message sequence) and b_seq
+        (transformed book sequence).
+        Returns compile times in seconds per function.
+    """
+    compile_times = {}
+    inputs = (
+        one_hot(jnp.expand_dims(m_seq, axis=0), len(Vocab())).astype(float),
+        jnp.expand_dims(b_seq, axis=0)
+    )
+    integration_timesteps = (
+        jnp.ones((1, len(m_seq))),
+        jnp.ones((1, len(b_seq)))
+    )
+    _compile(compile_times, 'predict', valh.predict,
+             inputs, integration_timesteps, state, model, batchnorm)
+    return compile_times
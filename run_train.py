@@ -6,6 +6,7 @@ import argparse
 from s5.utils.util import str2bool
 from lob.train import train
 from lob.dataloading import Datasets
+from lob.backend import configure_backend, configure_compilation_cache
 #import tensorflow as tf
 import os
 import jax
@@ -52,12 +53,29 @@ if __name__ == "__main__":
 	parser.add_argument("--book_depth", type=int, default=500,
 		     			help="number of tick levels to use in book data [if book_transform=True]")
 	parser.add_argument("--restore", type=str,
-		     			help="if given restore from given checkpoint dir")
+		     			help="if given restore from given checkpoint dir; if it contains resume " \
+		     				 "checkpoints, training continues from the latest one")
 	parser.add_argument("--restore_step", type=int)
+	parser.add_argument("--checkpoint_every_steps", type=int, default=0,
+		     			help="write a resume checkpoint (train state, rng, data cursor) " \
+		     				 "every this many training steps (0: only per epoch)")
+	parser.add_argument("--checkpoint_every_minutes", type=float, default=0.,
+		     			help="write a resume checkpoint every this many minutes (0: only per epoch)")
+	parser.add_argument("--checkpoint_keep", type=int, default=2,
+		     			help="number of most recent resume checkpoints to keep")
 	parser.add_argument("--msg_seq_len", type=int, default=500,  # 500
 						help="How many past messages to include in each sample")
+	parser.add_argument("--msg_seq_len_curriculum", type=str, default="",
+						help="shorter msg_seq_len stages before training at msg_seq_len, as 'len:epochs,...' " \
+							 "e.g. '100:2,500:2' (projections over the sequence are resampled between stages)")
 	parser.add_argument("--n_data_workers", type=int, default=0,
 		     			help="number of workers used in DataLoader")
+	parser.add_argument("--compact_batches", type=str2bool, default=False,
+		     			help="load int16 tokens and raw L2 book rows, expanding them on device [if book_transform=True]")
+	parser.add_argument("--n_files_shuffle", type=int, default=0,
+		     			help="if > 0, shuffle training data in blocks of this many days (better disk locality), else uniformly")
+	parser.add_argument("--track_io", type=str2bool, default=False,
+		     			help="log the memory-mapped pages read per training batch (diagnostic, slows down sampling)")
 
 	# Model Parameters
 	parser.add_argument("--n_message_layers", type=int, default=2,  # 2
@@ -82,10 +100,11 @@ if __name__ == "__main__":
 							 "lecun_normal sample from lecun normal, then multiply by V\\ " \
 							 "complex_normal: sample directly from complex standard normal")
 	parser.add_argument("--discretization", type=str, default="zoh", choices=["zoh", "bilinear"])
-	parser.add_argument("--mode", type=str, default="pool", choices=["pool", "last"],
+	parser.add_argument("--mode", type=str, default="pool", choices=["pool", "last", "multi"],
 						help="options: (for classification tasks) \\" \
 							 " pool: mean pooling \\" \
-							 "last: take last element")
+							 "last: take last element \\" \
+							 "multi: predict all non-time tokens of the last message in one pass (overrides masking)")
 	parser.add_argument("--activation_fn", default="half_glu1", type=str,
 						choices=["full_glu", "half_glu1", "half_glu2", "gelu"])
 	parser.add_argument("--conj_sym", type=str2bool, default=True,
@@ -94,10 +113,30 @@ if __name__ == "__main__":
 						help="whether to enforce the left-half plane condition")
 	parser.add_argument("--bidirectional", type=str2bool, default=False,  #False,
 						help="whether to use bidirectional model")
+	parser.add_argument("--ssm_kernel", type=str, default="scan", choices=["scan", "sequential", "chunked", "fft", "auto"],
+						help="computation of the SSM recurrence: \\" \
+							 "scan: parallel scan over the whole sequence \\" \
+							 "sequential: sequential scan over the steps \\" \
+							 "chunked: parallel scan in chunks with a sequential carry " \
+							 "(memory scales with L*P/ssm_chunk_size) \\" \
+							 "fft: long convolution via FFT (e.g. faster on CPU) \\" \
+							 "auto: fastest kernel per layer shape, benchmarked at startup")
+	parser.add_argument("--ssm_chunk_size", type=int, default=256,
+						help="number of steps per chunk of the chunked SSM kernel")
 	parser.add_argument("--dt_min", type=float, default=0.001,
 						help="min value to sample initial timescale params from")
 	parser.add_argument("--dt_max", type=float, default=0.1,
 						help="max value to sample initial timescale params from")
+	parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16"],
+						help="fp32: float32 throughout \\" \
+							 "bf16: dense layers, GLUs and decoder compute in bfloat16 " \
+							 "(params, SSM recurrence and loss stay in float32)")
+	parser.add_argument("--remat", type=str, default="none", choices=["none", "layer", "dots", "stack"],
+						help="activation rematerialization (less memory for more compute): \\" \
+							 "none: save all activations \\" \
+							 "layer: save only inputs of each S5 layer \\" \
+							 "dots: save matmul outputs of each S5 layer, recompute scans \\" \
+							 "stack: save only inputs of each stack of layers")
 
 	# Optimization Parameters
 	parser.add_argument("--prenorm", type=str2bool, default=True,
@@ -108,8 +147,54 @@ if __name__ == "__main__":
 						help="batchnorm momentum")
 	parser.add_argument("--bsz", type=int, default=16, #64, (max 16 with full size)
 						help="batch size")
-	parser.add_argument("--num_devices", type=int, default=jax.device_count(),
-		     			help="number of devices (GPUs) to use")
+	parser.add_argument("--grad_accum_steps", type=int, default=1,
+						help="number of micro-batches (of size bsz) to accumulate gradients over per update")
+	parser.add_argument("--steps_per_dispatch", type=int, default=1,
+						help="number of optimizer steps run in one compiled call (less dispatch overhead for small models)")
+	parser.add_argument("--backend", type=str, default=None, choices=["gpu", "cpu", "tpu"],
+		     			help="JAX backend to run on [default: JAX default platform]")
+	parser.add_argument("--n_cpu_devices", type=int, default=None,
+		     			help="for backend=cpu: number of XLA host devices (data parallel) to split the CPU into")
+	parser.add_argument("--n_cpu_threads", type=int, default=None,
+		     			help="for backend=cpu: threads for host-side data preparation [default: cores per device]")
+	parser.add_argument("--ssm_autotune_cache", type=str, default="cache_dir/ssm_autotune.json",
+						help="file of the SSM kernels selected by --ssm_kernel auto, " \
+							 "per hardware and layer shape ('' to always benchmark)")
+	parser.add_argument("--compilation_cache_dir", type=str, default="cache_dir/jax",
+		     			help="directory of the persistent XLA compilation cache, reused across runs " \
+		     				 "('' to disable)")
+	parser.add_argument("--aot_warmup", type=str2bool, default=True,
+		     			help="compile train and eval steps ahead of time before the first step, " \
+		     				 "reporting compile times (requires --compilation_cache_dir)")
+	parser.add_argument("--time_steps", type=str2bool, default=False,
+		     			help="log rolling percentiles of the data wait, transfer, prep, compute and logging time " \
+		     				 "per step (synchronises the device after each phase)")
+	parser.add_argument("--profile_steps", type=str, default="",
+		     			help="capture a JAX profiler (Perfetto) trace of training steps a:b (counted across epochs), " \
+		     				 "e.g. 10:20 [default: no trace]")
+	parser.add_argument("--profile_dir", type=str, default="/tmp/jax-trace",
+		     			help="directory the profiler trace is written to")
+	parser.add_argument("--num_devices", type=int, default=None,
+		     			help="number of devices (GPUs) to use across all processes [default: all]")
+	parser.add_argument("--sharding", type=str, default="pmap", choices=["pmap", "mesh"],
+		     			help="pmap: replicated state, pmapped steps \\" \
+		     				 "mesh: jit with state and batches sharded over a device mesh " \
+		     				 "(on CPU, e.g. XLA_FLAGS=--xla_force_host_platform_device_count=8)")
+	parser.add_argument("--model_parallel", type=int, default=1,
+		     			help="size of the model axis of the device mesh, over which the decoder, input encoder " \
+		     				 "and book pre-layers are split [requires sharding=mesh]")
+	parser.add_argument("--shard_opt_state", type=str2bool, default=False,
+		     			help="ZeRO-style: split optimizer state (Adam moments) over data parallel devices " \
+		     				 "[requires sharding=mesh]")
+	parser.add_argument("--shard_params", type=str2bool, default=False,
+		     			help="also split parameters over data parallel devices, all-gathered when used " \
+		     				 "[requires sharding=mesh]")
+	parser.add_argument("--coordinator_address", type=str, default=None,
+		     			help="host:port of process 0 for multi-process training (jax.distributed)")
+	parser.add_argument("--num_processes", type=int, default=1,
+		     			help="number of processes for multi-process training")
+	parser.add_argument("--process_id", type=int, default=0,
+		     			help="index of this process for multi-process training")
 	parser.add_argument("--epochs", type=int, default=100,  #100, 20
 						help="max number of epochs")
 	parser.add_argument("--early_stop_patience", type=int, default=1000,
@@ -146,6 +231,19 @@ if __name__ == "__main__":
 	parser.add_argument("--jax_seed", type=int, default=1919,
 						help="seed randomness")
 
+	args = parser.parse_args()
+	# has to happen before any other JAX call
+	configure_backend(args.backend, args.n_cpu_devices, args.n_cpu_threads)
+	configure_compilation_cache(args.compilation_cache_dir)
+	if args.num_processes > 1:
+		# has to happen before any other JAX call
+		jax.distributed.initialize(
+			coordinator_address=args.coordinator_address,
+			num_processes=args.num_processes,
+			process_id=args.process_id)
+	if args.num_devices is None:
+		args.num_devices = jax.device_count()
+
 	#with jax.profiler.trace("/tmp/jax-trace", create_perfetto_link=True):
-	train(parser.parse_args())
+	train(args)
 	#cProfile.run('train(parser.parse_args())')
@@ -0,0 +1,198 @@
+""" Startup autotuning of the S5 compute kernel (s5.ssm.SSM_KERNELS) per SSM shape.
+
+    For every distinct SSM configuration (sequence length L, features H, state
+    size P, conj_sym, bidirectional) the candidate kernels are benchmarked on
+    random inputs for the batch size per device (forward and backward pass for
+    training), and the fastest one that fits into the memory limit is used by
+    all S5SSMs with kernel "auto". Decisions are stored in a JSON cache file,
+    keyed by the hardware (backend, device kind, JAX version) and the shapes,
+    so that later runs skip the benchmarks.
+"""
+import json
+import os
+import time
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+import numpy as onp
+import jax
+import jax.numpy as np
+
+from .ssm import SSM_KERNELS, set_kernel_selection
+
+
+# (kernel, chunk_size) candidates
+CANDIDATES = (
+    ("scan", 0),
+    ("sequential", 0),
+    ("chunked", 64),
+    ("chunked", 256),
+    ("fft", 0),
+)
+
+
+def _name(kernel: str, chunk_size: int) -> str:
+    return f"{kernel}:{chunk_size}" if kernel == "chunked" else kernel
+
+
+CANDIDATE_NAMES = tuple(_name(k, c) for k, c in CANDIDATES)
+
+
+def hardware_key() -> str:
+    devices = jax.local_devices()
+    return f"{jax.default_backend()}/{devices[0].device_kind}/jax-{jax.__version__}"
+
+
+def shape_key(shape, bsz: int, grad: bool) -> str:
+    L, H, P, conj_sym, bidirectional = shape
+    return f"L={L},H={H},P={P},conj_sym={conj_sym},bidirectional={bidirectional},bsz={bsz},grad={grad}"
+
+
+def _benchmark_fn(kernel: str, chunk_size: int, shape, bsz: int, grad: bool):
+    """ compiled benchmark function and its inputs """
+    L, H, P, conj_sym, bidirectional = shape
+    rng = onp.random.default_rng(0)
+    # stable eigenvalues, as after discretization
+    Lambda_bar = np.asarray(
+        onp.exp((-0.5 + 1j * rng.uniform(0, onp.pi, P)) * 0.01), dtype=np.complex64)
+    B_bar = np.asarray(rng.normal(size=(P, H)) + 1j * rng.normal(size=(P, H)), dtype=np.complex64)
+    n_out = 2 * P if bidirectional else P
+    C_tilde = np.asarray(
+        rng.normal(size=(H, n_out)) + 1j * rng.normal(size=(H, n_out)), dtype=np.complex64)
+    us = np.asarray(rng.normal(size=(bsz, L, H)), dtype=np.float32)
+
+    apply_fn = SSM_KERNELS[kernel]
+    kwargs = {"chunk_size": chunk_size} if kernel == "chunked" else {}
+
+    def forward(B_bar, us):
+        return jax.vmap(
+            lambda u: apply_fn(Lambda_bar, B_bar, C_tilde, u, conj_sym, bidirectional, **kwargs)
+        )(us)
+
+    if grad:
+        fn = jax.grad(lambda B_bar, us: np.sum(forward(B_bar, us) ** 2), argnums=(0, 1))
+    else:
+        fn = forward
+    compiled = jax.jit(fn).lower(B_bar, us).compile()
+    return compiled, (B_bar, us)
+
+
+def _memory_bytes(compiled) -> Optional[int]:
+    """ device memory of a compiled function, if XLA reports it """
+    try:
+        stats = compiled.memory_analysis()
+        return int(stats.temp_size_in_bytes + stats.argument_size_in_bytes + stats.output_size_in_bytes)
+    except Exception:
+        return None
+
+
+def device_memory_limit() -> Optional[int]:
+    """ memory available to XLA on the first local device, if reported """
+    try:
+        return int(jax.local_devices()[0].memory_stats()["bytes_limit"])
+    except Exception:
+        return None
+
+
+def benchmark_kernels(
+        shape: Tuple,
+        bsz: int,
+        grad: bool = True,
+        n_iters: int = 5,
+        memory_limit: Optional[int] = None,
+        candidates: Sequence[Tuple[str, int]] = CANDIDATES,
+    ) -> Dict[str, float]:
+    """ median run time (s) of each candidate 'kernel' or 'chunked:C' for
+        shape (L, H, P, conj_sym, bidirectional); candidates which exceed
+        memory_limit (bytes) or run out of memory are left out
+    """
+    L = shape[0]
+    times = {}
+    for kernel, chunk_size in candidates:
+        if kernel == "chunked" and chunk_size >= L:
+            continue
+        name = _name(kernel, chunk_size)
+        try:
+            compiled, args = _benchmark_fn(kernel, chunk_size, shape, bsz, grad)
+            mem = _memory_bytes(compiled)
+            if memory_limit is not None and mem is not None and mem > memory_limit:
+                continue
+            jax.block_until_ready(compiled(*args))
+            runs = []
+            for _ in range(n_iters):
+                t0 = time.perf_counter()
+                jax.block_until_ready(compiled(*args))
+                runs.append(time.perf_counter() - t0)
+            times[name] = float(onp.median(runs))
+        except Exception as e:
+            # e.g. RESOURCE_EXHAUSTED: candidate doesn't fit into device memory
+            print(f"[*] SSM autotune: {name} failed for {shape_key(shape, bsz, grad)} ({type(e).__name__})")
+    return times
+
+
+def _load_cache(cache_file: Optional[str]) -> dict:
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)
+    return {}
+
+
+def _save_cache(cache_file: Optional[str], cache: dict) -> None:
+    if not cache_file:
+        return
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def _parse(name: str) -> Tuple[str, int]:
+    if ':' in name:
+        kernel, chunk_size = name.split(':')
+        return kernel, int(chunk_size)
+    return name, 256
+
+
+def autotune_ssm_kernels(
+        shapes: Iterable[Tuple],
+        bsz: int,
+        grad: bool = True,
+        cache_file: Optional[str] = None,
+        memory_limit: Optional[int] = None,
+    ) -> Dict[Tuple, str]:
+    """ Select the fastest kernel for each SSM shape (L, H, P, conj_sym,
+        bidirectional) at batch size bsz (per device), using and updating
+        the decisions in cache_file, and register them for kernel "auto".
+        memory_limit: max. bytes per candidate [default: device memory limit]
+        In multi-process runs, the decisions of process 0 are used by all.
+        Returns the selected kernel name per shape.
+    """
+    shapes = sorted(set(tuple(s) for s in shapes))
+    if memory_limit is None:
+        memory_limit = device_memory_limit()
+    selected = {}
+    if jax.process_index() == 0:
+        cache = _load_cache(cache_file)
+        decisions = cache.setdefault(hardware_key(), {})
+        updated = False
+        for shape in shapes:
+            key = shape_key(shape, bsz, grad)
+            if key not in decisions or decisions[key]["kernel"] not in CANDIDATE_NAMES:
+                times = benchmark_kernels(shape, bsz, grad, memory_limit=memory_limit)
+                assert len(times) > 0, f"no SSM kernel runs for {key}"
+                decisions[key] = {"kernel": min(times, key=times.get), "times": times}
+                updated = True
+            selected[shape] = decisions[key]["kernel"]
+        if updated:
+            _save_cache(cache_file, cache)
+
+    if jax.process_count() > 1:
+        # all processes have to compile the same programs: use the decisions of process 0
+        from jax.experimental import multihost_utils
+        idx = [CANDIDATE_NAMES.index(selected[s]) if s in selected else 0 for s in shapes]
+        idx = multihost_utils.broadcast_one_to_all(onp.array(idx))
+        selected = {s: CANDIDATE_NAMES[int(i)] for s, i in zip(shapes, idx)}
+
+    for shape, name in selected.items():
+        kernel, chunk_size = _parse(name)
+        set_kernel_selection(shape, kernel, chunk_size)
+        print(f"[*] SSM kernel for {shape_key(shape, bsz, grad)}: {name}")
+    return selected
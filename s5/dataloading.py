@@ -29,7 +29,9 @@ def make_data_loader(dset,
 					 drop_last: bool=True,
 					 collate_fn: callable=None,
 					 sampler: Optional[Sampler]=None,
-					 num_workers: int = 0):
+					 num_workers: int = 0,
+					 batch_sampler: Optional[Sampler]=None,
+					 persistent_workers: bool = False):
 	"""
 
 	:param dset: 			(PT dset):		PyTorch dataset object.
@@ -38,6 +40,9 @@ def make_data_loader(dset,
 	:param batch_size: 		(int):			Batch size for batches.
 	:param shuffle:         (bool):			Shuffle the data loader?
 	:param drop_last: 		(bool):			Drop ragged final batch (particularly for training).
+	:param batch_sampler: 	(Sampler):		Yields lists of indices, replaces batch_size, shuffle,
+											drop_last and sampler.
+	:param persistent_workers: (bool):		Keep worker processes alive between epochs.
 	:return:
 	"""
 
@@ -56,10 +61,19 @@ def make_data_loader(dset,
 		shuffle = False
 		drop_last = False
 
+	# only valid with worker processes
+	persistent_workers = persistent_workers and num_workers > 0
+
+	if batch_sampler is not None:
+		return torch.utils.data.DataLoader(
+			dataset=dset, collate_fn=collate_fn, batch_sampler=batch_sampler,
+			num_workers=num_workers, persistent_workers=persistent_workers)
+
 	# Generate the dataloaders.
 	return torch.utils.data.DataLoader(
 		dataset=dset, collate_fn=collate_fn, batch_size=batch_size, shuffle=shuffle,
-		drop_last=drop_last, generator=rng, sampler=sampler, num_workers=num_workers)#,
+		drop_last=drop_last, generator=rng, sampler=sampler, num_workers=num_workers,
+		persistent_workers=persistent_workers)#,
 		# prefetch_factor=3)
 
 
@@ -1,5 +1,76 @@
+from typing import Any
+import numpy as onp
 from flax import linen as nn
+from flax.core.frozen_dict import freeze, unfreeze
+from flax.traverse_util import flatten_dict, unflatten_dict
 import jax
+import jax.numpy as np
+
+
+# Activation rematerialization (gradient checkpointing) policies for S5 layers
+# ("stack" is applied to whole encoder stacks by the models instead)
+REMAT_POLICIES = {
+    # save only the layer inputs, recompute all activations within the layer
+    "layer": None,
+    # save outputs of matmuls, recompute the scan and elementwise operations
+    "dots": jax.checkpoint_policies.dots_with_no_batch_dims_saveable,
+}
+REMAT_OPTIONS = ["none", "stack", *REMAT_POLICIES]
+
+
+def remat_layer(layer_cls, remat="none"):
+    """ Wrap a layer class in nn.remat if remat names a per-layer policy.
+        Parameter names are unaffected.
+    """
+    assert remat in REMAT_OPTIONS, f"remat must be in {REMAT_OPTIONS}"
+    if remat in REMAT_POLICIES:
+        return nn.remat(layer_cls, policy=REMAT_POLICIES[remat])
+    return layer_cls
+
+
+class QuantizedDense(nn.Module):
+    """ Inference-only replacement of nn.Dense with int8 weights and a float32
+        scale per output channel (see quantize_params). The int8 kernel is
+        converted to dtype for the matmul and the scales are applied to its
+        output. The weights take a quarter of the memory; XLA may materialise
+        the converted kernel unless it fuses the conversion into the dot.
+    """
+    features: int
+    dtype: Any = np.float32
+
+    @nn.compact
+    def __call__(self, x):
+        kernel = self.param('kernel', nn.initializers.zeros, (x.shape[-1], self.features), np.int8)
+        scale = self.param('scale', nn.initializers.ones, (self.features,), np.float32)
+        bias = self.param('bias', nn.initializers.zeros, (self.features,), np.float32)
+        x = x.astype(self.dtype)
+        y = jax.lax.dot_general(
+            x, kernel.astype(self.dtype), (((x.ndim - 1,), (0,)), ((), ())))
+        return y * scale.astype(self.dtype) + bias.astype(self.dtype)
+
+
+def dense_layer(quantize=False):
+    """ Dense layer class: nn.Dense, or QuantizedDense for quantized inference """
+    return QuantizedDense if quantize else nn.Dense
+
+
+def quantize_params(params):
+    """ Convert trained (float) params for a model with quantize=True:
+        the kernels of all Dense layers to int8 with symmetric per output
+        channel scales (max. absolute weight / 127), other params unchanged.
+        Returns host (NumPy) arrays, to be put on device before inference.
+    """
+    quantized = {}
+    for k, v in flatten_dict(unfreeze(params)).items():
+        v = onp.asarray(v)
+        if k[-1] == 'kernel' and v.ndim == 2:
+            scale = onp.abs(v).max(axis=0) / 127
+            scale = onp.where(scale == 0, 1., scale).astype(onp.float32)
+            quantized[k] = onp.round(v / scale).astype(onp.int8)
+            quantized[k[:-1] + ('scale',)] = scale
+        else:
+            quantized[k] = v
+    return freeze(unflatten_dict(quantized))
 
 
 class SequenceLayer(nn.Module):
@@ -18,6 +89,11 @@ class SequenceLayer(nn.Module):
             step_rescale  (float32):  allows for uniformly changing the timescale parameter,
                                     e.g. after training on a different resolution for
                                     the speech commands benchmark
+            dtype       (dtype):    computation dtype of the dense (GLU) layers, e.g.
+                                    bfloat16 for mixed precision. Parameters and the
+                                    SSM recurrence remain in float32 / complex64.
+            quantize    (bool):     int8 weight-only dense layers for inference
+                                    (QuantizedDense, params from quantize_params)
     """
     ssm: nn.Module
     dropout: float
@@ -28,6 +104,8 @@ class SequenceLayer(nn.Module):
     batchnorm: bool = False
     bn_momentum: float = 0.90
     step_rescale: float = 1.0
+    dtype: Any = np.float32
+    quantize: bool = False
 
     def setup(self):
         """Initializes the ssm, batch/layer norm and dropout
@@ -35,10 +113,10 @@ class SequenceLayer(nn.Module):
         self.seq = self.ssm(step_rescale=self.step_rescale)
 
         if self.activation in ["full_glu"]:
-            self.out1 = nn.Dense(self.d_model)
-            self.out2 = nn.Dense(self.d_model)
+            self.out1 = dense_layer(self.quantize)(self.d_model, dtype=self.dtype)
+            self.out2 = dense_layer(self.quantize)(self.d_model, dtype=self.dtype)
         elif self.activation in ["half_glu1", "half_glu2"]:
-            self.out2 = nn.Dense(self.d_model)
+            self.out2 = dense_layer(self.quantize)(self.d_model, dtype=self.dtype)
 
         if self.batchnorm:
             self.norm = nn.BatchNorm(use_running_average=not self.training,
@@ -63,7 +141,8 @@ class SequenceLayer(nn.Module):
         skip = x
         if self.prenorm:
             x = self.norm(x)
-        x = self.seq(x)
+        # SSM runs in float32 / complex64, activations in self.dtype
+        x = self.seq(x.astype(np.float32)).astype(self.dtype)
 
         if self.activation in ["full_glu"]:
             x = self.drop(nn.gelu(x))
@@ -1,7 +1,8 @@
+from typing import Any
 import jax
 import jax.numpy as np
 from flax import linen as nn
-from .layers import SequenceLayer
+from .layers import SequenceLayer, dense_layer, remat_layer
 
 
 class StackedEncoderModel(nn.Module):
@@ -20,6 +21,10 @@ class StackedEncoderModel(nn.Module):
             step_rescale  (float32):  allows for uniformly changing the timescale parameter,
                                     e.g. after training on a different resolution for
                                     the speech commands benchmark
+            dtype       (dtype):    computation dtype of the dense layers (see SequenceLayer)
+            quantize    (bool):     int8 weight-only dense layers (see SequenceLayer)
+            remat       (str):      activation rematerialization of each layer
+                                    (see s5.layers.REMAT_POLICIES)
     """
     ssm: nn.Module
     d_model: int
@@ -31,14 +36,18 @@ class StackedEncoderModel(nn.Module):
     batchnorm: bool = False
     bn_momentum: float = 0.9
     step_rescale: float = 1.0
+    dtype: Any = np.float32
+    quantize: bool = False
+    remat: str = "none"
 
     def setup(self):
         """
         Initializes a linear encoder and the stack of S5 layers.
         """
-        self.encoder = nn.Dense(self.d_model)
+        self.encoder = dense_layer(self.quantize)(self.d_model, dtype=self.dtype)
+        layer_cls = remat_layer(SequenceLayer, self.remat)
         self.layers = [
-            SequenceLayer(
+            layer_cls(
                 ssm=self.ssm,
                 dropout=self.dropout,
                 d_model=self.d_model,
@@ -48,6 +57,8 @@ class StackedEncoderModel(nn.Module):
                 batchnorm=self.batchnorm,
                 bn_momentum=self.bn_momentum,
                 step_rescale=self.step_rescale,
+                dtype=self.dtype,
+                quantize=self.quantize,
             )
             for _ in range(self.n_layers)
         ]
@@ -1,4 +1,5 @@
 from functools import partial
+import logging
 import jax
 import jax.numpy as np
 from flax import linen as nn
@@ -6,6 +7,8 @@ from jax.nn.initializers import lecun_normal, normal
 
 from .ssm_init import init_CV, init_VinvB, init_log_steps, trunc_standard_normal
 
+logger = logging.getLogger(__name__)
+
 
 # Discretization functions
 def discretize_bilinear(Lambda, B_tilde, Delta):
@@ -88,6 +91,190 @@ def apply_ssm(Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectiona
         return jax.vmap(lambda x: (C_tilde @ x).real)(xs)
 
 
+def apply_ssm_sequential(Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectional):
+    """ Compute the LxH output of discretized SSM given an LxH input, like
+        apply_ssm, with a sequential scan over the L steps (O(P) state memory
+        per step, no log-depth intermediates).
+        Args: see apply_ssm
+        Returns:
+            ys (float32): the SSM outputs (S5 layer preactivations)      (L, H)
+    """
+    def step(x, u):
+        x = Lambda_bar * x + B_bar @ u
+        return x, x
+
+    x0 = np.zeros(Lambda_bar.shape, dtype=Lambda_bar.dtype)
+    _, xs = jax.lax.scan(step, x0, input_sequence)
+    if bidirectional:
+        _, xs2 = jax.lax.scan(step, x0, input_sequence, reverse=True)
+        xs = np.concatenate((xs, xs2), axis=-1)
+
+    if conj_sym:
+        return jax.vmap(lambda x: 2*(C_tilde @ x).real)(xs)
+    else:
+        return jax.vmap(lambda x: (C_tilde @ x).real)(xs)
+
+
+def _chunked_scan(Lambda_bar, B_bar, input_sequence, chunk_size):
+    """ Forward recurrence x_k = Lambda_bar * x_{k-1} + B_bar u_k in chunks of
+        chunk_size steps: parallel scan within each chunk (from a zero state),
+        plus the carried state of the previous chunk propagated with powers of
+        Lambda_bar. Only the carries are saved for the backward pass, the
+        chunk states are recomputed.
+        Args:
+            Lambda_bar (complex64): discretized diagonal state matrix    (P,)
+            B_bar      (complex64): discretized input matrix             (P, H)
+            input_sequence (float32): input sequence of features         (L, H)
+            chunk_size (int):        number of steps per chunk C
+        Returns:
+            apply (function): runs the scan given a readout, which maps the
+                              (C, P) states of a chunk to (C, H) outputs, and
+                              returns the outputs                (L, H)
+    """
+    L, H = input_sequence.shape
+    n_chunks = -(-L // chunk_size)
+    u = np.pad(input_sequence, ((0, n_chunks * chunk_size - L), (0, 0)))
+    u = u.reshape(n_chunks, chunk_size, H)
+    # Lambda_bar^1 ... Lambda_bar^C
+    Lambda_pows = Lambda_bar ** np.arange(1, chunk_size + 1)[:, None]
+
+    def apply(readout):
+        @jax.checkpoint
+        def chunk(x, u_c):
+            Bu_elements = jax.vmap(lambda u: B_bar @ u)(u_c)
+            _, xs = jax.lax.associative_scan(
+                binary_operator, (np.broadcast_to(Lambda_bar, Bu_elements.shape), Bu_elements))
+            xs = xs + Lambda_pows * x
+            return xs[-1], readout(xs)
+
+        x0 = np.zeros(Lambda_bar.shape, dtype=Lambda_pows.dtype)
+        _, ys = jax.lax.scan(chunk, x0, u)
+        return ys.reshape(n_chunks * chunk_size, -1)[:L]
+    return apply
+
+
+def apply_ssm_chunked(Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectional,
+                      chunk_size=256):
+    """ Compute the LxH output of discretized SSM given an LxH input, like
+        apply_ssm, but scanning in chunks of chunk_size steps (see
+        _chunked_scan). Memory of the scan scales with L*P/chunk_size instead
+        of L*P (times the log-depth intermediates).
+        Args:
+            Lambda_bar (complex64): discretized diagonal state matrix    (P,)
+            B_bar      (complex64): discretized input matrix             (P, H)
+            C_tilde    (complex64): output matrix                        (H, P)
+            input_sequence (float32): input sequence of features         (L, H)
+            conj_sym (bool):         whether conjugate symmetry is enforced
+            bidirectional (bool):    whether bidirectional setup is used,
+                                  Note for this case C_tilde will have 2P cols
+            chunk_size (int):        number of steps per chunk
+        Returns:
+            ys (float32): the SSM outputs (S5 layer preactivations)      (L, H)
+    """
+    P = Lambda_bar.shape[0]
+    chunk_size = min(chunk_size, input_sequence.shape[0])
+    scale = 2 if conj_sym else 1
+
+    def readout(C):
+        return lambda xs: scale * jax.vmap(lambda x: (C @ x).real)(xs)
+
+    ys = _chunked_scan(Lambda_bar, B_bar, input_sequence, chunk_size)(readout(C_tilde[:, :P]))
+    if bidirectional:
+        # reverse scan: forward scan over the reversed sequence
+        ys2 = _chunked_scan(Lambda_bar, B_bar, input_sequence[::-1], chunk_size)(
+            readout(C_tilde[:, P:]))
+        ys = ys + ys2[::-1]
+    return ys
+
+
+def _causal_fft_conv(kernel, x):
+    """ causal convolution y_k = sum_{j<=k} kernel_{k-j} * x_j of each channel
+        kernel, x: (L, P) -> (L, P) complex
+    """
+    L = x.shape[0]
+    # zero padded to a power of 2 >= 2L: linear instead of circular convolution
+    n = 1 << (2 * L - 1).bit_length()
+    ys = np.fft.ifft(np.fft.fft(kernel, n, axis=0) * np.fft.fft(x, n, axis=0), axis=0)
+    return ys[:L]
+
+
+def apply_ssm_fft(Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectional):
+    """ Compute the LxH output of discretized SSM given an LxH input, like
+        apply_ssm, as a long convolution evaluated with FFTs. The SSM is time
+        invariant, so x_k = sum_{j<=k} Lambda_bar^{k-j} B_bar u_j: the (factorized)
+        kernel Lambda_bar^k (L, P) is convolved with B_bar u per state
+        dimension, followed by the C_tilde readout.
+        Args:
+            Lambda_bar (complex64): discretized diagonal state matrix    (P,)
+            B_bar      (complex64): discretized input matrix             (P, H)
+            C_tilde    (complex64): output matrix                        (H, P)
+            input_sequence (float32): input sequence of features         (L, H)
+            conj_sym (bool):         whether conjugate symmetry is enforced
+            bidirectional (bool):    whether bidirectional setup is used,
+                                  Note for this case C_tilde will have 2P cols
+        Returns:
+            ys (float32): the SSM outputs (S5 layer preactivations)      (L, H)
+    """
+    L = input_sequence.shape[0]
+    kernel = Lambda_bar ** np.arange(L)[:, None]
+    Bu_elements = jax.vmap(lambda u: B_bar @ u)(input_sequence)
+
+    xs = _causal_fft_conv(kernel, Bu_elements)
+    if bidirectional:
+        xs2 = _causal_fft_conv(kernel, Bu_elements[::-1])[::-1]
+        xs = np.concatenate((xs, xs2), axis=-1)
+
+    if conj_sym:
+        return jax.vmap(lambda x: 2*(C_tilde @ x).real)(xs)
+    else:
+        return jax.vmap(lambda x: (C_tilde @ x).real)(xs)
+
+
+# compute kernels of the S5 recurrence, selected per model with S5SSM.kernel
+SSM_KERNELS = {
+    "scan": apply_ssm,
+    "sequential": apply_ssm_sequential,
+    "chunked": apply_ssm_chunked,
+    "fft": apply_ssm_fft,
+}
+
+
+# kernels chosen for SSM shapes by kernel "auto" (see s5.autotune):
+# (L, H, P, conj_sym, bidirectional) -> (kernel, chunk_size)
+_KERNEL_SELECTION = {}
+
+
+def set_kernel_selection(shape, kernel, chunk_size=256):
+    """ use kernel (with chunk_size) for S5SSMs with kernel "auto" and shape
+        (L, H, P, conj_sym, bidirectional) """
+    assert kernel in SSM_KERNELS, f"kernel must be in {list(SSM_KERNELS)}"
+    _KERNEL_SELECTION[tuple(shape)] = (kernel, chunk_size)
+
+
+def selected_kernel(shape):
+    """ kernel and chunk size selected for shape, parallel scan if not tuned """
+    shape = tuple(shape)
+    if shape not in _KERNEL_SELECTION:
+        logger.warning(f"SSM kernel 'auto' not tuned for (L, H, P, conj_sym, bidirectional)="
+                       f"{shape}, using the parallel scan")
+    return _KERNEL_SELECTION.get(shape, ("scan", 256))
+
+
+def check_kernel_parity(kernel, Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectional,
+                        rtol=1e-4, **kernel_kwargs):
+    """ Compare the outputs of an SSM kernel (name in SSM_KERNELS) with the
+        reference parallel scan (apply_ssm) on the same inputs.
+        Args: see apply_ssm, rtol: tolerance relative to the largest reference output
+        Returns:
+            max. absolute error (float), whether it is within tolerance (bool)
+    """
+    ref = apply_ssm(Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectional)
+    ys = SSM_KERNELS[kernel](
+        Lambda_bar, B_bar, C_tilde, input_sequence, conj_sym, bidirectional, **kernel_kwargs)
+    err = float(np.max(np.abs(ys - ref)))
+    return err, err <= rtol * float(np.max(np.abs(ref)))
+
+
 class S5SSM(nn.Module):
     Lambda_re_init: np.DeviceArray
     Lambda_im_init: np.DeviceArray
@@ -104,6 +291,8 @@ class S5SSM(nn.Module):
     clip_eigs: bool = False
     bidirectional: bool = False
     step_rescale: float = 1.0
+    kernel: str = "scan"
+    chunk_size: int = 256
 
     """ The S5 SSM
         Args:
@@ -134,6 +323,14 @@ class S5SSM(nn.Module):
                                     initializing log_step
             step_rescale:  (float32): allows for uniformly changing the timescale parameter, e.g. after training 
                                     on a different resolution for the speech commands benchmark
+            kernel:      (string): computation of the recurrence (SSM_KERNELS)
+                             options: [scan: parallel scan over the whole sequence,
+                                       sequential: sequential scan over the steps,
+                                       chunked: parallel scan in chunks of chunk_size steps
+                                                with a sequential carry (less memory),
+                                       fft: convolution with the kernel Lambda_bar^k via FFT,
+                                       auto: kernel selected for the shape (see s5.autotune)]
+            chunk_size:  (int32): number of steps per chunk of the chunked kernel
     """
 
     def setup(self):
@@ -229,18 +426,27 @@ class S5SSM(nn.Module):
     def __call__(self, input_sequence):
         """
         Compute the LxH output of the S5 SSM given an LxH input sequence
-        using a parallel scan.
+        using a parallel scan (see kernel).
         Args:
              input_sequence (float32): input sequence (L, H)
         Returns:
             output sequence (float32): (L, H)
         """
-        ys = apply_ssm(self.Lambda_bar,
-                       self.B_bar,
-                       self.C_tilde,
-                       input_sequence,
-                       self.conj_sym,
-                       self.bidirectional)
+        kernel, chunk_size = self.kernel, self.chunk_size
+        if kernel == "auto":
+            kernel, chunk_size = selected_kernel(
+                (input_sequence.shape[0], self.H, self.P, self.conj_sym, self.bidirectional))
+        if kernel not in SSM_KERNELS:
+            raise NotImplementedError("SSM kernel {} not implemented".format(kernel))
+        apply_fn = SSM_KERNELS[kernel]
+        if kernel == "chunked":
+            apply_fn = partial(apply_fn, chunk_size=chunk_size)
+        ys = apply_fn(self.Lambda_bar,
+                      self.B_bar,
+                      self.C_tilde,
+                      input_sequence,
+                      self.conj_sym,
+                      self.bidirectional)
 
         # Add feedthrough matrix output Du;
         Du = jax.vmap(lambda u: self.D * u)(input_sequence)
@@ -259,7 +465,9 @@ def init_S5SSM(H,
                dt_max,
                conj_sym,
                clip_eigs,
-               bidirectional
+               bidirectional,
+               kernel="scan",
+               chunk_size=256,
                ):
     """Convenience function that will be used to initialize the SSM.
        Same arguments as defined in S5SSM above."""
@@ -276,4 +484,6 @@ def init_S5SSM(H,
                    dt_max=dt_max,
                    conj_sym=conj_sym,
                    clip_eigs=clip_eigs,
-                   bidirectional=bidirectional)
+                   bidirectional=bidirectional,
+                   kernel=kernel,
+                   chunk_size=chunk_size)
@@ -0,0 +1,61 @@
+""" Reductions of the scheduled learning rates on plateau (lr_scale
+    hyperparameter of the optimizer groups, lob.train_helpers).
+"""
+import numpy as onp
+import jax.numpy as np
+import optax
+from flax.training import train_state
+
+from lob.train_helpers import scaled_adam, scaled_adamw, plateau_lr_scales, update_lr_scale
+
+
+LR_MIN = 1e-4
+
+
+def make_state(ssm_lr, lr):
+    params = {'ssm': np.ones(3), 'regular': np.ones(2)}
+    tx = optax.multi_transform(
+        {
+            "ssm": optax.inject_hyperparams(scaled_adam, static_args='lr_min')(
+                learning_rate=ssm_lr, lr_min=LR_MIN),
+            "regular": optax.inject_hyperparams(scaled_adamw, static_args='lr_min')(
+                learning_rate=lr, weight_decay=0., lr_min=LR_MIN),
+        },
+        {'ssm': 'ssm', 'regular': 'regular'},
+    )
+    return train_state.TrainState.create(apply_fn=None, params=params, tx=tx)
+
+
+def applied_lrs(state):
+    """ size of the first adam step (= learning rate) per group """
+    grads = {'ssm': np.ones(3), 'regular': np.ones(2)}
+    updates, _ = state.tx.update(grads, state.opt_state, state.params)
+    return {k: -float(v[0]) for k, v in updates.items()}
+
+
+def test_groups_are_scaled_separately():
+    ssm_lr, lr = 1e-3, 4e-3
+    state = make_state(ssm_lr, lr)
+    # regular lr reduced once, ssm lr twice
+    state = update_lr_scale(state, plateau_lr_scales(0.5 * lr, 0.25 * ssm_lr, lr, ssm_lr))
+    lrs = applied_lrs(state)
+    onp.testing.assert_allclose(lrs['regular'], 0.5 * lr, rtol=1e-4)
+    onp.testing.assert_allclose(lrs['ssm'], 0.25 * ssm_lr, rtol=1e-4)
+
+
+def test_reduced_lr_is_floored_at_lr_min():
+    ssm_lr, lr = 1e-3, 4e-3
+    state = make_state(ssm_lr, lr)
+    state = update_lr_scale(state, plateau_lr_scales(1e-3 * lr, 1e-3 * ssm_lr, lr, ssm_lr))
+    lrs = applied_lrs(state)
+    onp.testing.assert_allclose(lrs['regular'], LR_MIN, rtol=1e-4)
+    onp.testing.assert_allclose(lrs['ssm'], LR_MIN, rtol=1e-4)
+
+
+def test_lr_below_lr_min_is_not_scaled():
+    # e.g. during warmup
+    state = make_state(0.5 * LR_MIN, 0.5 * LR_MIN)
+    state = update_lr_scale(state, {'ssm': 0.1, 'regular': 0.1})
+    lrs = applied_lrs(state)
+    onp.testing.assert_allclose(lrs['ssm'], 0.5 * LR_MIN, rtol=1e-4)
+    onp.testing.assert_allclose(lrs['regular'], 0.5 * LR_MIN, rtol=1e-4)
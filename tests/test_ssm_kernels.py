@@ -0,0 +1,71 @@
+""" Numeric parity of the SSM compute kernels (s5.ssm.SSM_KERNELS) with the
+    reference parallel scan apply_ssm.
+"""
+import numpy as onp
+import pytest
+import jax
+import jax.numpy as np
+
+from s5.ssm import SSM_KERNELS, apply_ssm, check_kernel_parity
+
+
+H, P = 4, 8
+CHUNK_SIZE = 16
+
+
+def ssm_inputs(L, conj_sym, bidirectional, seed=0):
+    """ discretized SSM (stable eigenvalues) and an input sequence of length L """
+    rng = onp.random.default_rng(seed)
+    Lambda_bar = np.asarray(
+        onp.exp((-rng.uniform(0.01, 0.5, P) + 1j * rng.uniform(0, onp.pi, P)) * 0.1),
+        dtype=np.complex64)
+    B_bar = np.asarray(rng.normal(size=(P, H)) + 1j * rng.normal(size=(P, H)), dtype=np.complex64)
+    n_out = 2 * P if bidirectional else P
+    C_tilde = np.asarray(
+        rng.normal(size=(H, n_out)) + 1j * rng.normal(size=(H, n_out)), dtype=np.complex64)
+    u = np.asarray(rng.normal(size=(L, H)), dtype=np.float32)
+    return Lambda_bar, B_bar, C_tilde, u
+
+
+@pytest.mark.parametrize("kernel", sorted(SSM_KERNELS))
+@pytest.mark.parametrize("conj_sym", [True, False])
+@pytest.mark.parametrize("bidirectional", [False, True])
+# multiple of the chunk size, not a multiple, shorter than a chunk
+@pytest.mark.parametrize("L", [4 * CHUNK_SIZE, 3 * CHUNK_SIZE + 5, CHUNK_SIZE - 3])
+def test_kernel_matches_apply_ssm(kernel, conj_sym, bidirectional, L):
+    Lambda_bar, B_bar, C_tilde, u = ssm_inputs(L, conj_sym, bidirectional)
+    kwargs = {"chunk_size": CHUNK_SIZE} if kernel == "chunked" else {}
+
+    ref = apply_ssm(Lambda_bar, B_bar, C_tilde, u, conj_sym, bidirectional)
+    ys = jax.jit(lambda u: SSM_KERNELS[kernel](
+        Lambda_bar, B_bar, C_tilde, u, conj_sym, bidirectional, **kwargs))(u)
+
+    assert ys.shape == (L, H)
+    scale = float(np.max(np.abs(ref)))
+    onp.testing.assert_allclose(ys, ref, rtol=1e-4, atol=1e-4 * scale)
+
+
+@pytest.mark.parametrize("kernel", sorted(k for k in SSM_KERNELS if k != "scan"))
+def test_kernel_gradients_match_apply_ssm(kernel):
+    """ training uses the gradients w.r.t. the SSM matrices and the inputs """
+    L = 3 * CHUNK_SIZE + 5
+    Lambda_bar, B_bar, C_tilde, u = ssm_inputs(L, conj_sym=True, bidirectional=True)
+    kwargs = {"chunk_size": CHUNK_SIZE} if kernel == "chunked" else {}
+
+    def loss(apply_fn, B_bar, u, **kwargs):
+        return np.sum(apply_fn(Lambda_bar, B_bar, C_tilde, u, True, True, **kwargs) ** 2)
+
+    ref = jax.grad(lambda B_bar, u: loss(apply_ssm, B_bar, u), argnums=(0, 1))(B_bar, u)
+    grads = jax.grad(
+        lambda B_bar, u: loss(SSM_KERNELS[kernel], B_bar, u, **kwargs), argnums=(0, 1))(B_bar, u)
+
+    for g, g_ref in zip(grads, ref):
+        scale = float(np.max(np.abs(g_ref)))
+        onp.testing.assert_allclose(g, g_ref, rtol=1e-3, atol=1e-4 * scale)
+
+
+def test_check_kernel_parity():
+    Lambda_bar, B_bar, C_tilde, u = ssm_inputs(3 * CHUNK_SIZE + 5, True, False)
+    err, ok = check_kernel_parity(
+        "chunked", Lambda_bar, B_bar, C_tilde, u, True, False, chunk_size=CHUNK_SIZE)
+    assert ok, f"max. abs. error {err}"